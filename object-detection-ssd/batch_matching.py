@@ -0,0 +1,153 @@
+#
+# batched SSD target encoding for train_ssd.py: the ground truth boxes of a whole batch are padded
+# into one (B, T, 4) tensor and matched against the priors in one shot, instead of running
+# vision.ssd.ssd.MatchPrior per sample inside the dataloader workers.
+# The result is identical to MatchPrior: same IoU, same prior assignment (including every target
+# keeping its best prior) and the same location encoding (vision/utils/box_utils.py).
+#
+# Used as the collate_fn of the DataLoader (encoding on the worker's CPU), or with
+# encode_on_device=True to hand the padded targets to the training loop, which encodes them on
+# the training device.
+#
+import numpy as np
+import torch
+from torch.utils.data.dataloader import default_collate
+
+from vision.utils import box_utils
+
+
+class BatchMatchPrior:
+    def __init__(self, center_form_priors, center_variance, size_variance, iou_threshold):
+        self.center_form_priors = center_form_priors
+        self.corner_form_priors = box_utils.center_form_to_corner_form(center_form_priors)
+        self.center_variance = center_variance
+        self.size_variance = size_variance
+        self.iou_threshold = iou_threshold
+
+    # gt_boxes (B, T, 4) corner form boxes in percent coordinates, gt_labels (B, T), valid (B, T)
+    # marks the real targets of the padded layout. Returns locations (B, P, 4) and labels (B, P).
+    def __call__(self, gt_boxes, gt_labels, valid):
+        device = gt_boxes.device
+        center_form_priors = self.center_form_priors.to(device)
+        corner_form_priors = self.corner_form_priors.to(device)
+        batch_size, num_targets = gt_labels.shape
+        num_priors = corner_form_priors.size(0)
+
+        # (B, P, T) IoU of every prior with every target, padding can never be the best target
+        ious = box_utils.iou_of(gt_boxes.unsqueeze(1), corner_form_priors.view(1, num_priors, 1, 4))
+        ious = ious.masked_fill(~valid.unsqueeze(1), -1.0)
+        best_target_per_prior, best_target_per_prior_index = ious.max(2)
+        _, best_prior_per_target_index = ious.max(1)
+
+        # every target gets its best prior; like the loop in assign_priors, a later target wins
+        # a prior that is the best one of several targets
+        batch_index = torch.arange(batch_size, device=device)
+        for target_index in range(num_targets):
+            rows = batch_index[valid[:, target_index]]
+            best_target_per_prior_index[rows, best_prior_per_target_index[rows, target_index]] = target_index
+        target_rows = batch_index.unsqueeze(1).expand(batch_size, num_targets)[valid]
+        best_target_per_prior[target_rows, best_prior_per_target_index[valid]] = 2.0
+
+        labels = gt_labels.gather(1, best_target_per_prior_index)
+        labels = labels.masked_fill(best_target_per_prior < self.iou_threshold, 0)
+        boxes = gt_boxes.gather(1, best_target_per_prior_index.unsqueeze(2).expand(batch_size, num_priors, 4))
+        # an image without targets is all background, its priors encode to zero locations
+        empty = ~valid.any(1)
+        if empty.any():
+            boxes[empty] = corner_form_priors
+        boxes = box_utils.corner_form_to_center_form(boxes)
+        locations = box_utils.convert_boxes_to_locations(boxes, center_form_priors,
+                                                         self.center_variance, self.size_variance)
+        return locations, labels
+
+
+# Function that pads per-sample (boxes, labels) into (B, T, 4) boxes, (B, T) labels and a (B, T) valid mask
+def pad_targets(boxes_list, labels_list):
+    boxes_list = [np.asarray(boxes, dtype=np.float32).reshape(-1, 4) for boxes in boxes_list]
+    num_targets = max([1] + [len(boxes) for boxes in boxes_list])
+    gt_boxes = np.zeros((len(boxes_list), num_targets, 4), dtype=np.float32)
+    gt_labels = np.zeros((len(boxes_list), num_targets), dtype=np.int64)
+    valid = np.zeros((len(boxes_list), num_targets), dtype=bool)
+    for i, (boxes, labels) in enumerate(zip(boxes_list, labels_list)):
+        gt_boxes[i, :len(boxes)] = boxes
+        gt_labels[i, :len(boxes)] = np.asarray(labels, dtype=np.int64).reshape(-1)
+        valid[i, :len(boxes)] = True
+    return torch.from_numpy(gt_boxes), torch.from_numpy(gt_labels), torch.from_numpy(valid)
+
+
+# collate_fn for datasets without a target_transform: stacks the images and encodes the batch's
+# targets at once. With encode_on_device=True it returns (images, gt_boxes, gt_labels, valid) and
+# the training loop calls the matcher after moving the batch to its device.
+class MatchPriorCollate:
+    def __init__(self, matcher, encode_on_device=False):
+        self.matcher = matcher
+        self.encode_on_device = encode_on_device
+
+    def __call__(self, batch):
+        images = default_collate([sample[0] for sample in batch])
+        gt_boxes, gt_labels, valid = pad_targets([sample[1] for sample in batch], [sample[2] for sample in batch])
+        if self.encode_on_device:
+            return images, gt_boxes, gt_labels, valid
+        locations, labels = self.matcher(gt_boxes, gt_labels, valid)
+        return images, locations, labels
+
+
+# Main function: parity check and benchmark against the per-sample MatchPrior of the training code
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    from vision.ssd.config import mobilenetv1_ssd_config as config
+    from vision.ssd.ssd import MatchPrior
+
+    parser = argparse.ArgumentParser(description="Benchmark batched SSD target encoding against MatchPrior.")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-targets", type=int, default=8, help="ground truth boxes per image (1 to max)")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--device", type=str, default="cpu")
+    opt = parser.parse_args()
+
+    per_sample = MatchPrior(config.priors, config.center_variance, config.size_variance, 0.5)
+    batched = BatchMatchPrior(config.priors, config.center_variance, config.size_variance, 0.5)
+
+    # random boxes in percent coordinates, including tiny, overlapping and duplicated ones
+    rng = np.random.default_rng(0)
+    samples = []
+    for i in range(opt.batch_size):
+        count = int(rng.integers(1, opt.max_targets + 1))
+        corners = np.sort(rng.uniform(0.0, 1.0, size=(count, 2, 2)), axis=1)
+        boxes = corners.transpose(0, 2, 1).reshape(count, 4)[:, [0, 2, 1, 3]].astype(np.float32)
+        boxes[:, 2:] = np.maximum(boxes[:, 2:], boxes[:, :2] + 0.01)
+        if count > 1 and i % 4 == 0:
+            boxes[-1] = boxes[0]
+        samples.append((boxes, rng.integers(1, 18, size=count).astype(np.int64)))
+
+    def run_per_sample():
+        encoded = [per_sample(boxes.copy(), labels.copy()) for boxes, labels in samples]
+        return torch.stack([e[0] for e in encoded]), torch.stack([e[1] for e in encoded])
+
+    def run_batched():
+        gt_boxes, gt_labels, valid = pad_targets(*zip(*samples))
+        result = batched(gt_boxes.to(opt.device), gt_labels.to(opt.device), valid.to(opt.device))
+        if opt.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        return result
+
+    def benchmark(fn):
+        fn()
+        start = time.perf_counter()
+        for _ in range(opt.runs):
+            result = fn()
+        return result, (time.perf_counter() - start) / opt.runs
+
+    (reference_locations, reference_labels), per_sample_time = benchmark(run_per_sample)
+    (locations, labels), batched_time = benchmark(run_batched)
+
+    assert torch.equal(labels.cpu(), reference_labels), 'label mismatch'
+    max_diff = (locations.cpu() - reference_locations).abs().max().item()
+    assert max_diff < 1e-5, 'location mismatch ({:g})'.format(max_diff)
+
+    print('{:d} priors x {:d} images, {:d} positive priors, max location difference {:g}'.format(
+        config.priors.size(0), opt.batch_size, int((labels > 0).sum()), max_diff))
+    print('per-sample MatchPrior:      {:8.2f} ms'.format(per_sample_time * 1000))
+    print('batched ({:s}):{:s}{:8.2f} ms'.format(opt.device, ' ' * max(1, 17 - len(opt.device)), batched_time * 1000))
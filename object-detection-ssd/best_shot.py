@@ -0,0 +1,144 @@
+#
+# per-visit best-shot selection for bird memories. While a bird is in front of the camera every
+# frame is scored cheaply (confidence, size and centering of the box, sharpness of a downscaled
+# ROI) and only the few best crops are kept; exactly one of them is emitted when the visit ends.
+#
+import collections
+import time
+
+import cv2
+import numpy as np
+
+from memory_image import crop_roi
+
+# image - copied crop of the frame around the bird (same channel order as the frame)
+# box - (left, top, right, bottom) of the bird in frame pixels
+Shot = collections.namedtuple('Shot', ['score', 'confidence', 'sharpness', 'box', 'image', 'timestamp'])
+
+
+# Function that returns the variance of the Laplacian of an image, a cheap focus/blur measure
+def laplacian_variance(img):
+    img = np.ascontiguousarray(img)
+    if img.ndim == 3:
+        img = cv2.cvtColor(img[..., :3], cv2.COLOR_RGB2GRAY)
+    return float(cv2.Laplacian(img, cv2.CV_32F).var())
+
+
+class Visit:
+    def __init__(self, class_id):
+        self.class_id = class_id
+        self.shots = []
+        self.frames = 0
+
+
+class BestShotSelector:
+    # max_candidates - crops kept per visit
+    # crop_margin - margin added around the box on every side, relative to the box size
+    #               (None = keep the whole frame)
+    # sharpness_size - longer side of the downscaled ROI the sharpness is measured on
+    # sharpness_scale - Laplacian variance at which the sharpness term is worth half its weight
+    # weights - weight of the confidence, size, centering and sharpness terms of the score
+    # target_fraction - box area (fraction of the frame) that gets the full size term
+    def __init__(self, max_candidates=4, crop_margin=0.5, sharpness_size=64, sharpness_scale=100.0,
+                 weights=(1.0, 0.5, 0.5, 1.0), target_fraction=0.15):
+        self.max_candidates = max_candidates
+        self.crop_margin = crop_margin
+        self.sharpness_size = sharpness_size
+        self.sharpness_scale = sharpness_scale
+        self.weights = weights
+        self.target_fraction = target_fraction
+        self.visits = {}
+        self.offered = 0
+        self.scored = 0
+
+    # Start recording a visit (key identifies the visit, e.g. a track id)
+    def open_visit(self, key, class_id):
+        if key not in self.visits:
+            self.visits[key] = Visit(class_id)
+
+    def has_visit(self, key):
+        return key in self.visits
+
+    # Offers a frame to a visit. row is the detection (class_id, confidence, left, top, right, bottom)
+    # and frame the HxWxC image it was found on; the crop is only copied if it makes the cut.
+    def offer(self, key, frame, row):
+        visit = self.visits.get(key)
+        if visit is None:
+            return False
+        visit.frames += 1
+        self.offered += 1
+
+        height, width = frame.shape[:2]
+        confidence = float(row[1])
+        left, top, right, bottom = (int(round(v)) for v in (
+            max(row[2], 0), max(row[3], 0), min(row[4], width), min(row[5], height)))
+        if right <= left or bottom <= top:
+            return False
+
+        # cheap terms first: skip the sharpness measurement if even a perfectly sharp frame can't make the cut
+        w_confidence, w_size, w_center, w_sharpness = self.weights
+        area_fraction = (right - left) * (bottom - top) / float(width * height)
+        center_x, center_y = (left + right) / 2.0 / width, (top + bottom) / 2.0 / height
+        centering = 1.0 - min(1.0, 2.0 * max(abs(center_x - 0.5), abs(center_y - 0.5)))
+        score = (w_confidence * confidence + w_size * min(1.0, area_fraction / self.target_fraction)
+                 + w_center * centering)
+
+        worst = visit.shots[-1].score if len(visit.shots) >= self.max_candidates else None
+        if worst is not None and score + w_sharpness <= worst:
+            return False
+
+        roi = frame[top:bottom, left:right]
+        step = max(1, max(bottom - top, right - left) // self.sharpness_size)
+        sharpness = laplacian_variance(roi[::step, ::step])
+        self.scored += 1
+        score += w_sharpness * sharpness / (sharpness + self.sharpness_scale)
+        if worst is not None and score <= worst:
+            return False
+
+        shot = Shot(score, confidence, sharpness, (left, top, right, bottom),
+                    self._crop(frame, left, top, right, bottom), time.time())
+        visit.shots.append(shot)
+        visit.shots.sort(key=lambda candidate: -candidate.score)
+        del visit.shots[self.max_candidates:]
+        return True
+
+    # Ends the given visits, returns (class_id, best Shot) for each that got at least one shot
+    def end_visits(self, keys):
+        ended = []
+        for key in keys:
+            visit = self.visits.pop(key, None)
+            if visit is not None and visit.shots:
+                ended.append((visit.class_id, visit.shots[0]))
+        return ended
+
+    # Ends all visits (e.g. at the end of a detection cycle)
+    def flush(self):
+        return self.end_visits(list(self.visits))
+
+    def _crop(self, frame, left, top, right, bottom):
+        if self.crop_margin is None:
+            return np.array(frame)
+        return np.array(crop_roi(frame, (left, top, right, bottom), self.crop_margin))
+
+
+# Main function for testing during development
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    texture = rng.integers(0, 255, size=(200, 200, 3), dtype=np.uint8)
+    blurred = cv2.GaussianBlur(texture, (15, 15), 5)
+
+    selector = BestShotSelector()
+    selector.open_visit(7, 3)
+    start = time.perf_counter()
+    for i in range(60):
+        frame = np.zeros((720, 1280, 3), dtype=np.uint8)
+        x = 100 + i * 15
+        frame[260:460, x:x + 200] = texture if i == 30 else blurred
+        selector.offer(7, frame, np.array([3, 0.93, x, 260, x + 200, 460], dtype=np.float32))
+    elapsed = time.perf_counter() - start
+
+    class_id, shot = selector.end_visits([7])[0]
+    print('best shot: frame {:d}, score {:.3f}, sharpness {:.1f}, crop {}'.format(
+        (shot.box[0] - 100) // 15, shot.score, shot.sharpness, shot.image.shape))
+    print('offered {:d}, scored {:d}, {:.3f} ms/frame'.format(
+        selector.offered, selector.scored, elapsed * 1000 / selector.offered))
@@ -0,0 +1,184 @@
+#
+# resumable training checkpoints for train_ssd.py. Every checkpoint is a pair of files:
+#   <net>-Epoch-<epoch>-Loss-<loss>.pth   the model's state_dict, as net.save() writes it
+#                                          (so net.load() and onnx_export.py's best-loss finder keep working)
+#   <net>-Epoch-<epoch>-Loss-<loss>.ckpt  optimizer, scheduler, epoch and RNG state to resume from
+#
+# The states are copied to CPU memory on the training thread and written by a background thread,
+# each file to a temp file that is renamed into place, so a preempted run never leaves half a
+# checkpoint behind. Of the checkpoints a saver writes, only the best keep_best by validation loss
+# (plus the latest one, to resume from) are kept; files of earlier runs in the folder are never touched.
+#
+import logging
+import os
+import queue
+import random
+import re
+import tempfile
+import threading
+
+import numpy as np
+import torch
+
+STATE_SUFFIX = '.ckpt'
+
+
+# Function that parses (epoch, loss) out of a checkpoint name, None if the file is not a checkpoint of net_name
+def parse_checkpoint_name(file_name, net_name):
+    match = re.match(r'^{:s}-Epoch-(\d+)-Loss-(.+)\.pth$'.format(re.escape(net_name)), file_name)
+    if not match:
+        return None
+    try:
+        return int(match.group(1)), float(match.group(2))
+    except ValueError:
+        return None
+
+
+# Function that lists the (epoch, loss, path) of net_name's checkpoints in a folder, oldest first
+def list_checkpoints(folder, net_name):
+    checkpoints = []
+    for file_name in os.listdir(folder):
+        parsed = parse_checkpoint_name(file_name, net_name)
+        if parsed:
+            checkpoints.append((parsed[0], parsed[1], os.path.join(folder, file_name)))
+    return sorted(checkpoints)
+
+
+# Function that returns the path of the newest checkpoint of net_name in a folder (None if there is none)
+def latest_checkpoint(folder, net_name):
+    checkpoints = list_checkpoints(folder, net_name)
+    return checkpoints[-1][2] if checkpoints else None
+
+
+# Function that returns the path of the training state file belonging to a model checkpoint
+def state_path(model_path):
+    return os.path.splitext(model_path)[0] + STATE_SUFFIX
+
+
+# Function that copies all tensors of a (nested) state to CPU memory, so training can go on while it is written
+def snapshot(state):
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        copy = type(state)((key, snapshot(value)) for key, value in state.items())
+        # module state_dicts carry version metadata for load_state_dict()
+        if hasattr(state, '_metadata'):
+            copy._metadata = state._metadata
+        return copy
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def capture_rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# Function that writes obj with torch.save atomically (temp file in the same folder, then a rename)
+def atomic_save(obj, path):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as checkpoint_file:
+            torch.save(obj, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# Function that restores the optimizer, scheduler and (optionally) RNG state saved next to a model
+# checkpoint. Returns the epoch the checkpoint was saved after, None if it has no training state.
+def load_training_state(model_path, optimizer, scheduler, restore_rng=True):
+    path = state_path(model_path)
+    if not os.path.isfile(path):
+        return None
+    # the file holds more than tensors (RNG state), it is one of our own checkpoints
+    try:
+        state = torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        state = torch.load(path, map_location='cpu')
+    optimizer.load_state_dict(state['optimizer'])
+    scheduler.load_state_dict(state['scheduler'])
+    if restore_rng:
+        restore_rng_state(state['rng'])
+    return state['epoch']
+
+
+# Writes checkpoints from a background thread. At most one snapshot waits while another one is
+# written, save() blocks beyond that, so memory use stays bounded if the disk is slow.
+class CheckpointSaver(threading.Thread):
+    # keep_best - number of best checkpoints (by validation loss) to keep, 0 keeps all of them
+    def __init__(self, folder, net_name, keep_best=5):
+        super().__init__(name='checkpoint-saver', daemon=True)
+        self.folder = folder
+        self.net_name = net_name
+        self.keep_best = keep_best
+        self.failures = 0
+        # (loss, path) of the checkpoints written by this saver and not pruned yet, oldest first
+        self.saved = []
+        self._queue = queue.Queue(maxsize=1)
+
+    # Returns the path the model checkpoint is going to be written to
+    def save(self, epoch, val_loss, net, optimizer, scheduler):
+        model_path = os.path.join(self.folder, f"{self.net_name}-Epoch-{epoch}-Loss-{val_loss}.pth")
+        training_state = {
+            'epoch': epoch,
+            'val_loss': val_loss,
+            'optimizer': snapshot(optimizer.state_dict()),
+            'scheduler': scheduler.state_dict(),
+            'rng': capture_rng_state(),
+        }
+        self._queue.put((model_path, snapshot(net.state_dict()), training_state))
+        return model_path
+
+    def run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            model_path, model_state, training_state = job
+            try:
+                # the training state goes first, so every .pth has its .ckpt
+                atomic_save(training_state, state_path(model_path))
+                atomic_save(model_state, model_path)
+                logging.info(f"Saved model {model_path}")
+                self.saved.append((training_state['val_loss'], model_path))
+                self.prune()
+            except Exception:
+                self.failures += 1
+                logging.exception(f"Failed to save checkpoint {model_path}")
+
+    # Deletes the checkpoints written by this saver, but the keep_best ones with the lowest loss and the latest one
+    def prune(self):
+        if self.keep_best <= 0 or not self.saved:
+            return
+        keep = {path for _, path in sorted(self.saved, key=lambda c: c[0])[:self.keep_best]}
+        keep.add(self.saved[-1][1])
+        for _, path in self.saved:
+            if path in keep:
+                continue
+            for file_path in (path, state_path(path)):
+                try:
+                    os.unlink(file_path)
+                except FileNotFoundError:
+                    pass
+            logging.info(f"Removed checkpoint {path}")
+        self.saved = [(loss, path) for loss, path in self.saved if path in keep]
+
+    # Waits for the pending checkpoints to be written
+    def close(self, timeout=None):
+        self._queue.put(None)
+        self.join(timeout)
@@ -0,0 +1,229 @@
+#
+# preprocessed, memory-mapped dataset cache for train_ssd.py.
+#
+# "Compiling" a dataset decodes every image once (optionally shrinking it so its longer side is
+# at most image_size) and writes all of them back to back into one uint8 file, with an index
+# (byte offset and shape of each image, its boxes in pixels and labels) next to it. Training then
+# reads images as zero-copy slices of a read-only memmap instead of decoding a JPEG per sample;
+# augmentation and target matching still run per sample, as they are random.
+#
+# The cache is tied to a key over the source files (path, size and mtime of every file under the
+# dataset root) and the compile options, and is rebuilt when the key no longer matches.
+#
+# Layout of a cache directory:
+#   images.u8    all images (HxWx3 RGB, uint8) back to back
+#   index.npz    offsets, shapes, box_offsets, boxes, labels, class_names, key
+#
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from memory_image import limit_size
+
+CACHE_VERSION = 1
+IMAGES_FILE = 'images.u8'
+INDEX_FILE = 'index.npz'
+
+
+# Function that computes the invalidation key of a cache: a hash over every file under the
+# dataset root (relative path, size, mtime) and the options the cache is compiled with.
+# exclude - directories left out of the hash, i.e. the caches themselves when they live inside
+#           the dataset root (otherwise every compile would invalidate the key it was built for)
+def source_key(root, exclude=(), **options):
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'version': CACHE_VERSION, 'options': options}, sort_keys=True).encode())
+    root = os.path.abspath(root)
+    excluded = {os.path.realpath(path) for path in exclude}
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories[:] = sorted(name for name in subdirectories
+                                   if os.path.realpath(os.path.join(directory, name)) not in excluded)
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            stat = os.stat(path)
+            digest.update('{}\0{:d}\0{:d}\n'.format(os.path.relpath(path, root), stat.st_size,
+                                                    stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+# Function that shrinks an image (and its pixel boxes) so its longer side is at most image_size
+def resize_sample(image, boxes, image_size=0):
+    height, width = image.shape[:2]
+    resized = limit_size(image, image_size)
+    if resized is image:
+        return image, boxes
+    new_height, new_width = resized.shape[:2]
+    return resized, boxes * np.array([new_width / width, new_height / height] * 2, dtype=np.float32)
+
+
+# Function that checks whether cache_dir holds a complete cache compiled with the given key
+def is_valid(cache_dir, key):
+    try:
+        with np.load(os.path.join(cache_dir, INDEX_FILE)) as index:
+            if str(index['key']) != key:
+                return False
+            expected = int(index['offsets'][-1]) if len(index['offsets']) else 0
+        return os.path.getsize(os.path.join(cache_dir, IMAGES_FILE)) == expected
+    except (OSError, KeyError, ValueError):
+        return False
+
+
+# Function that compiles a dataset into cache_dir.
+# dataset - returns raw (image RGB uint8, boxes in pixels, labels) samples, i.e. a VOCDataset or
+#           OpenImagesDataset created without transform/target_transform
+# num_workers - threads decoding images (OpenCV releases the GIL while decoding)
+def compile_dataset(dataset, cache_dir, key, image_size=0, num_workers=4, chunk_size=64):
+    os.makedirs(cache_dir, exist_ok=True)
+    images_path = os.path.join(cache_dir, IMAGES_FILE)
+    offsets, shapes, box_counts, all_boxes, all_labels = [0], [], [], [], []
+
+    def load(index):
+        image, boxes, labels = dataset[index]
+        image, boxes = resize_sample(np.ascontiguousarray(image, dtype=np.uint8),
+                                     np.asarray(boxes, dtype=np.float32).reshape(-1, 4), image_size)
+        return image, boxes, np.asarray(labels, dtype=np.int64).reshape(-1)
+
+    # the index is written last, so an interrupted compile never looks valid
+    index_path = os.path.join(cache_dir, INDEX_FILE)
+    if os.path.exists(index_path):
+        os.unlink(index_path)
+
+    with open(images_path, 'wb') as images_file, \
+            concurrent.futures.ThreadPoolExecutor(max(1, num_workers)) as executor:
+        for start in range(0, len(dataset), chunk_size):
+            indexes = range(start, min(start + chunk_size, len(dataset)))
+            for image, boxes, labels in executor.map(load, indexes):
+                images_file.write(image.data)
+                offsets.append(offsets[-1] + image.nbytes)
+                shapes.append(image.shape)
+                box_counts.append(len(boxes))
+                all_boxes.append(boxes)
+                all_labels.append(labels)
+            logging.info("Compiled {:d}/{:d} images into {:s}".format(indexes[-1] + 1, len(dataset), cache_dir))
+
+    tmp_path = os.path.join(cache_dir, 'index.tmp.npz')
+    np.savez(tmp_path,
+             offsets=np.array(offsets, dtype=np.int64),
+             shapes=np.array(shapes, dtype=np.int32).reshape(-1, 3),
+             box_offsets=np.concatenate([[0], np.cumsum(box_counts)]).astype(np.int64),
+             boxes=np.concatenate(all_boxes) if all_boxes else np.zeros((0, 4), dtype=np.float32),
+             labels=np.concatenate(all_labels) if all_labels else np.zeros(0, dtype=np.int64),
+             class_names=np.array(list(dataset.class_names)),
+             key=np.array(key))
+    os.replace(tmp_path, index_path)
+
+
+# Map-style dataset over a compiled cache, with the same transform/target_transform interface as
+# the datasets it was compiled from. The memmap is opened lazily, so every DataLoader worker maps
+# the file itself after the fork instead of inheriting a handle.
+class CachedDataset:
+    def __init__(self, cache_dir, transform=None, target_transform=None):
+        self.cache_dir = cache_dir
+        self.transform = transform
+        self.target_transform = target_transform
+        with np.load(os.path.join(cache_dir, INDEX_FILE)) as index:
+            self.offsets = index['offsets']
+            self.shapes = index['shapes']
+            self.box_offsets = index['box_offsets']
+            self.boxes = index['boxes']
+            self.labels = index['labels']
+            self.class_names = [str(name) for name in index['class_names']]
+            self.key = str(index['key'])
+        self._images = None
+
+    def __len__(self):
+        return len(self.shapes)
+
+    # Returns the cached image as a read-only view into the memmap, plus copies of its boxes/labels
+    def get_raw(self, index):
+        if self._images is None:
+            self._images = np.memmap(os.path.join(self.cache_dir, IMAGES_FILE), dtype=np.uint8, mode='r')
+        image = self._images[self.offsets[index]:self.offsets[index + 1]].reshape(self.shapes[index])
+        start, end = self.box_offsets[index], self.box_offsets[index + 1]
+        return image, self.boxes[start:end].copy(), self.labels[start:end].copy()
+
+    def __getitem__(self, index):
+        image, boxes, labels = self.get_raw(index)
+        if self.transform:
+            image, boxes, labels = self.transform(image, boxes, labels)
+        if self.target_transform:
+            boxes, labels = self.target_transform(boxes, labels)
+        return image, boxes, labels
+
+    # the memmap is not pickled along with the dataset (DataLoader workers reopen it)
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_images'] = None
+        return state
+
+    def __repr__(self):
+        return 'CachedDataset({:s}, {:d} images, {:d} classes)'.format(
+            self.cache_dir, len(self), len(self.class_names))
+
+
+# Function that returns a CachedDataset for a dataset, compiling it first if the cache is missing or stale.
+# create_raw_dataset - called without arguments to create the untransformed source dataset
+# cache_root - directory holding the caches of all splits (default cache_dir), never part of the key
+def open_cached_dataset(create_raw_dataset, root, cache_dir, transform=None, target_transform=None,
+                        image_size=0, num_workers=4, cache_root=None, **options):
+    key = source_key(root, exclude=(cache_root or cache_dir, cache_dir), image_size=image_size, **options)
+    if not is_valid(cache_dir, key):
+        logging.info("Dataset cache {:s} is missing or stale, compiling it from {:s}".format(cache_dir, root))
+        compile_dataset(create_raw_dataset(), cache_dir, key, image_size=image_size, num_workers=num_workers)
+    dataset = CachedDataset(cache_dir, transform=transform, target_transform=target_transform)
+    logging.info(dataset)
+    return dataset
+
+
+# Function that names the cache directory of one dataset split below cache_root
+def cache_path(cache_root, dataset_path, dataset_type, split):
+    name = os.path.basename(os.path.normpath(dataset_path))
+    digest = hashlib.sha256(os.path.abspath(dataset_path).encode()).hexdigest()[:8]
+    return os.path.join(cache_root, '{:s}-{:s}-{:s}-{:s}'.format(name, digest, dataset_type, split))
+
+
+# Main function: compile (or check) the caches of datasets ahead of training, or benchmark a cache
+if __name__ == '__main__':
+    import argparse
+    import sys
+    import time
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='%(asctime)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
+
+    parser = argparse.ArgumentParser(description="Compile datasets into memory-mapped caches for train_ssd.py.")
+    parser.add_argument("--dataset-type", default="open_images", type=str, choices=['voc', 'open_images'])
+    parser.add_argument('--datasets', '--data', nargs='+', default=["data"], help='Dataset directory path')
+    parser.add_argument("--cache-dir", type=str, required=True, help="directory holding the caches")
+    parser.add_argument("--cache-image-size", type=int, default=512,
+                        help="longer side of the cached images in pixels (0 = keep the original size)")
+    parser.add_argument("--balance-data", action='store_true')
+    parser.add_argument("--workers", type=int, default=4, help="threads decoding images")
+    parser.add_argument("--benchmark", action='store_true', help="time reading every sample of the caches")
+    opt = parser.parse_args()
+
+    from vision.datasets.voc_dataset import VOCDataset
+    from vision.datasets.open_images import OpenImagesDataset
+
+    for dataset_path in opt.datasets:
+        for split in ('train', 'test'):
+            if opt.dataset_type == 'voc':
+                def create_raw(): return VOCDataset(dataset_path, is_test=split == 'test')
+            else:
+                def create_raw(): return OpenImagesDataset(dataset_path, dataset_type=split,
+                                                           balance_data=opt.balance_data and split == 'train')
+            dataset = open_cached_dataset(create_raw, dataset_path,
+                                          cache_path(opt.cache_dir, dataset_path, opt.dataset_type, split),
+                                          image_size=opt.cache_image_size, num_workers=opt.workers,
+                                          cache_root=opt.cache_dir,
+                                          dataset_type=opt.dataset_type, split=split,
+                                          balance_data=opt.balance_data and split == 'train')
+            if opt.benchmark:
+                start = time.perf_counter()
+                for i in range(len(dataset)):
+                    dataset[i]
+                elapsed = time.perf_counter() - start
+                print('{}: {:.0f} samples/sec'.format(dataset, len(dataset) / elapsed if elapsed else 0.0))
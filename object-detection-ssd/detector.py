@@ -0,0 +1,257 @@
+#
+# backend-agnostic object detector interface.
+#
+# Every backend exposes the subset of jetson.inference.detectNet used by the feeder
+# (Detect, GetClassDesc, GetNetworkFPS) and returns objects with the same attributes as
+# detectNet's detections (ClassID, Confidence, Left, Top, Right, Bottom, ...), so the
+# decision logic runs unchanged on a Jetson, on an x86 box with ONNX Runtime, or on a fake.
+#
+import time
+
+import cv2
+import numpy as np
+
+import ssd_postprocess
+from metrics import METRICS
+
+BACKENDS = ('jetson', 'onnx')
+
+
+# Same attributes as jetson.inference.detectNet.Detection (box in pixels)
+class Detection:
+    __slots__ = ('ClassID', 'Confidence', 'Left', 'Top', 'Right', 'Bottom')
+
+    def __init__(self, class_id, confidence, left, top, right, bottom):
+        self.ClassID = class_id
+        self.Confidence = confidence
+        self.Left = left
+        self.Top = top
+        self.Right = right
+        self.Bottom = bottom
+
+    @property
+    def Width(self):
+        return self.Right - self.Left
+
+    @property
+    def Height(self):
+        return self.Bottom - self.Top
+
+    @property
+    def Area(self):
+        return self.Width * self.Height
+
+    @property
+    def Center(self):
+        return ((self.Left + self.Right) / 2, (self.Top + self.Bottom) / 2)
+
+    def __repr__(self):
+        return '<Detection ClassID={:d} Confidence={:.3f} Left={:.1f} Top={:.1f} Right={:.1f} Bottom={:.1f}>'.format(
+            self.ClassID, self.Confidence, self.Left, self.Top, self.Right, self.Bottom)
+
+
+# Function that reads a labels.txt file (one class per line, BACKGROUND first)
+def load_labels(path):
+    with open(path) as labels_file:
+        return [name.strip() for name in labels_file.readlines() if name.strip()]
+
+
+class Detector:
+    def __init__(self, class_names):
+        self.class_names = list(class_names)
+        self._fps = 0.0
+
+    # Detect objects in an image, returns a list of Detection
+    def Detect(self, img, overlay='none'):
+        raise NotImplementedError
+
+    # Detect objects in several images, returns one list of Detection per image
+    def DetectBatch(self, imgs, overlay='none'):
+        return [self.Detect(img, overlay=overlay) for img in imgs]
+
+    def detect(self, img):
+        return self.Detect(img)
+
+    def GetClassDesc(self, class_id):
+        return self.class_names[class_id]
+
+    def GetNumClasses(self):
+        return len(self.class_names)
+
+    def GetNetworkFPS(self):
+        return self._fps
+
+    # exponentially smoothed frames/sec of the network itself
+    def _record_time(self, elapsed):
+        fps = 1.0 / elapsed if elapsed > 0 else 0.0
+        self._fps = fps if not self._fps else 0.9 * self._fps + 0.1 * fps
+
+
+# TensorRT detectNet on the Jetson (needs the jetson-inference python bindings)
+class JetsonDetector(Detector):
+    def __init__(self, network, argv, threshold):
+        import jetson.inference
+
+        self.net = jetson.inference.detectNet(network, argv, threshold)
+        super().__init__([self.net.GetClassDesc(i) for i in range(self.net.GetNumClasses())])
+
+    # detectNet decodes and runs NMS inside Detect, so its post-processing counts as inference
+    def Detect(self, img, overlay='none'):
+        with METRICS.stage('inference'):
+            return self.net.Detect(img, overlay=overlay)
+
+    def GetNetworkFPS(self):
+        return self.net.GetNetworkFPS()
+
+    def PrintProfilerTimes(self):
+        self.net.PrintProfilerTimes()
+
+
+# ONNX Runtime on the CPU, for models exported by onnx_export.py ('input_0' -> 'scores', 'boxes').
+# The SSD preprocessing, box decoding and NMS that TensorRT's detectNet does are done here in NumPy,
+# unless the model was exported with --fuse-nms (then the graph's 'selected_indices' are used).
+class OnnxDetector(Detector):
+    # raw_outputs - set if the model outputs raw confidences/locations (exported without is_test),
+    #               they are then softmaxed and decoded against the SSD priors here
+    def __init__(self, model, labels, threshold=0.5, iou_threshold=0.45, top_k=-1,
+                 input_size=ssd_postprocess.IMAGE_SIZE, mean=ssd_postprocess.IMAGE_MEAN,
+                 std=ssd_postprocess.IMAGE_STD, raw_outputs=False, num_threads=0):
+        import onnxruntime
+
+        super().__init__(load_labels(labels))
+        self.threshold = threshold
+        self.iou_threshold = iou_threshold
+        self.top_k = top_k
+        self.input_size = input_size
+        self.mean = mean
+        self.std = std
+        self.raw_outputs = raw_outputs
+        self.priors = ssd_postprocess.generate_priors(image_size=input_size) if raw_outputs else None
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.fused_nms = 'selected_indices' in [output.name for output in self.session.get_outputs()]
+        self._check_outputs()
+        # models exported with a fixed batch size can only take that many images per run
+        batch_dim = self.session.get_inputs()[0].shape[0]
+        self.max_batch_size = batch_dim if isinstance(batch_dim, int) else 0
+
+    # Function that rejects a model that does not match raw_outputs (onnx_export.py --raw-outputs),
+    # since decoding the wrong kind of outputs silently gives garbage boxes
+    def _check_outputs(self):
+        height, width = self.session.get_inputs()[0].shape[2:4]
+        dynamic_size = not isinstance(height, int) or not isinstance(width, int)
+        num_boxes = self.session.get_outputs()[1].shape[1]
+        if self.raw_outputs and self.fused_nms:
+            raise ValueError("Model has fused NMS outputs, it was not exported with --raw-outputs")
+        if not self.raw_outputs and dynamic_size:
+            raise ValueError("Model has a dynamic input size, it was exported with --raw-outputs")
+        if self.raw_outputs and isinstance(num_boxes, int) and num_boxes != len(self.priors):
+            raise ValueError("Model outputs {:d} boxes, but there are {:d} SSD priors for a {:d}px input".format(
+                num_boxes, len(self.priors), self.input_size))
+
+    # Function that turns an RGB HxWxC image into the normalized 1x3xSxS float tensor the SSD expects
+    def preprocess(self, img):
+        return ssd_postprocess.preprocess_image(img, self.input_size, self.input_size, self.mean, self.std)
+
+    def Detect(self, img, overlay='none'):
+        return self.DetectBatch([img])[0]
+
+    # Runs the whole batch through the network in one go (in chunks for fixed-batch models)
+    # and post-processes all images with one vectorized decode + NMS pass
+    def DetectBatch(self, imgs, overlay='none'):
+        imgs = [np.asarray(img) for img in imgs]
+        chunk_size = self.max_batch_size or len(imgs)
+
+        start = time.perf_counter()
+        outputs = []
+        for i in range(0, len(imgs), chunk_size):
+            batch = np.concatenate([self.preprocess(img) for img in imgs[i:i + chunk_size]])
+            outputs.append(self.session.run(None, {self.input_name: batch}))
+        elapsed = time.perf_counter() - start
+        self._record_time(elapsed / len(imgs))
+        METRICS.observe('inference', elapsed)
+
+        start = time.perf_counter()
+        results = []
+        for output in outputs:
+            scores, boxes = output[0], output[1]
+            if self.fused_nms:
+                results.extend(ssd_postprocess.select_postprocess(
+                    scores, boxes, output[2], self.threshold, self.top_k))
+                continue
+            if self.raw_outputs:
+                scores, boxes = ssd_postprocess.decode(scores, boxes, self.priors)
+            results.extend(ssd_postprocess.batched_postprocess(
+                scores, boxes, self.threshold, self.iou_threshold, self.top_k))
+
+        detections = []
+        for img, (boxes, labels, probs) in zip(imgs, results):
+            height, width = img.shape[:2]
+            scale = np.array([width, height, width, height], dtype=np.float32)
+            boxes = np.clip(boxes, 0.0, 1.0) * scale
+            detections.append([Detection(int(label), float(prob), *map(float, box))
+                               for box, label, prob in zip(boxes, labels, probs)])
+        METRICS.observe('postprocess', time.perf_counter() - start)
+        return detections
+
+
+# Stand-in for the detection network: sleeps for the given latency (like waiting on the GPU)
+# and returns a fixed list of detections
+class FakeDetector(Detector):
+    def __init__(self, latency=0.03, detections=None, class_names=None):
+        super().__init__(class_names or [])
+        self.latency = latency
+        self.detections = list(detections or [])
+        self.calls = 0
+
+    def Detect(self, img, overlay='none'):
+        self.calls += 1
+        if self.latency:
+            with METRICS.stage('inference'):
+                time.sleep(self.latency)
+            self._record_time(self.latency)
+        return list(self.detections)
+
+
+# Function that creates the detector for the chosen backend
+# (for 'jetson', model/labels and other detectNet options are read from argv by detectNet itself)
+# raw_outputs - the ONNX model was exported with onnx_export.py --raw-outputs
+def create_detector(backend, network, argv, threshold, model=None, labels=None, num_threads=0, raw_outputs=False):
+    if backend == 'jetson':
+        return JetsonDetector(network, argv, threshold)
+    if backend == 'onnx':
+        if not model or not labels:
+            raise ValueError("The onnx backend needs --model and --labels")
+        return OnnxDetector(model, labels, threshold=threshold, num_threads=num_threads, raw_outputs=raw_outputs)
+    raise ValueError(f"Detector backend {backend} is not supported, expected one of {BACKENDS}")
+
+
+# Main function for testing during development
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the ONNX Runtime detector on an image.")
+    parser.add_argument("image", type=str, help="path to an image")
+    parser.add_argument("--model", type=str, required=True, help="path to the ONNX model")
+    parser.add_argument("--labels", type=str, required=True, help="path to labels.txt")
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--raw-outputs", action='store_true',
+                        help="the model was exported with onnx_export.py --raw-outputs")
+    parser.add_argument("--runs", type=int, default=20, help="number of timed runs")
+    opt = parser.parse_args()
+
+    detector = OnnxDetector(opt.model, opt.labels, threshold=opt.threshold, raw_outputs=opt.raw_outputs)
+    image = cv2.cvtColor(cv2.imread(opt.image), cv2.COLOR_BGR2RGB)
+
+    start = time.perf_counter()
+    for _ in range(opt.runs):
+        detections = detector.Detect(image)
+    elapsed = time.perf_counter() - start
+
+    for detection in detections:
+        print(detector.GetClassDesc(detection.ClassID), detection)
+    print('{:.1f} ms/frame ({:.1f} FPS)'.format(elapsed * 1000 / opt.runs, opt.runs / elapsed))
@@ -0,0 +1,192 @@
+#
+# bounded background job queue for slow side effects (HTTP uploads, push notifications)
+# so that the frame capture / detection loop never blocks on the network
+#
+import queue
+import threading
+import time
+
+# drop policies used when the queue is full
+DROP_NEWEST = 'drop-newest'  # reject the job being submitted
+DROP_OLDEST = 'drop-oldest'  # evict the oldest waiting job to make room
+BLOCK = 'block'              # wait (up to block_timeout) for room, then drop the new job
+
+DROP_POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+
+
+# A single unit of work waiting in the queue
+class Job:
+    def __init__(self, kind, fn, args, kwargs):
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.enqueued_at = time.monotonic()
+
+
+# Counters describing what the queue has done so far (per job kind and in total)
+class DispatchStats:
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        # latency is measured from submit() until the job finishes running
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.by_kind = {}
+
+    def as_dict(self):
+        completed = self.completed + self.failed
+        return {
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'max_depth': self.max_depth,
+            'latency_avg': self.latency_total / completed if completed else 0.0,
+            'latency_max': self.latency_max,
+            'by_kind': {kind: dict(counts) for kind, counts in self.by_kind.items()},
+        }
+
+
+class DispatchQueue:
+    def __init__(self, max_size=16, num_workers=1, drop_policy=DROP_OLDEST, block_timeout=0.05, name='dispatch'):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unsupported drop policy {drop_policy}, expected one of {DROP_POLICIES}")
+
+        self.drop_policy = drop_policy
+        self.block_timeout = block_timeout
+        self.stats = DispatchStats()
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._workers = []
+
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    # Number of jobs currently waiting to run
+    def depth(self):
+        return self._queue.qsize()
+
+    # Queue fn(*args, **kwargs) to run on a worker thread. Never blocks longer than block_timeout.
+    # Returns True if the job was accepted, False if it was dropped.
+    def submit(self, kind, fn, *args, **kwargs):
+        job = Job(kind, fn, args, kwargs)
+
+        with self._lock:
+            if self._closed:
+                self._count(kind, 'dropped')
+                return False
+            self._count(kind, 'submitted')
+
+        try:
+            if self.drop_policy == BLOCK:
+                self._queue.put(job, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(job)
+        except queue.Full:
+            if self.drop_policy != DROP_OLDEST or not self._evict_oldest_and_put(job):
+                self._drop(kind)
+                return False
+
+        with self._lock:
+            self.stats.max_depth = max(self.stats.max_depth, self._queue.qsize())
+        return True
+
+    # Stop accepting jobs and wait for the workers to finish.
+    # With drain=True every queued job is run first, otherwise waiting jobs are discarded.
+    def shutdown(self, drain=True, timeout=None):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+
+        if not drain:
+            while True:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._drop(job.kind)
+                self._queue.task_done()
+
+        # one sentinel per worker, placed after any remaining jobs
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for _ in self._workers:
+            try:
+                self._queue.put(None, timeout=self._remaining(deadline))
+            except queue.Full:
+                break
+
+        for worker in self._workers:
+            worker.join(self._remaining(deadline))
+
+    def _evict_oldest_and_put(self, job):
+        try:
+            oldest = self._queue.get_nowait()
+        except queue.Empty:
+            oldest = None
+
+        if oldest is not None:
+            self._queue.task_done()
+            self._drop(oldest.kind)
+
+        try:
+            self._queue.put_nowait(job)
+            return True
+        except queue.Full:
+            return False
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+
+            status = 'completed'
+            try:
+                job.fn(*job.args, **job.kwargs)
+            except Exception as exception_error:
+                status = 'failed'
+                print(f"{job.kind} job failed: {exception_error}")
+
+            latency = time.monotonic() - job.enqueued_at
+            with self._lock:
+                self._count(job.kind, status)
+                self.stats.latency_total += latency
+                self.stats.latency_max = max(self.stats.latency_max, latency)
+            self._queue.task_done()
+
+    def _drop(self, kind):
+        with self._lock:
+            self._count(kind, 'dropped')
+
+    # caller must hold self._lock
+    def _count(self, kind, field):
+        setattr(self.stats, field, getattr(self.stats, field) + 1)
+        counts = self.stats.by_kind.setdefault(
+            kind, {'submitted': 0, 'completed': 0, 'failed': 0, 'dropped': 0})
+        counts[field] += 1
+
+    @staticmethod
+    def _remaining(deadline):
+        if deadline is None:
+            return None
+        return max(0.0, deadline - time.monotonic())
+
+
+# Main function for testing during development
+if __name__ == '__main__':
+    dispatcher = DispatchQueue(max_size=4, num_workers=2)
+    for i in range(20):
+        dispatcher.submit('sleep', time.sleep, 0.1)
+    print('queue depth after burst: {:d}'.format(dispatcher.depth()))
+    dispatcher.shutdown(drain=True)
+    print(dispatcher.stats.as_dict())
@@ -0,0 +1,451 @@
+#
+# staged capture -> inference -> decision pipeline.
+#
+# Each stage runs on its own thread so the camera keeps capturing while the network runs.
+# Frames live in a fixed-size ring of preallocated buffers; the inference stage always takes
+# the newest captured frame and the decision stage the newest result ("latest frame wins"),
+# so stale frames are dropped instead of queueing up and latency stays bounded.
+#
+import argparse
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from detector import FakeDetector
+from metrics import METRICS
+
+
+# Fixed set of preallocated frame buffers shared by the stages.
+# A slot is pinned while a later stage is still using it so capture never overwrites it.
+class FrameRing:
+    def __init__(self, slots):
+        if len(slots) < 3:
+            raise ValueError("FrameRing needs at least 3 slots (capture, inference and decision)")
+        self.slots = slots
+        self.captured = 0
+        self.dropped = 0
+
+        self._seq = [0] * len(slots)
+        self._timestamps = [0.0] * len(slots)
+        self._pins = [0] * len(slots)
+        self._latest = None
+        self._taken_seq = 0
+        self._next = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    # Pick a slot for the next captured frame: never the newest published one or a pinned one
+    def acquire_write(self):
+        with self._condition:
+            while not self._closed:
+                for offset in range(len(self.slots)):
+                    index = (self._next + offset) % len(self.slots)
+                    if index != self._latest and not self._pins[index]:
+                        self._next = (index + 1) % len(self.slots)
+                        return index
+                self._condition.wait()
+            return None
+
+    # Make a captured frame available to the inference stage
+    def publish(self, index, timestamp):
+        with self._condition:
+            if self._latest is not None and self._seq[self._latest] > self._taken_seq:
+                # the previous frame was never picked up by the inference stage
+                self.dropped += 1
+            self.captured += 1
+            self._seq[index] = self.captured
+            self._timestamps[index] = timestamp
+            self._latest = index
+            self._condition.notify_all()
+
+    # Wait for a frame newer than the last one taken, pin it and return (index, seq, timestamp).
+    # Returns None once the ring is closed and drained (or on timeout).
+    def take_latest(self, timeout=None):
+        with self._condition:
+            # a frame published before the ring was closed is still handed out
+            while self._latest is None or self._seq[self._latest] <= self._taken_seq:
+                if self._closed or not self._condition.wait(timeout):
+                    return None
+            index = self._latest
+            self._taken_seq = self._seq[index]
+            self._pins[index] += 1
+            return index, self._seq[index], self._timestamps[index]
+
+    def release(self, index):
+        with self._condition:
+            self._pins[index] -= 1
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+# Single-item hand-off between two stages where a newer item replaces an unprocessed one
+class LatestMailbox:
+    def __init__(self):
+        self._item = None
+        self._closed = False
+        self._condition = threading.Condition()
+
+    # Returns the item that was replaced (never processed), or None
+    def put(self, item):
+        with self._condition:
+            replaced = self._item
+            self._item = item
+            self._condition.notify_all()
+            return replaced
+
+    def get(self, timeout=None):
+        with self._condition:
+            while self._item is None and not self._closed:
+                if not self._condition.wait(timeout):
+                    return None
+            item = self._item
+            self._item = None
+            return item
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+# Function that allocates ring slots for numpy based sources
+def alloc_numpy_slots(num_slots, height, width, channels=3):
+    return [np.zeros((height, width, channels), dtype=np.uint8) for _ in range(num_slots)]
+
+
+# Function that returns the given percentiles (in ms) of a list of latencies in seconds
+def latency_percentiles(latencies, percentiles=(50, 95, 99)):
+    if not latencies:
+        return {p: 0.0 for p in percentiles}
+    values = np.percentile(np.asarray(latencies), percentiles) * 1000
+    return {p: round(float(value), 2) for p, value in zip(percentiles, values)}
+
+
+class FramePipeline:
+    # source   - object with capture_into(slot) -> bool (False at end of stream)
+    # detect   - fn(slot) -> detections
+    # decide   - fn(slot, detections) run on the decision thread for every processed frame
+    # slots    - preallocated frame buffers (see alloc_numpy_slots)
+    # pace     - optional fn() -> bool run before each inference, blocks until the next frame is due
+    #            (the freshest frame is taken after it returns), returning False ends the run
+    def __init__(self, source, detect, decide, slots, pace=None):
+        self.source = source
+        self.detect = detect
+        self.decide = decide
+        self.pace = pace
+        self.ring = FrameRing(slots)
+
+        self.inferred = 0
+        self.decided = 0
+        self.decisions_dropped = 0
+        # capture -> decision done, per processed frame
+        self.latencies = []
+        self.error = None
+
+        self._mailbox = LatestMailbox()
+        self._stop_event = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._guard, args=(self._capture_stage,), name='capture', daemon=True),
+            threading.Thread(target=self._guard, args=(self._inference_stage,), name='inference', daemon=True),
+            threading.Thread(target=self._guard, args=(self._decision_stage,), name='decision', daemon=True),
+        ]
+        self._start_time = None
+        self._end_time = None
+
+    def start(self):
+        self._start_time = time.perf_counter()
+        for thread in self._threads:
+            thread.start()
+
+    # Stop all stages (frames still in flight are discarded)
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self.ring.close()
+        self._mailbox.close()
+        for thread in self._threads:
+            thread.join(timeout)
+        if self._end_time is None:
+            self._end_time = time.perf_counter()
+
+    # Block until the source runs out of frames (or timeout expires); returns True if it did
+    def wait(self, timeout=None):
+        self._threads[-1].join(timeout)
+        return not self._threads[-1].is_alive()
+
+    def is_running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def stats(self):
+        end_time = self._end_time or time.perf_counter()
+        elapsed = end_time - self._start_time if self._start_time else 0.0
+        return {
+            'captured': self.ring.captured,
+            'capture_dropped': self.ring.dropped,
+            'inferred': self.inferred,
+            'decided': self.decided,
+            'decisions_dropped': self.decisions_dropped,
+            'fps': round(self.decided / elapsed, 2) if elapsed else 0.0,
+            'latency_ms': latency_percentiles(self.latencies),
+        }
+
+    def _guard(self, stage):
+        try:
+            stage()
+        except Exception as exception_error:
+            self.error = exception_error
+            print("Pipeline stage {:s} failed: {}".format(threading.current_thread().name, exception_error))
+            self._stop_event.set()
+            self.ring.close()
+            self._mailbox.close()
+
+    def _capture_stage(self):
+        while not self._stop_event.is_set():
+            index = self.ring.acquire_write()
+            if index is None:
+                break
+            with METRICS.stage('capture'):
+                streaming = self.source.capture_into(self.ring.slots[index])
+            if not streaming:
+                break
+            self.ring.publish(index, time.perf_counter())
+        # end of stream: let the other stages finish what they have
+        self.ring.close()
+
+    def _inference_stage(self):
+        while not self._stop_event.is_set():
+            if self.pace is not None and not self.pace():
+                break
+            item = self.ring.take_latest()
+            if item is None:
+                break
+            index, seq, timestamp = item
+            detections = self.detect(self.ring.slots[index])
+            self.inferred += 1
+
+            replaced = self._mailbox.put((index, timestamp, detections))
+            if replaced is not None:
+                self.ring.release(replaced[0])
+                self.decisions_dropped += 1
+        self._mailbox.close()
+
+    def _decision_stage(self):
+        while not self._stop_event.is_set():
+            item = self._mailbox.get()
+            if item is None:
+                break
+            index, timestamp, detections = item
+            try:
+                self.decide(self.ring.slots[index], detections)
+            finally:
+                self.ring.release(index)
+            self.decided += 1
+            self.latencies.append(time.perf_counter() - timestamp)
+        self._end_time = time.perf_counter()
+
+
+# Base class for sources that emulate a camera's frame rate (fps=0 means as fast as possible)
+class PacedSource:
+    def __init__(self, fps=0):
+        self.fps = fps
+        self._next_time = None
+
+    def _pace(self):
+        if not self.fps:
+            return
+        now = time.perf_counter()
+        if self._next_time is None:
+            self._next_time = now
+        delay = self._next_time - now
+        if delay > 0:
+            time.sleep(delay)
+        self._next_time = max(now, self._next_time) + 1.0 / self.fps
+
+
+# Function that copies (and resizes if needed) an image into a preallocated slot
+def copy_into(image, slot):
+    if image.shape == slot.shape:
+        np.copyto(slot, image)
+    else:
+        cv2.resize(image, (slot.shape[1], slot.shape[0]), dst=slot)
+
+
+# Fake camera that plays back the images in a directory (sorted by name)
+class DirectoryVideoSource(PacedSource):
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+    def __init__(self, path, loop=False, max_frames=0, fps=0):
+        super().__init__(fps)
+        self.files = sorted(os.path.join(path, file) for file in os.listdir(path)
+                            if file.lower().endswith(self.IMAGE_EXTENSIONS))
+        if not self.files:
+            raise ValueError(f"No images found in {path}")
+        self.loop = loop
+        self.max_frames = max_frames
+        self.frames = 0
+        self._cache = {}
+
+    def capture_into(self, slot):
+        if self.max_frames and self.frames >= self.max_frames:
+            return False
+        if self.frames >= len(self.files) and not self.loop:
+            return False
+
+        file = self.files[self.frames % len(self.files)]
+        # decode each file once, repeated loops over a directory measure the pipeline, not JPEG decode
+        image = self._cache.get(file)
+        if image is None:
+            image = cv2.cvtColor(cv2.imread(file), cv2.COLOR_BGR2RGB)
+            self._cache[file] = image
+
+        self._pace()
+        copy_into(image, slot)
+        self.frames += 1
+        return True
+
+
+# Fake camera that plays back a video file
+class VideoFileSource(PacedSource):
+    def __init__(self, path, loop=False, max_frames=0, fps=0):
+        super().__init__(fps)
+        self.path = path
+        self.loop = loop
+        self.max_frames = max_frames
+        self.frames = 0
+        self._capture = cv2.VideoCapture(path)
+        if not self._capture.isOpened():
+            raise ValueError(f"Could not open video {path}")
+
+    def capture_into(self, slot):
+        if self.max_frames and self.frames >= self.max_frames:
+            return False
+
+        ok, image = self._capture.read()
+        if not ok and self.loop:
+            self._capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, image = self._capture.read()
+        if not ok:
+            return False
+
+        self._pace()
+        copy_into(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), slot)
+        self.frames += 1
+        return True
+
+
+# Fake camera producing a static noise background with a moving square ("bird")
+class SyntheticVideoSource(PacedSource):
+    def __init__(self, max_frames=300, fps=0, seed=0):
+        super().__init__(fps)
+        self.max_frames = max_frames
+        self.frames = 0
+        self._rng = np.random.default_rng(seed)
+        self._background = None
+
+    def capture_into(self, slot):
+        if self.max_frames and self.frames >= self.max_frames:
+            return False
+        if self._background is None or self._background.shape != slot.shape:
+            self._background = self._rng.integers(0, 255, size=slot.shape, dtype=np.uint8)
+
+        self._pace()
+        np.copyto(slot, self._background)
+        size = slot.shape[0] // 6
+        x = (self.frames * 8) % max(1, slot.shape[1] - size)
+        slot[size:2 * size, x:x + size] = 255
+        self.frames += 1
+        return True
+
+
+# Camera input for boxes without jetson.utils: same Capture()/IsStreaming() interface as
+# videoSource, backed by one of the sources above and a small set of reused frame buffers
+class SourceInput:
+    def __init__(self, source, height, width, num_buffers=4):
+        self.source = source
+        self.buffers = alloc_numpy_slots(num_buffers, height, width)
+        self._next = 0
+        self._streaming = True
+
+    def Capture(self):
+        buffer = self.buffers[self._next]
+        self._next = (self._next + 1) % len(self.buffers)
+        if self._streaming and not self.source.capture_into(buffer):
+            self._streaming = False
+        return buffer
+
+    def IsStreaming(self):
+        return self._streaming
+
+
+# Display output for headless boxes without jetson.utils (same interface as videoOutput)
+class NullOutput:
+    def Render(self, img):
+        pass
+
+    def SetStatus(self, title):
+        pass
+
+    def IsStreaming(self):
+        return True
+
+
+# Function that runs capture, inference and decision one after another (what the feeder did before)
+def run_sequential(source, detect, decide, slot):
+    latencies = []
+    start = time.perf_counter()
+    while source.capture_into(slot):
+        captured = time.perf_counter()
+        decide(slot, detect(slot))
+        latencies.append(time.perf_counter() - captured)
+    elapsed = time.perf_counter() - start
+    return {
+        'decided': len(latencies),
+        'fps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': latency_percentiles(latencies),
+    }
+
+
+# Function that creates a fake camera from a directory of images, a video file or 'synthetic'
+def create_source(uri, loop=True, max_frames=0, fps=0):
+    if uri == 'synthetic':
+        return SyntheticVideoSource(max_frames=max_frames, fps=fps)
+    if os.path.isdir(uri):
+        return DirectoryVideoSource(uri, loop=loop, max_frames=max_frames, fps=fps)
+    return VideoFileSource(uri, loop=loop, max_frames=max_frames, fps=fps)
+
+
+# Main function for benchmarking the pipeline on a plain CPU box
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark sequential vs pipelined frame processing with fake camera/detector.")
+    parser.add_argument("--source", type=str, default="synthetic",
+                        help="directory of images, a video file, or 'synthetic'")
+    parser.add_argument("--frames", type=int, default=300, help="number of frames to capture")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--camera-fps", type=float, default=30, help="emulated camera rate (0 = unthrottled)")
+    parser.add_argument("--inference-ms", type=float, default=25, help="emulated detector latency")
+    parser.add_argument("--decision-ms", type=float, default=5, help="emulated decision/render latency")
+    parser.add_argument("--slots", type=int, default=4, help="number of frames in the ring buffer")
+    opt = parser.parse_args()
+
+    detector = FakeDetector(latency=opt.inference_ms / 1000)
+
+    def decide(frame, detections):
+        time.sleep(opt.decision_ms / 1000)
+
+    sequential = run_sequential(create_source(opt.source, max_frames=opt.frames, fps=opt.camera_fps), detector.detect, decide,
+                                alloc_numpy_slots(1, opt.height, opt.width)[0])
+    print('sequential: {}'.format(sequential))
+
+    pipeline = FramePipeline(create_source(opt.source, max_frames=opt.frames, fps=opt.camera_fps), detector.detect, decide,
+                             alloc_numpy_slots(opt.slots, opt.height, opt.width))
+    pipeline.start()
+    pipeline.wait()
+    pipeline.stop()
+    print('pipelined:  {}'.format(pipeline.stats()))
@@ -0,0 +1,245 @@
+#
+# local archive of bird memories. Images are stored once per content hash under
+# <root>/objects/ and indexed in SQLite (time, species, confidence, box, upload status),
+# so memories can be re-synced after an outage and summarized without scanning image files.
+# Retention is by age and total size; past the size limit the least recently used images
+# (uploaded ones first) are evicted.
+#
+import collections
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+PENDING = 'pending'
+UPLOADED = 'uploaded'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS memories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sha256 TEXT NOT NULL REFERENCES images (sha256),
+    timestamp REAL NOT NULL,
+    species TEXT NOT NULL,
+    confidence REAL,
+    box_left REAL,
+    box_top REAL,
+    box_right REAL,
+    box_bottom REAL,
+    upload_status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS memories_species_time ON memories (species, timestamp);
+CREATE INDEX IF NOT EXISTS memories_time ON memories (timestamp);
+CREATE INDEX IF NOT EXISTS memories_status ON memories (upload_status);
+CREATE INDEX IF NOT EXISTS images_last_access ON images (last_access);
+'''
+
+Memory = collections.namedtuple('Memory', ['id', 'sha256', 'timestamp', 'species', 'confidence', 'box', 'upload_status'])
+
+# per species: number of memories, best confidence, first and last sighting
+SpeciesSummary = collections.namedtuple('SpeciesSummary', ['species', 'count', 'best_confidence', 'first', 'last'])
+
+MEMORY_COLUMNS = 'id, sha256, timestamp, species, confidence, box_left, box_top, box_right, box_bottom, upload_status'
+
+
+def _memory(row):
+    box = None if row[5] is None else tuple(row[5:9])
+    return Memory(row[0], row[1], row[2], row[3], row[4], box, row[9])
+
+
+class MemoryArchive:
+    # root - directory holding the images and the index
+    # max_bytes - total size of the archived images (0 = no limit)
+    # max_age - seconds a memory is kept (0 = forever)
+    def __init__(self, root='./captured-bird-images', max_bytes=512 * 1024 * 1024, max_age=30 * 24 * 3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, 'archive.sqlite3'), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def image_path(self, sha256):
+        return os.path.join(self.root, 'objects', sha256[:2], sha256 + '.jpeg')
+
+    # Archive an encoded memory, returns its id. Identical images are stored only once.
+    # box - (left, top, right, bottom) of the bird in frame pixels (or None)
+    def add(self, data, species, confidence=None, box=None, timestamp=None, upload_status=PENDING):
+        sha256 = hashlib.sha256(data).hexdigest()
+        timestamp = time.time() if timestamp is None else timestamp
+        box = tuple(box) if box is not None else (None, None, None, None)
+
+        path = self.image_path(sha256)
+        if not os.path.exists(path):
+            self._write(path, data)
+
+        # no upsert (ON CONFLICT ... DO UPDATE), the Jetson's SQLite 3.22 predates it
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO images (sha256, size, last_access) VALUES (?, ?, ?)',
+                             (sha256, len(data), now))
+            self._db.execute('UPDATE images SET last_access = ? WHERE sha256 = ?', (now, sha256))
+            cursor = self._db.execute(
+                'INSERT INTO memories (sha256, timestamp, species, confidence, box_left, box_top, box_right, '
+                'box_bottom, upload_status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (sha256, timestamp, species, confidence) + box + (upload_status,))
+            self._enforce_retention()
+            self._db.commit()
+            return cursor.lastrowid
+
+    # Returns the image bytes of a memory (and marks the image as recently used)
+    def read(self, memory_id):
+        with self._lock:
+            row = self._db.execute('SELECT sha256 FROM memories WHERE id = ?', (memory_id,)).fetchone()
+            if row is None:
+                raise KeyError(memory_id)
+            self._db.execute('UPDATE images SET last_access = ? WHERE sha256 = ?', (time.time(), row[0]))
+            self._db.commit()
+        with open(self.image_path(row[0]), 'rb') as img_file:
+            return img_file.read()
+
+    def set_status(self, memory_id, upload_status):
+        with self._lock:
+            self._db.execute('UPDATE memories SET upload_status = ? WHERE id = ?', (upload_status, memory_id))
+            self._db.commit()
+
+    def mark_uploaded(self, memory_id):
+        self.set_status(memory_id, UPLOADED)
+
+    def mark_failed(self, memory_id):
+        self.set_status(memory_id, FAILED)
+
+    def get(self, memory_id):
+        with self._lock:
+            row = self._db.execute('SELECT ' + MEMORY_COLUMNS + ' FROM memories WHERE id = ?',
+                                   (memory_id,)).fetchone()
+        return None if row is None else _memory(row)
+
+    # Memories matching all given filters, oldest first (start <= timestamp < end)
+    def query(self, species=None, start=None, end=None, upload_status=None, limit=None):
+        conditions, params = [], []
+        for column, operator, value in (('species', '=', species), ('timestamp', '>=', start),
+                                        ('timestamp', '<', end), ('upload_status', '=', upload_status)):
+            if value is not None:
+                conditions.append('{:s} {:s} ?'.format(column, operator))
+                params.append(value)
+        sql = 'SELECT ' + MEMORY_COLUMNS + ' FROM memories'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY timestamp, id'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self._lock:
+            return [_memory(row) for row in self._db.execute(sql, params).fetchall()]
+
+    # Memories that still have to be uploaded (e.g. after an outage)
+    def pending(self, limit=None):
+        memories = self.query(upload_status=PENDING, limit=limit) + self.query(upload_status=FAILED, limit=limit)
+        return sorted(memories, key=lambda memory: (memory.timestamp, memory.id))[:limit]
+
+    # Per species counts between start and end (e.g. one day), most seen species first
+    def species_summary(self, start=None, end=None):
+        sql = ('SELECT species, COUNT(*), MAX(confidence), MIN(timestamp), MAX(timestamp) FROM memories '
+               'WHERE timestamp >= ? AND timestamp < ? GROUP BY species ORDER BY COUNT(*) DESC, species')
+        with self._lock:
+            rows = self._db.execute(sql, (start if start is not None else float('-inf'),
+                                          end if end is not None else float('inf'))).fetchall()
+        return [SpeciesSummary(*row) for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM memories').fetchone()[0]
+
+    def total_bytes(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM images').fetchone()[0]
+
+    def enforce_retention(self, now=None):
+        with self._lock:
+            self._enforce_retention(now)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # caller must hold self._lock; drops expired memories, then least recently used images
+    # (uploaded ones before the ones still waiting for upload) until the archive fits in max_bytes
+    def _enforce_retention(self, now=None):
+        now = time.time() if now is None else now
+        if self.max_age:
+            self._db.execute('DELETE FROM memories WHERE timestamp < ?', (now - self.max_age,))
+            for (sha256,) in self._db.execute(
+                    'SELECT sha256 FROM images WHERE sha256 NOT IN (SELECT sha256 FROM memories)').fetchall():
+                self._delete_image(sha256)
+
+        if not self.max_bytes:
+            return
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM images').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        candidates = self._db.execute(
+            'SELECT images.sha256, images.size FROM images '
+            'LEFT JOIN memories ON memories.sha256 = images.sha256 AND memories.upload_status != ? '
+            'GROUP BY images.sha256 ORDER BY COUNT(memories.id) > 0, images.last_access',
+            (UPLOADED,)).fetchall()
+        for sha256, size in candidates:
+            if total <= self.max_bytes:
+                break
+            self._db.execute('DELETE FROM memories WHERE sha256 = ?', (sha256,))
+            self._delete_image(sha256)
+            total -= size
+
+    # caller must hold self._lock
+    def _delete_image(self, sha256):
+        self._db.execute('DELETE FROM images WHERE sha256 = ?', (sha256,))
+        try:
+            os.unlink(self.image_path(sha256))
+        except FileNotFoundError:
+            pass
+
+    # Function that writes a file atomically, so a reader never sees half an image
+    def _write(self, path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as img_file:
+                img_file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+# Main function for testing during development
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query the local bird memory archive.")
+    parser.add_argument("root", type=str, nargs='?', default='./captured-bird-images')
+    parser.add_argument("--species", type=str, default=None, help="only list memories of this species")
+    parser.add_argument("--days", type=float, default=1.0, help="summarize the last N days")
+    opt = parser.parse_args()
+
+    archive = MemoryArchive(opt.root, max_bytes=0, max_age=0)
+    start = time.time() - opt.days * 24 * 3600
+    print('{:d} memories, {:.1f} MB'.format(len(archive), archive.total_bytes() / 1e6))
+    for summary in archive.species_summary(start):
+        print('{:s}: {:d} (best {:.2f}, last {:s})'.format(
+            summary.species, summary.count, summary.best_confidence or 0.0, time.ctime(summary.last)))
+    for memory in archive.query(species=opt.species, start=start) if opt.species else []:
+        print(memory)
+    archive.close()
@@ -0,0 +1,70 @@
+#
+# in-memory JPEG encoding of bird memories: the (RGB) shot is optionally cropped and shrunk,
+# encoded straight into a byte buffer and handed to the uploader, nothing touches the SD card
+# unless the local archive (memory_archive.py) is enabled.
+#
+import cv2
+
+
+# Function that crops an RGB image to box = (left, top, right, bottom) plus a margin relative to the box size
+def crop_roi(img, box, margin=0.0):
+    height, width = img.shape[:2]
+    left, top, right, bottom = box
+    margin_x = int((right - left) * margin)
+    margin_y = int((bottom - top) * margin)
+    return img[max(0, int(top) - margin_y):min(height, int(bottom) + margin_y),
+               max(0, int(left) - margin_x):min(width, int(right) + margin_x)]
+
+
+# Function that shrinks an image so its longer side is at most max_size pixels (0 = keep the size)
+def limit_size(img, max_size=0):
+    height, width = img.shape[:2]
+    if not max_size or max(height, width) <= max_size:
+        return img
+    scale = max_size / float(max(height, width))
+    return cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+# Function that encodes an RGB image as JPEG bytes (the channel swap is done on the resized image)
+def encode_jpeg(img, quality=90, box=None, margin=0.0, max_size=0):
+    if box is not None:
+        img = crop_roi(img, box, margin)
+    img = limit_size(img[..., :3], max_size)
+    ok, buffer = cv2.imencode('.jpg', cv2.cvtColor(img, cv2.COLOR_RGB2BGR),
+                              [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return buffer.tobytes()
+
+
+class MemoryEncoder:
+    # quality - JPEG quality (0-100)
+    # max_size - longer side of the encoded image in pixels (0 = keep the size of the shot)
+    def __init__(self, quality=90, max_size=0):
+        self.quality = quality
+        self.max_size = max_size
+
+    def encode(self, img):
+        return encode_jpeg(img, self.quality, max_size=self.max_size)
+
+
+# Main function for testing during development
+if __name__ == '__main__':
+    import time
+
+    import numpy as np
+
+    frame = np.random.default_rng(0).integers(0, 255, size=(720, 1280, 3), dtype=np.uint8)
+    frame = cv2.GaussianBlur(frame, (9, 9), 3)
+
+    for quality, max_size in [(95, 0), (90, 0), (80, 0), (90, 640)]:
+        start = time.perf_counter()
+        data = encode_jpeg(frame, quality, max_size=max_size)
+        elapsed = time.perf_counter() - start
+        print('quality {:d}, max size {:d}: {:d} KB in {:.1f} ms'.format(
+            quality, max_size, len(data) // 1024, elapsed * 1000))
+
+    decoded = cv2.cvtColor(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    print('round trip', decoded.shape, 'mean abs error {:.1f}'.format(
+        np.abs(decoded.astype(int) - limit_size(frame, 640).astype(int)).mean()))
@@ -0,0 +1,273 @@
+#
+# low-overhead metrics for the feeder's hot path: per-stage timings (capture, inference,
+# postprocess, decision, serial_write, upload, push) go into fixed-bucket histograms (one
+# bisect and a few additions per observation, no allocation), events into counters, and
+# queue depths / link statistics are read from callbacks only when exported.
+# Everything is exported as Prometheus text (MetricsServer, GET /metrics) or as periodic
+# JSON lines (JsonLineLogger).
+#
+# Modules record into the shared METRICS registry, e.g.
+#     with METRICS.stage('inference'):
+#         detections = net.Detect(img)
+#     METRICS.inc('frames_processed')
+#
+import bisect
+import http.server
+import json
+import socketserver
+import threading
+import time
+
+# upper bounds of the stage timing buckets in seconds (an implicit +Inf bucket follows)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(buckets)
+        # counts[i] - observations in (bounds[i - 1], bounds[i]], the last one is the +Inf bucket
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    # callers serialize observations through the registry's lock
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # Estimates the q-quantile (0-1) by linear interpolation inside its bucket
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / bucket_count)
+            seen += bucket_count
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+
+class _StageTimer:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    # prefix - prepended to every exported metric name
+    def __init__(self, prefix='feeder', buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        # name -> (kind, help, fn) of the values that are only read when exporting
+        self.callbacks = {}
+        self._lock = threading.Lock()
+
+    # Context manager that records the time spent in a stage
+    def stage(self, name):
+        return _StageTimer(self, name)
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Register a value read at export time, e.g. a queue depth (kind 'gauge') or a counter kept
+    # by another object (kind 'counter', like the UART link's byte counts)
+    def register(self, name, fn, kind='gauge', help=''):
+        self.callbacks[name] = (kind, help, fn)
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+        self.started = time.time()
+
+    def as_dict(self):
+        with self._lock:
+            stages = {name: histogram.as_dict() for name, histogram in self.stages.items()}
+            counters = dict(self.counters)
+        values = {name: _read(fn) for name, (kind, help, fn) in list(self.callbacks.items())}
+        return {'time': time.time(), 'uptime': time.time() - self.started,
+                'stages': stages, 'counters': counters, 'values': values}
+
+    # Prometheus text exposition format (version 0.0.4)
+    def prometheus_text(self):
+        with self._lock:
+            stages = [(name, list(histogram.counts), histogram.count, histogram.sum)
+                      for name, histogram in sorted(self.stages.items())]
+            counters = sorted(self.counters.items())
+
+        lines = []
+        name = self.prefix + '_stage_seconds'
+        lines.append('# HELP {:s} Time spent in each stage of the feeder loop.'.format(name))
+        lines.append('# TYPE {:s} histogram'.format(name))
+        for stage, counts, count, total in stages:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{:s}_bucket{{stage="{:s}",le="{:s}"}} {:d}'.format(name, stage, le, cumulative))
+            lines.append('{:s}_sum{{stage="{:s}"}} {!r}'.format(name, stage, total))
+            lines.append('{:s}_count{{stage="{:s}"}} {:d}'.format(name, stage, count))
+
+        for counter, value in counters:
+            name = '{:s}_{:s}_total'.format(self.prefix, counter)
+            lines.append('# TYPE {:s} counter'.format(name))
+            lines.append('{:s} {!r}'.format(name, value))
+
+        for callback, (kind, help, fn) in sorted(self.callbacks.items()):
+            name = '{:s}_{:s}{:s}'.format(self.prefix, callback, '_total' if kind == 'counter' else '')
+            if help:
+                lines.append('# HELP {:s} {:s}'.format(name, help))
+            lines.append('# TYPE {:s} {:s}'.format(name, kind))
+            lines.append('{:s} {!r}'.format(name, _read(fn)))
+        return '\n'.join(lines) + '\n'
+
+    def json_line(self):
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+
+# Function that reads a callback value, a failing callback must not break the export
+def _read(fn):
+    try:
+        return float(fn())
+    except Exception:
+        return float('nan')
+
+
+# shared registry the feeder's modules record into
+METRICS = Metrics()
+
+
+# HTTP server handling every request on its own daemon thread
+# (http.server.ThreadingHTTPServer is Python 3.7+, the Jetson's Ubuntu 18.04 ships 3.6)
+class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+# Serves GET /metrics in the Prometheus text format from a background thread
+class MetricsServer(threading.Thread):
+    def __init__(self, metrics=METRICS, host='0.0.0.0', port=9108):
+        super().__init__(name='metrics-server', daemon=True)
+        registry = metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # scrapes are not worth a line on the console
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadedHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+
+    def run(self):
+        self.server.serve_forever(poll_interval=0.5)
+
+    def stop(self, timeout=None):
+        self.server.shutdown()
+        self.server.server_close()
+        self.join(timeout)
+
+
+# Appends one JSON line with all metrics to a file every interval seconds ('-' = stdout)
+class JsonLineLogger(threading.Thread):
+    def __init__(self, path, metrics=METRICS, interval=60.0):
+        super().__init__(name='metrics-logger', daemon=True)
+        self.path = path
+        self.metrics = metrics
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.write()
+
+    def write(self):
+        line = self.metrics.json_line()
+        if self.path == '-':
+            print(line)
+            return
+        with open(self.path, 'a') as log_file:
+            log_file.write(line + '\n')
+
+    # the last interval is written on stop, so short runs still leave a record
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self.join(timeout)
+        self.write()
+
+
+# Main function for testing during development
+if __name__ == '__main__':
+    import random
+    import urllib.request
+
+    metrics = Metrics()
+    rng = random.Random(0)
+    queue_depth = [3]
+    metrics.register('dispatch_queue_depth', lambda: queue_depth[0], help='Jobs waiting in the dispatch queue.')
+
+    runs = 100000
+    start = time.perf_counter()
+    for _ in range(runs):
+        metrics.observe('inference', rng.lognormvariate(-3.5, 0.3))
+        metrics.inc('frames_processed')
+    elapsed = time.perf_counter() - start
+    print('{:.2f} us per observation + increment'.format(elapsed * 1e6 / runs))
+    with metrics.stage('decision'):
+        time.sleep(0.002)
+
+    server = MetricsServer(metrics, host='127.0.0.1', port=0)
+    server.start()
+    with urllib.request.urlopen('http://127.0.0.1:{:d}/metrics'.format(server.port)) as response:
+        text = response.read().decode()
+    server.stop(timeout=1)
+    print('\n'.join(line for line in text.splitlines() if 'bucket' not in line))
+    print(json.dumps(metrics.as_dict()['stages'], indent=1))
@@ -0,0 +1,90 @@
+#
+# cheap pre-filter that decides per frame whether the object detection DNN needs to run.
+# Frames are downscaled by striding, compared against a running-average background and
+# only passed to the detector when enough pixels changed (or a keyframe is due).
+#
+import numpy as np
+
+
+class MotionGate:
+    # scale - keep every Nth pixel in both directions before comparing
+    # pixel_threshold - change in brightness (0-255) for a pixel to count as changed
+    # min_changed_fraction - fraction of changed pixels needed to run the detector
+    # keyframe_interval - run the detector at least every N frames regardless of motion
+    # learning_rate - how quickly the background model follows the scene (0-1)
+    def __init__(self, scale=8, pixel_threshold=15, min_changed_fraction=0.005,
+                 keyframe_interval=15, learning_rate=0.05):
+        self.scale = scale
+        self.pixel_threshold = pixel_threshold
+        self.min_changed_fraction = min_changed_fraction
+        self.keyframe_interval = keyframe_interval
+        self.learning_rate = learning_rate
+
+        self.frames = 0
+        self.skipped = 0
+        self.last_changed_fraction = 0.0
+
+        self._background = None
+        self._gray = None
+        self._diff = None
+        self._frames_since_detect = 0
+
+    # Returns True if the detector should run on this frame (HxWxC uint8/float array)
+    def should_detect(self, frame):
+        self.frames += 1
+        small = frame[::self.scale, ::self.scale, :3]
+
+        # channel sum instead of a weighted grayscale conversion, so thresholds are scaled by 3
+        if self._background is None or self._background.shape != small.shape[:2]:
+            self._gray = np.empty(small.shape[:2], dtype=np.float32)
+            self._diff = np.empty_like(self._gray)
+            np.sum(small, axis=2, dtype=np.float32, out=self._gray)
+            self._background = self._gray.copy()
+            return self._detect()
+
+        np.sum(small, axis=2, dtype=np.float32, out=self._gray)
+        np.subtract(self._gray, self._background, out=self._diff)
+
+        # update the running-average background with the signed difference
+        self._background += self.learning_rate * self._diff
+
+        np.abs(self._diff, out=self._diff)
+        changed = np.count_nonzero(self._diff > self.pixel_threshold * 3)
+        self.last_changed_fraction = changed / self._diff.size
+
+        if self.last_changed_fraction >= self.min_changed_fraction:
+            return self._detect()
+
+        # guaranteed periodic inference, e.g. for a bird sitting perfectly still
+        if self._frames_since_detect + 1 >= self.keyframe_interval:
+            return self._detect()
+
+        self._frames_since_detect += 1
+        self.skipped += 1
+        return False
+
+    def reset(self):
+        self._background = None
+        self._frames_since_detect = 0
+
+    def _detect(self):
+        self._frames_since_detect = 0
+        return True
+
+
+# Main function for testing during development
+if __name__ == '__main__':
+    import time
+
+    gate = MotionGate()
+    rng = np.random.default_rng(0)
+    scene = rng.integers(0, 255, size=(720, 1280, 3), dtype=np.uint8)
+
+    start = time.perf_counter()
+    for i in range(300):
+        frame = scene.copy() if i % 50 else rng.integers(0, 255, size=scene.shape, dtype=np.uint8)
+        gate.should_detect(frame)
+    elapsed = time.perf_counter() - start
+
+    print('frames: {:d}, skipped: {:d}, {:.3f} ms/frame'.format(
+        gate.frames, gate.skipped, elapsed * 1000 / gate.frames))
@@ -0,0 +1,155 @@
+#
+# shared notifier for the feeder: one pooled keep-alive HTTP session for bird memory uploads
+# and one for Expo push delivery, with all tokens sent in a single batched push request
+#
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from exponent_server_sdk import (
+    DeviceNotRegisteredError,
+    PushClient,
+    PushMessage,
+    PushServerError,
+    PushTicketError,
+)
+import rollbar
+
+from metrics import METRICS
+from send_img import BIRD_MEMORY_URL, post_bird_memory
+
+# headers the Expo push API expects (PushClient only sets these on sessions it creates itself)
+EXPO_HEADERS = {
+    'accept': 'application/json',
+    'accept-encoding': 'gzip, deflate',
+    'content-type': 'application/json',
+}
+
+
+# Function that creates a requests session whose connections are kept alive and reused
+def create_session(pool_size=4, headers=None):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+class Notifier:
+    # push_host / memory_url / the sessions can be swapped out to point the notifier
+    # at a local stand-in HTTP server during testing
+    # rate_limiter - optional rate_limit.KeyedRateLimiter, tokens over their limit are skipped
+    def __init__(self, tokens, push_host=None, memory_url=BIRD_MEMORY_URL,
+                 push_session=None, upload_session=None, timeout=10, pool_size=4, rate_limiter=None):
+        # read and changed by every dispatch/outbox thread, only touch it while holding _tokens_lock
+        self.tokens = list(tokens)
+        self._tokens_lock = threading.Lock()
+        self.rate_limiter = rate_limiter
+        self.memory_url = memory_url
+        self.timeout = timeout
+
+        self.push_session = push_session or create_session(pool_size, EXPO_HEADERS)
+        # uploads are multipart, so they can't share the JSON content-type header of the push session
+        self.upload_session = upload_session or create_session(pool_size)
+        self.push_client = PushClient(host=push_host, session=self.push_session, timeout=timeout)
+
+    # Returns the active tokens that may receive a notification now. Each call takes one of their
+    # rate limiter tokens, so it is made once per notification, not once per delivery attempt.
+    def admit(self, title=''):
+        active = self.active_tokens()
+        tokens = active
+        if self.rate_limiter is not None:
+            tokens = [token for token in active if self.rate_limiter.allow(token)]
+            if len(tokens) < len(active):
+                print('push notification rate limited for {:d} token(s): {:s}'.format(
+                    len(active) - len(tokens), title))
+                METRICS.inc('push_rate_limited', len(active) - len(tokens))
+        return tokens
+
+    # Returns a copy of the tokens that are currently registered
+    def active_tokens(self):
+        with self._tokens_lock:
+            return list(self.tokens)
+
+    # Send one push notification to every active token using a single batched request.
+    # tokens - the tokens admit() returned for this notification (a retry passes them again and
+    #          is not charged again), None to admit the tokens now
+    def notify(self, title, message, extra=None, tokens=None):
+        if tokens is None:
+            tokens = self.admit(title)
+        else:
+            # tokens unregistered since the first attempt are skipped
+            with self._tokens_lock:
+                tokens = [token for token in tokens if token in self.tokens]
+        if not tokens:
+            return []
+
+        messages = [PushMessage(to=token,
+                                data=extra,
+                                title=title,
+                                body=message,
+                                sound='default',
+                                badge=1
+                                ) for token in tokens]
+        try:
+            with METRICS.stage('push'):
+                responses = self.push_client.publish_multiple(messages)
+        except PushServerError as exc:
+            print('exception PushServerError')
+            # Encountered some likely formatting/validation error.
+            rollbar.report_exc_info(
+                extra_data={
+                    'tokens': tokens,
+                    'message': message,
+                    'extra': extra,
+                    'errors': exc.errors,
+                    'response_data': exc.response_data,
+                })
+            raise
+
+        for response in responses:
+            self._validate(response, message, extra)
+        return responses
+
+    # Upload the bird memory image over the pooled upload session.
+    # Raises requests' HTTPError on an error status so the upload can be retried.
+    def post_bird_memory(self, species_name, img_data=None):
+        with METRICS.stage('upload'):
+            response = post_bird_memory(species_name, session=self.upload_session,
+                                        url=self.memory_url, timeout=self.timeout, img_data=img_data)
+        response.raise_for_status()
+        return response
+
+    # Stop sending to a token, e.g. once its device has been unregistered
+    def remove_token(self, token):
+        with self._tokens_lock:
+            try:
+                self.tokens.remove(token)
+            except ValueError:
+                pass
+
+    def close(self):
+        self.push_session.close()
+        self.upload_session.close()
+
+    def _validate(self, response, message, extra):
+        token = response.push_message.to
+        try:
+            # We got a response back, but we don't know whether it's an error yet.
+            response.validate_response()
+        except DeviceNotRegisteredError:
+            print('exception DeviceNotRegisteredError')
+            # stop sending to tokens whose device has been unregistered
+            self.remove_token(token)
+        except PushTicketError as exc:
+            print('exception PushTicketError')
+            # Encountered some other per-notification error.
+            rollbar.report_exc_info(
+                extra_data={
+                    'token': token,
+                    'message': message,
+                    'extra': extra,
+                    'push_response': exc.push_response._asdict(),
+                })
@@ -1,12 +1,16 @@
 #
 # converts a saved PyTorch model to ONNX format
+# (optionally with dynamic axes, fused NMS, FP16/INT8 variants and a parity/latency check)
 #
 import os
 import sys
 import argparse
 
+import numpy as np
 import torch.onnx
 
+import onnx_tools
+
 from vision.ssd.vgg_ssd import create_vgg_ssd
 from vision.ssd.mobilenetv1_ssd import create_mobilenetv1_ssd
 from vision.ssd.mobilenetv1_ssd_lite import create_mobilenetv1_ssd_lite
@@ -30,12 +34,54 @@ parser.add_argument('--height', type=int, default=300,
                     help="input height of the model to be exported (in pixels)")
 parser.add_argument('--batch-size', type=int, default=1,
                     help="batch size of the model to be exported (default=1)")
+parser.add_argument('--opset', type=int, default=11,
+                    help="ONNX opset version to export with (default=11)")
+parser.add_argument('--dynamic-batch', action='store_true',
+                    help="export with a dynamic batch axis (the default fixed batch is what TensorRT/detectNet expects)")
+parser.add_argument('--dynamic-size', action='store_true',
+                    help="export with dynamic height/width axes (needs --raw-outputs, the priors baked into the decoded model only fit one resolution)")
+parser.add_argument('--raw-outputs', action='store_true',
+                    help="export the raw confidences/locations instead of softmaxed scores and decoded boxes")
+parser.add_argument('--fuse-nms', action='store_true',
+                    help="append NonMaxSuppression to the graph, adding a 'selected_indices' output")
+parser.add_argument('--nms-iou-threshold', type=float, default=0.45,
+                    help="IoU threshold of the fused NMS")
+parser.add_argument('--nms-score-threshold', type=float, default=0.3,
+                    help="minimum score of boxes kept by the fused NMS (the detector applies its own threshold on top)")
+parser.add_argument('--nms-top-k', type=int, default=100,
+                    help="maximum boxes per class kept by the fused NMS")
+parser.add_argument('--simplify', action='store_true',
+                    help="fold constants and remove redundant nodes (onnx-simplifier if installed, else onnxruntime)")
+parser.add_argument('--fp16', action='store_true',
+                    help="also write a float16 model (<OUTPUT>.fp16.onnx, needs onnxconverter-common)")
+parser.add_argument('--int8', action='store_true',
+                    help="also write an INT8 quantized model (<OUTPUT>.int8.onnx), calibrated on --calibration-data")
+parser.add_argument('--calibration-data', type=str, default='',
+                    help="dataset directory with the images used for INT8 calibration (e.g. the training data)")
+parser.add_argument('--calibration-images', type=int, default=100,
+                    help="number of images used for INT8 calibration")
+parser.add_argument('--verify', action='store_true',
+                    help="compare the exported models against PyTorch on the CPU and measure their latency")
+parser.add_argument('--verify-runs', type=int, default=20,
+                    help="number of timed runs per model when verifying")
 parser.add_argument('--model-dir', type=str, default='',
                     help="directory to look for the input PyTorch model in, and export the converted ONNX model to (if --output doesn't specify a directory)")
 
 args = parser.parse_args()
 print(args)
 
+if args.dynamic_size and not args.raw_outputs:
+    print("--dynamic-size needs --raw-outputs (the decoded boxes depend on the input resolution)")
+    sys.exit(1)
+
+if args.fuse_nms and args.raw_outputs:
+    print("--fuse-nms needs the decoded scores/boxes, it can't be combined with --raw-outputs")
+    sys.exit(1)
+
+if args.int8 and not args.calibration_data:
+    print("--int8 needs --calibration-data to calibrate the activation ranges")
+    sys.exit(1)
+
 # set the device
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 print('running on device ' + str(device))
@@ -75,16 +121,18 @@ num_classes = len(class_names)
 print('creating network:  ' + args.net)
 print('num classes:       ' + str(num_classes))
 
+is_test = not args.raw_outputs
+
 if args.net == 'vgg16-ssd':
-    net = create_vgg_ssd(len(class_names), is_test=True)
+    net = create_vgg_ssd(len(class_names), is_test=is_test)
 elif args.net == 'mb1-ssd' or args.net == 'ssd-mobilenet':
-    net = create_mobilenetv1_ssd(len(class_names), is_test=True)
+    net = create_mobilenetv1_ssd(len(class_names), is_test=is_test)
 elif args.net == 'mb1-ssd-lite':
-    net = create_mobilenetv1_ssd_lite(len(class_names), is_test=True)
+    net = create_mobilenetv1_ssd_lite(len(class_names), is_test=is_test)
 elif args.net == 'mb2-ssd-lite':
-    net = create_mobilenetv2_ssd_lite(len(class_names), is_test=True)
+    net = create_mobilenetv2_ssd_lite(len(class_names), is_test=is_test)
 elif args.net == 'sq-ssd-lite':
-    net = create_squeezenet_ssd_lite(len(class_names), is_test=True)
+    net = create_squeezenet_ssd_lite(len(class_names), is_test=is_test)
 else:
     print("The net type is wrong. It should be one of vgg16-ssd, mb1-ssd and mb1-ssd-lite.")
     sys.exit(1)
@@ -96,8 +144,20 @@ net.load(args.input)
 net.to(device)
 net.eval()
 
+
+# Function that moves the network to a device, including the priors a test-mode SSD
+# decodes against (those are created on the GPU whenever one is available)
+def move_net(net, device):
+    net.to(device)
+    if getattr(net, 'priors', None) is not None:
+        net.priors = net.priors.to(device)
+        net.device = device
+
+
+move_net(net, device)
+
 # create example image data
-dummy_input = torch.randn(args.batch_size, 3, args.height, args.width).cuda()
+dummy_input = torch.randn(args.batch_size, 3, args.height, args.width).to(device)
 
 # format output model path
 if not args.output:
@@ -110,8 +170,67 @@ if args.model_dir and args.output.find('/') == -1 and args.output.find('\\') ==
 input_names = ['input_0']
 output_names = ['scores', 'boxes']
 
+dynamic_axes = {}
+if args.dynamic_batch or args.dynamic_size:
+    input_axes = {0: 'batch'} if args.dynamic_batch else {}
+    if args.dynamic_size:
+        input_axes.update({2: 'height', 3: 'width'})
+    output_axes = {0: 'batch'} if args.dynamic_batch else {}
+    if args.dynamic_size:
+        output_axes[1] = 'priors'
+    dynamic_axes = {'input_0': input_axes, 'scores': output_axes, 'boxes': output_axes}
+
 print('exporting model to ONNX...')
-torch.onnx.export(net, dummy_input, args.output, verbose=True,
+torch.onnx.export(net, dummy_input, args.output, verbose=False, opset_version=args.opset,
+                  do_constant_folding=True, dynamic_axes=dynamic_axes or None,
                   input_names=input_names, output_names=output_names)
-print('model exported to:  {:s}'.format(args.output))
+
+if args.simplify:
+    onnx_tools.simplify_model(args.output, args.output)
+    print('model simplified')
+
+output_base = args.output[:-len('.onnx')] if args.output.endswith('.onnx') else args.output
+exported = [args.output]
+
+if args.fp16:
+    exported.append(onnx_tools.convert_fp16(args.output, output_base + '.fp16.onnx'))
+
+if args.int8:
+    calibration_paths = onnx_tools.find_calibration_images(args.calibration_data, args.calibration_images)
+    print('calibrating INT8 model on {:d} images from {:s}'.format(len(calibration_paths), args.calibration_data))
+    exported.append(onnx_tools.quantize_int8(args.output, output_base + '.int8.onnx', calibration_paths,
+                                             width=args.width, height=args.height))
+
+# NMS is appended last, so the FP16/INT8 conversions only ever see the network itself
+if args.fuse_nms:
+    for path in exported:
+        onnx_tools.fuse_nms(path, path, args.nms_iou_threshold, args.nms_score_threshold, args.nms_top_k)
+
+for path in exported:
+    print('model exported to:  {:s}'.format(path))
+
+# compare every exported model against the PyTorch model on the CPU
+if args.verify:
+    move_net(net, torch.device('cpu'))
+    torch.set_grad_enabled(False)
+
+    batch_size = 1 if args.dynamic_batch else args.batch_size
+    inputs = []
+    if args.calibration_data:
+        images = list(onnx_tools.load_images(
+            onnx_tools.find_calibration_images(args.calibration_data, 8 * batch_size), args.width, args.height))
+        inputs = [np.concatenate(images[i:i + batch_size])
+                  for i in range(0, len(images) - batch_size + 1, batch_size)]
+    if not inputs:
+        inputs = [np.random.randn(batch_size, 3, args.height, args.width).astype(np.float32) for _ in range(4)]
+
+    reference = [[output.numpy() for output in net(torch.from_numpy(img))] for img in inputs]
+    torch_latency = onnx_tools.measure_latency(lambda: net(torch.from_numpy(inputs[0])), args.verify_runs)
+    print('pytorch (cpu): {:.2f} ms'.format(torch_latency))
+
+    for path in exported:
+        result = onnx_tools.verify_model(path, inputs, reference, args.verify_runs)
+        if path == args.output and max(result['max_diff_scores'], result['max_diff_boxes']) > 1e-3:
+            print('WARNING: {:s} does not match the PyTorch model'.format(path))
+
 print('task done, exiting program')
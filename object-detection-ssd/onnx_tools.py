@@ -0,0 +1,190 @@
+#
+# post-export tools for the SSD ONNX models: graph simplification, fused NMS,
+# FP16 conversion, INT8 calibration/quantization and parity/latency checks.
+# Works on the .onnx files alone (onnx + onnxruntime), so it runs without PyTorch.
+#
+import os
+import time
+
+import cv2
+import numpy as np
+import onnx
+from onnx import TensorProto, helper
+
+import ssd_postprocess
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+# Function that folds constants and removes redundant nodes. Uses onnx-simplifier if it is
+# installed, otherwise onnxruntime's hardware-independent (basic) graph optimizations.
+def simplify_model(input_path, output_path):
+    try:
+        import onnxsim
+    except ImportError:
+        onnxsim = None
+
+    if onnxsim is not None:
+        model, check_ok = onnxsim.simplify(onnx.load(input_path))
+        if not check_ok:
+            raise RuntimeError("onnx-simplifier could not validate the simplified model")
+        onnx.save(model, output_path)
+        return output_path
+
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC
+    options.optimized_model_filepath = output_path
+    onnxruntime.InferenceSession(input_path, options, providers=['CPUExecutionProvider'])
+    return output_path
+
+
+# Function that appends a NonMaxSuppression node to a model with 'scores' [B,N,C] and
+# 'boxes' [B,N,4] outputs. The extra 'selected_indices' output holds one (image, label, prior)
+# row per kept box; the background class is never selected.
+def fuse_nms(input_path, output_path, iou_threshold=0.45, score_threshold=0.3, top_k=100):
+    model = onnx.load(input_path)
+    graph = model.graph
+    output_names = [output.name for output in graph.output]
+    if output_names[:2] != ['scores', 'boxes']:
+        raise ValueError(f"Expected 'scores' and 'boxes' outputs, got {output_names}")
+
+    def constant(name, values, data_type):
+        return helper.make_tensor(name, data_type, [len(values)], values)
+
+    graph.initializer.extend([
+        constant('nms_class_start', [1], TensorProto.INT64),
+        constant('nms_class_end', [2 ** 62], TensorProto.INT64),
+        constant('nms_class_axis', [2], TensorProto.INT64),
+        constant('nms_top_k', [top_k], TensorProto.INT64),
+        constant('nms_iou_threshold', [iou_threshold], TensorProto.FLOAT),
+        constant('nms_score_threshold', [score_threshold], TensorProto.FLOAT),
+        constant('nms_label_offset', [0, 1, 0], TensorProto.INT64),
+    ])
+
+    # NonMaxSuppression wants scores as [B,C,N]; IoU does not care that our corners are (x, y)
+    # rather than the (y, x) the operator documents
+    graph.node.extend([
+        helper.make_node('Slice', ['scores', 'nms_class_start', 'nms_class_end', 'nms_class_axis'],
+                         ['nms_class_scores']),
+        helper.make_node('Transpose', ['nms_class_scores'], ['nms_scores'], perm=[0, 2, 1]),
+        helper.make_node('NonMaxSuppression',
+                         ['boxes', 'nms_scores', 'nms_top_k', 'nms_iou_threshold', 'nms_score_threshold'],
+                         ['nms_indices']),
+        helper.make_node('Add', ['nms_indices', 'nms_label_offset'], ['selected_indices']),
+    ])
+    graph.output.append(helper.make_tensor_value_info('selected_indices', TensorProto.INT64, [None, 3]))
+
+    onnx.checker.check_model(model)
+    onnx.save(model, output_path)
+    return output_path
+
+
+# Function that converts the weights and activations to float16, keeping float32 inputs/outputs
+def convert_fp16(input_path, output_path):
+    try:
+        from onnxconverter_common import float16
+    except ImportError:
+        raise ImportError("FP16 conversion needs the onnxconverter-common package (pip3 install onnxconverter-common)")
+
+    model = float16.convert_float_to_float16(onnx.load(input_path), keep_io_types=True)
+    onnx.save(model, output_path)
+    return output_path
+
+
+# Function that picks up to limit images from a training dataset directory, spread evenly
+# over the (sorted) files. Uses the 'train' split of an open_images dataset if there is one.
+def find_calibration_images(dataset_dir, limit=100):
+    dataset_dir = os.path.expanduser(dataset_dir)
+    if os.path.isdir(os.path.join(dataset_dir, 'train')):
+        dataset_dir = os.path.join(dataset_dir, 'train')
+
+    paths = []
+    for root, _, files in os.walk(dataset_dir):
+        paths.extend(os.path.join(root, name) for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+    paths.sort()
+
+    if limit and len(paths) > limit:
+        paths = [paths[i] for i in np.linspace(0, len(paths) - 1, limit).astype(int)]
+    return paths
+
+
+# Function that loads images and turns them into network inputs (same preprocessing as training/inference)
+def load_images(paths, width=ssd_postprocess.IMAGE_SIZE, height=ssd_postprocess.IMAGE_SIZE):
+    for path in paths:
+        img = cv2.imread(path)
+        if img is None:
+            print("Skipping unreadable image " + path)
+            continue
+        yield ssd_postprocess.preprocess_image(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), width, height)
+
+
+# Function that quantizes a model to INT8 (static, QDQ format), calibrated on the given images
+def quantize_int8(input_path, output_path, calibration_paths, width=ssd_postprocess.IMAGE_SIZE,
+                  height=ssd_postprocess.IMAGE_SIZE, per_channel=True):
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    if not calibration_paths:
+        raise ValueError("INT8 quantization needs at least one calibration image")
+
+    input_name = onnx.load(input_path).graph.input[0].name
+
+    class ImageReader(CalibrationDataReader):
+        def __init__(self):
+            self.images = load_images(calibration_paths, width, height)
+
+        def get_next(self):
+            img = next(self.images, None)
+            return None if img is None else {input_name: img}
+
+    quantize_static(input_path, output_path, ImageReader(), quant_format=QuantFormat.QDQ,
+                    per_channel=per_channel, activation_type=QuantType.QInt8, weight_type=QuantType.QInt8)
+    return output_path
+
+
+def create_session(path, num_threads=0):
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+# Function that returns the largest absolute difference of every output against the reference outputs
+def max_abs_diff(reference, outputs):
+    return [float(np.max(np.abs(np.asarray(expected, dtype=np.float32) - np.asarray(actual, dtype=np.float32))))
+            for expected, actual in zip(reference, outputs)]
+
+
+# Function that times fn() and returns the median latency in ms (after a few warm-up calls)
+def measure_latency(fn, runs=20, warmup=3):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+# Function that runs an exported model on the inputs and reports its parity with the reference
+# outputs (only the 'scores'/'boxes' outputs are compared) and its CPU latency
+def verify_model(path, inputs, reference, runs=20, num_threads=0):
+    session = create_session(path, num_threads)
+    input_name = session.get_inputs()[0].name
+
+    diffs = None
+    for img, expected in zip(inputs, reference):
+        outputs = session.run(['scores', 'boxes'], {input_name: img})
+        diff = max_abs_diff(expected, outputs)
+        diffs = diff if diffs is None else [max(a, b) for a, b in zip(diffs, diff)]
+
+    latency = measure_latency(lambda: session.run(None, {input_name: inputs[0]}), runs)
+    size = os.path.getsize(path) / 1e6
+    print('{:s}: {:.2f} MB, {:.2f} ms, max abs diff scores {:.2e} boxes {:.2e}'.format(
+        path, size, latency, diffs[0], diffs[1]))
+    return {'path': path, 'size_mb': size, 'latency_ms': latency,
+            'max_diff_scores': diffs[0], 'max_diff_boxes': diffs[1]}
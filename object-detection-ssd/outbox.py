@@ -0,0 +1,269 @@
+#
+# on-disk outbox for bird memories and notifications that could not be delivered
+# (e.g. during a Wi-Fi outage). Jobs are stored in SQLite and flushed by a background
+# worker with jittered exponential backoff, so an outage never stalls detection.
+# A job is given up (and logged) after max_attempts tries or once it is older than max_age,
+# and right away when the server rejects it for good (a 4xx status other than 408/429).
+#
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+
+from requests.exceptions import HTTPError, RequestException
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    dedup_key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    data BLOB,
+    size INTEGER NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL
+)
+'''
+
+
+# Function that computes the delay before the next attempt: exponential in the number
+# of attempts, capped at max_delay, with "equal jitter" so feeders don't retry in lockstep
+def backoff_delay(attempts, base_delay=2.0, max_delay=300.0):
+    delay = min(max_delay, base_delay * (2 ** attempts))
+    return random.uniform(delay / 2, delay)
+
+
+# Function that tells whether a failed delivery can never succeed: the server answered with a
+# client error, except for 408 (request timeout) and 429 (too many requests), which are worth a retry
+def is_permanent_failure(exception_error):
+    if not isinstance(exception_error, HTTPError) or exception_error.response is None:
+        return False
+    status = exception_error.response.status_code
+    return 400 <= status < 500 and status not in (408, 429)
+
+
+class Outbox:
+    # max_attempts - deliveries tried before a job is dropped (0 = no limit)
+    # max_age - seconds after which a job that still fails is dropped (0 = no limit)
+    # on_drop - fn(kind, payload) called for every job that is discarded without being delivered
+    def __init__(self, path='outbox.sqlite3', max_bytes=64 * 1024 * 1024, base_delay=2.0, max_delay=300.0,
+                 max_attempts=20, max_age=7 * 24 * 3600, on_drop=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.max_age = max_age
+        self.on_drop = on_drop
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(SCHEMA)
+        self._db.commit()
+
+    # Store a job for later delivery. Jobs with the same dedup_key as a pending job are ignored.
+    # Returns True if the job was stored.
+    def put(self, kind, payload, data=None, dedup_key=None):
+        payload_json = json.dumps(payload, sort_keys=True)
+        if dedup_key is None:
+            digest = hashlib.sha1(kind.encode() + payload_json.encode() + (data or b''))
+            dedup_key = digest.hexdigest()
+        size = len(payload_json) + len(data or b'')
+
+        if size > self.max_bytes:
+            print('Outbox job {:s} is larger than the outbox limit, dropping it'.format(kind))
+            self._dropped([(kind, payload_json)])
+            return False
+
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT OR IGNORE INTO outbox (kind, dedup_key, payload, data, size, next_attempt, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (kind, dedup_key, payload_json, data, size, now, now))
+            evicted = self._evict_oldest()
+            self._db.commit()
+            stored = cursor.rowcount == 1
+        self._dropped(evicted)
+        return stored
+
+    # Jobs whose next attempt is due, oldest first, as (id, kind, payload, data, attempts)
+    def due(self, limit=16, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id, kind, payload, data, attempts FROM outbox '
+                'WHERE next_attempt <= ? ORDER BY id LIMIT ?', (now, limit)).fetchall()
+        return [(job_id, kind, json.loads(payload), data, attempts)
+                for job_id, kind, payload, data, attempts in rows]
+
+    # Seconds until the next job becomes due (None if the outbox is empty)
+    def next_due_in(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            next_attempt = self._db.execute('SELECT MIN(next_attempt) FROM outbox').fetchone()[0]
+        if next_attempt is None:
+            return None
+        return max(0.0, next_attempt - now)
+
+    def mark_done(self, job_id):
+        with self._lock:
+            self._db.execute('DELETE FROM outbox WHERE id = ?', (job_id,))
+            self._db.commit()
+
+    # Remove a job that can never be delivered (it is passed to on_drop)
+    def discard(self, job_id):
+        with self._lock:
+            row = self._db.execute('SELECT kind, payload FROM outbox WHERE id = ?', (job_id,)).fetchone()
+            self._db.execute('DELETE FROM outbox WHERE id = ?', (job_id,))
+            self._db.commit()
+        self._dropped([row] if row else [])
+
+    # Reschedule a failed job using exponential backoff, returns the chosen delay.
+    # Returns None instead if the job ran out of attempts or got too old, it is dropped then.
+    def mark_failed(self, job_id, attempts):
+        now = time.time()
+        delay = backoff_delay(attempts, self.base_delay, self.max_delay)
+        with self._lock:
+            row = self._db.execute('SELECT kind, payload, created FROM outbox WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            kind, payload_json, created = row
+            give_up = ((self.max_attempts > 0 and attempts + 1 >= self.max_attempts)
+                       or (self.max_age > 0 and now + delay - created > self.max_age))
+            if give_up:
+                self._db.execute('DELETE FROM outbox WHERE id = ?', (job_id,))
+            else:
+                self._db.execute('UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?',
+                                 (attempts + 1, now + delay, job_id))
+            self._db.commit()
+        if give_up:
+            self._dropped([(kind, payload_json)])
+            return None
+        return delay
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def total_bytes(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM outbox').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # caller must hold self._lock; drops the oldest jobs until the outbox fits in max_bytes,
+    # returns the (kind, payload) of the dropped jobs so on_drop can be called after the lock is released
+    def _evict_oldest(self):
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM outbox').fetchone()[0]
+        if total <= self.max_bytes:
+            return []
+        evicted = []
+        for job_id, kind, payload_json, size in self._db.execute(
+                'SELECT id, kind, payload, size FROM outbox ORDER BY id').fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute('DELETE FROM outbox WHERE id = ?', (job_id,))
+            total -= size
+            evicted.append((kind, payload_json))
+            print('Outbox is full, evicted oldest {:s} job'.format(kind))
+        return evicted
+
+    # Function that tells on_drop about jobs given as (kind, payload JSON)
+    def _dropped(self, jobs):
+        if self.on_drop is None:
+            return
+        for kind, payload_json in jobs:
+            try:
+                self.on_drop(kind, json.loads(payload_json))
+            except Exception as exception_error:
+                print('Outbox drop handler failed for {:s} job: {}'.format(kind, exception_error))
+
+
+# Background thread that delivers outbox jobs using one handler per job kind.
+# handlers maps kind -> fn(payload, data); a handler raising a RequestException
+# (connection error, timeout, HTTP error status) is retried later with backoff,
+# unless the server rejected the job for good.
+class OutboxWorker(threading.Thread):
+    def __init__(self, outbox, handlers, idle_interval=30.0):
+        super().__init__(name='outbox', daemon=True)
+        self.outbox = outbox
+        self.handlers = handlers
+        self.idle_interval = idle_interval
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+
+    # Ask the worker to look at the outbox now (e.g. after a new job was stored)
+    def wake(self):
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self._wake.set()
+        self.join(timeout)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.flush()
+
+            wait_time = self.outbox.next_due_in()
+            if wait_time is None or wait_time > self.idle_interval:
+                wait_time = self.idle_interval
+            self._wake.wait(wait_time)
+            self._wake.clear()
+
+    # Try every due job once. Stops at the first transient failure since the
+    # rest of the jobs would most likely fail the same way.
+    def flush(self):
+        for job_id, kind, payload, data, attempts in self.outbox.due():
+            if self._stop_event.is_set():
+                return
+
+            handler = self.handlers.get(kind)
+            if handler is None:
+                print('No outbox handler for {:s} jobs, discarding job'.format(kind))
+                self.outbox.discard(job_id)
+                continue
+
+            try:
+                handler(payload, data)
+            except RequestException as exception_error:
+                if is_permanent_failure(exception_error):
+                    print('Outbox {:s} job was rejected ({}), discarding it'.format(kind, exception_error))
+                    self.outbox.discard(job_id)
+                    continue
+                delay = self.outbox.mark_failed(job_id, attempts)
+                if delay is None:
+                    print('Outbox delivery of {:s} failed ({}), giving up after {:d} attempts'.format(
+                        kind, exception_error, attempts + 1))
+                else:
+                    print('Outbox delivery of {:s} failed ({}), retrying in {:.1f}s'.format(
+                        kind, exception_error, delay))
+                return
+            except Exception as exception_error:
+                # not a network problem, retrying will not help
+                print('Outbox {:s} job failed permanently: {}'.format(kind, exception_error))
+                self.outbox.discard(job_id)
+                continue
+
+            self.outbox.mark_done(job_id)
+
+
+# Main function for testing during development
+if __name__ == '__main__':
+    outbox = Outbox(':memory:', max_bytes=1024)
+    outbox.put('notification', {'title': 'test', 'message': 'hello'})
+    outbox.put('notification', {'title': 'test', 'message': 'hello'})
+    print('jobs stored: {:d} ({:d} bytes)'.format(len(outbox), outbox.total_bytes()))
+
+    worker = OutboxWorker(outbox, {'notification': lambda payload, data: print(payload)})
+    worker.start()
+    time.sleep(0.5)
+    worker.stop()
+    print('jobs left: {:d}'.format(len(outbox)))
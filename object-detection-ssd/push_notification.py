@@ -7,12 +7,23 @@ from exponent_server_sdk import (
 )
 from requests.exceptions import ConnectionError, HTTPError
 import rollbar
-import time
 
+# shared client so repeated messages reuse the same keep-alive connection
+push_client = None
 
-def send_push_message(token, title, message, extra=None):
+
+def get_push_client():
+    global push_client
+    if push_client is None:
+        push_client = PushClient()
+    return push_client
+
+
+# on_unregistered - called with the token if its device is no longer registered,
+#                   e.g. Notifier.remove_token to stop sending to it
+def send_push_message(token, title, message, extra=None, on_unregistered=None):
     try:
-        response = PushClient().publish(
+        response = get_push_client().publish(
             PushMessage(to=token,
                         data=extra,
                         title=title,
@@ -33,15 +44,12 @@ def send_push_message(token, title, message, extra=None):
                 'response_data': exc.response_data,
             })
         raise
-    except (ConnectionError, HTTPError) as exc:
-        print('Waiting to establish HTTP connection')
-        time.sleep(5)
-        send_push_message(token, title, message, extra=None)
-        # Encountered some Connection or HTTP error - retry a few times in
-        # case it is transient.
+    except (ConnectionError, HTTPError):
+        # Encountered some Connection or HTTP error - let the caller decide whether
+        # to retry (the feeder stores the message in its outbox, see outbox.py).
         rollbar.report_exc_info(
             extra_data={'token': token, 'message': message, 'extra': extra})
-        raise self.retry(exc=exc)
+        raise
 
     try:
         # We got a response back, but we don't know whether it's an error yet.
@@ -50,9 +58,9 @@ def send_push_message(token, title, message, extra=None):
         response.validate_response()
     except DeviceNotRegisteredError:
         print('exception DeviceNotRegisteredError')
-        # Mark the push token as inactive
-        from notifications.models import PushToken
-        PushToken.objects.filter(token=token).update(active=False)
+        # stop sending to tokens whose device has been unregistered
+        if on_unregistered is not None:
+            on_unregistered(token)
     except PushTicketError as exc:
         print('exception PushTicketError')
         # Encountered some other per-notification error.
@@ -63,7 +71,7 @@ def send_push_message(token, title, message, extra=None):
                 'extra': extra,
                 'push_response': exc.push_response._asdict(),
             })
-        raise self.retry(exc=exc)
+        raise
 
 
 # Main function for testing during development
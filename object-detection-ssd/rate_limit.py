@@ -0,0 +1,123 @@
+#
+# time-based duplicate suppression and rate limiting on the monotonic clock:
+# a per-key cooldown map (e.g. one bird memory per species every few minutes) and a
+# per-key token bucket limiter (e.g. push notifications per Expo token). Both keep at
+# most max_keys entries, so memory stays bounded however many keys show up.
+#
+import collections
+import threading
+import time
+
+
+class CooldownMap:
+    # cooldown - default seconds a key stays blocked after it was used
+    # cooldowns - per key overrides of cooldown
+    def __init__(self, cooldown=120.0, cooldowns=None, max_keys=64, clock=time.monotonic):
+        self.cooldown = cooldown
+        self.cooldowns = dict(cooldowns or {})
+        self.max_keys = max_keys
+        self.clock = clock
+        self.suppressed = 0
+        # key -> time the cooldown ends, in insertion order
+        self._until = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def remaining(self, key):
+        with self._lock:
+            until = self._until.get(key)
+        return 0.0 if until is None else max(0.0, until - self.clock())
+
+    def ready(self, key):
+        return self.remaining(key) <= 0.0
+
+    # Returns True (and starts the key's cooldown) if the key is not cooling down
+    def try_acquire(self, key):
+        now = self.clock()
+        with self._lock:
+            until = self._until.get(key)
+            if until is not None and now < until:
+                self.suppressed += 1
+                return False
+            self._until.pop(key, None)
+            self._until[key] = now + self.cooldowns.get(key, self.cooldown)
+            self._prune(now)
+            return True
+
+    def reset(self, key=None):
+        with self._lock:
+            if key is None:
+                self._until.clear()
+            else:
+                self._until.pop(key, None)
+
+    def __len__(self):
+        return len(self._until)
+
+    # caller must hold self._lock; drops expired keys, then the oldest ones past max_keys
+    def _prune(self, now):
+        for key in [key for key, until in self._until.items() if until <= now]:
+            del self._until[key]
+        while len(self._until) > self.max_keys:
+            self._until.popitem(last=False)
+
+
+class KeyedRateLimiter:
+    # rate - tokens added per second to every key's bucket
+    # burst - bucket size, i.e. how many events a key may send at once
+    def __init__(self, rate, burst=1, max_keys=256, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.allowed = 0
+        self.limited = 0
+        # key -> (tokens, time of the last refill), least recently used first
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns True (and takes a token) if the key may send now
+    def allow(self, key):
+        now = self.clock()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1.0
+            if allowed:
+                tokens -= 1.0
+                self.allowed += 1
+            else:
+                self.limited += 1
+            self._buckets[key] = (tokens, now)
+            # a key that was evicted simply starts again with a full bucket
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+# Main function for testing during development (simulated clock)
+if __name__ == '__main__':
+    class FakeClock:
+        def __init__(self):
+            self.now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    clock = FakeClock()
+    cooldowns = CooldownMap(cooldown=120.0, cooldowns={'blue-jay': 300.0}, clock=clock)
+    limiter = KeyedRateLimiter(rate=12 / 3600.0, burst=3, clock=clock)
+
+    # two species alternating at the feeder every 10 seconds for an hour
+    memories = collections.Counter()
+    notifications = 0
+    for step in range(360):
+        clock.now = step * 10.0
+        species = 'blue-jay' if step % 2 else 'cardinal'
+        if cooldowns.try_acquire(species):
+            memories[species] += 1
+            notifications += limiter.allow('ExponentPushToken[test]')
+    print('memories: {}, notifications sent: {:d}, suppressed: {:d}, rate limited: {:d}'.format(
+        dict(memories), notifications, cooldowns.suppressed, limiter.limited))
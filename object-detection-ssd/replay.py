@@ -0,0 +1,407 @@
+#
+# offline replay harness and end-to-end benchmark for the feeder loop.
+#
+# Recorded frames (a directory of images, a video or 'synthetic') and/or a recorded detection
+# stream are fed through the real decision code of smart_feeder_run.py (run_obj_detection,
+# handle_bird, handle_squirrel, the UART link and the upload/notification path) with
+#   - SourceInput/NullOutput instead of the camera and display,
+#   - ReplayDetector (or the ONNX Runtime detector) instead of detectNet,
+#   - a SimulatedMcu on a pseudo-terminal instead of the MSP430, driven by a scripted
+#     serial conversation,
+#   - a local HTTP stand-in for the Expo push service and the bird memory API.
+# Each run reports frames/sec, per-stage latency percentiles (from metrics.METRICS), CPU usage
+# and what reached the MCU and the HTTP stand-in. With --baseline the run fails if frames/sec
+# dropped by more than --max-regression, so it can gate performance changes.
+#
+# Detection streams are JSON lines (one frame per line, a list of
+# [class_id, confidence, left, top, right, bottom] rows) or .npz files with 'rows' (all rows
+# stacked, Kx6) and 'counts' (rows per frame).
+#
+import argparse
+import http.server
+import json
+import os
+import pty
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import serial
+
+import smart_feeder_run
+from best_shot import BestShotSelector
+from decision import ClassTable, NO_DETECTIONS, detections_to_array
+from detector import Detector, Detection, OnnxDetector, load_labels
+from dispatch_queue import DispatchQueue
+from frame_pipeline import NullOutput, SourceInput, create_source
+from memory_image import MemoryEncoder
+from metrics import METRICS, ThreadedHTTPServer
+from motion_gate import MotionGate
+from notifier import Notifier
+from outbox import Outbox, OutboxWorker
+from rate_limit import CooldownMap
+from scheduler import ActivityScheduler
+from smart_feeder_run import Feeder, FeederSupervisor
+from tracker import IouTracker
+from uart_protocol import CODECS, CommandLink, SimulatedMcu
+
+DEFAULT_LABELS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'models', 'ALL_BIRDS_AND_SQUIRRELS_WITH_PARAKEET_V2', 'labels.txt')
+
+# the MSP430 starts a detection cycle on the first frame
+DEFAULT_SCRIPT = [{'frame': 0, 'mcu': 'r'}]
+
+
+# Function that loads a recorded detection stream, returns one (K,6) float32 array per frame
+def load_detection_stream(path):
+    if path.endswith('.npz'):
+        with np.load(path) as stream:
+            rows, counts = stream['rows'].astype(np.float32), stream['counts']
+        return np.split(rows, np.cumsum(counts)[:-1]) if len(counts) else []
+    frames = []
+    with open(path) as stream_file:
+        for line in stream_file:
+            if line.strip():
+                frames.append(np.array(json.loads(line), dtype=np.float32).reshape(-1, 6))
+    return frames
+
+
+# Function that saves a detection stream (list of (K,6) arrays) as .npz or JSON lines
+def save_detection_stream(path, frames):
+    if path.endswith('.npz'):
+        rows = np.concatenate(frames) if frames else NO_DETECTIONS
+        np.savez_compressed(path, rows=rows, counts=np.array([len(frame) for frame in frames], dtype=np.int64))
+        return
+    with open(path, 'w') as stream_file:
+        for frame in frames:
+            stream_file.write(json.dumps(np.round(frame, 4).tolist()) + '\n')
+
+
+# Function that makes up a detection stream: a bird visits, a squirrel raids the feeder, then a
+# second species arrives while the first one comes back (boxes move a little every frame)
+def synthetic_stream(labels, num_frames=300, width=1280, height=720, seed=0):
+    rng = np.random.default_rng(seed)
+    table = ClassTable(labels)
+    birds = [info.class_id for info in table.classes if not info.is_squirrel and info.slug != 'BACKGROUND']
+    squirrel = next(info.class_id for info in table.classes if info.is_squirrel)
+    visits = [(birds[0], 10, 90), (squirrel, 110, 150), (birds[0], 190, 260), (birds[1 % len(birds)], 200, 280)]
+
+    frames = []
+    for index in range(num_frames):
+        rows = []
+        for class_id, start, end in visits:
+            if start <= index < end:
+                x = width * (0.2 + 0.4 * (index - start) / (end - start)) + rng.normal(0, 2)
+                y = height * 0.35 + rng.normal(0, 2)
+                rows.append([class_id, rng.uniform(0.91, 0.99), x, y, x + width * 0.15, y + height * 0.3])
+        frames.append(np.array(rows, dtype=np.float32).reshape(-1, 6))
+    return frames
+
+
+# Plays a recorded detection stream back as a detector, one recorded frame per Detect call.
+# A batch (several feeders) gets the same recorded frame for every image; latency is paid per image.
+class ReplayDetector(Detector):
+    def __init__(self, frames, class_names, latency=0.0):
+        super().__init__(class_names)
+        self.frames = frames
+        self.latency = latency
+        self.calls = 0
+
+    def Detect(self, img, overlay='none'):
+        return self.DetectBatch([img], overlay=overlay)[0]
+
+    def DetectBatch(self, imgs, overlay='none'):
+        rows = self.frames[self.calls] if self.calls < len(self.frames) else NO_DETECTIONS
+        self.calls += 1
+        with METRICS.stage('inference'):
+            if self.latency:
+                time.sleep(self.latency * len(imgs))
+        if self.latency:
+            self._record_time(self.latency)
+        return [[Detection(int(row[0]), float(row[1]), *map(float, row[2:6])) for row in rows] for _ in imgs]
+
+
+# Wraps a detector and keeps the detections of every frame, so a run can be saved as a stream
+class RecordingDetector(Detector):
+    def __init__(self, detector):
+        super().__init__(detector.class_names)
+        self.detector = detector
+        self.frames = []
+
+    def Detect(self, img, overlay='none'):
+        return self.DetectBatch([img], overlay=overlay)[0]
+
+    def DetectBatch(self, imgs, overlay='none'):
+        results = self.detector.DetectBatch(imgs, overlay=overlay)
+        self.frames.extend(detections_to_array(detections) for detections in results)
+        return results
+
+    def GetNetworkFPS(self):
+        return self.detector.GetNetworkFPS()
+
+
+# Local stand-in for the Expo push service and the bird memory API.
+# Every push message is acknowledged with an 'ok' ticket, every upload with 200.
+class StandInServer(threading.Thread):
+    # latency - seconds every request takes, like a slow uplink
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0):
+        super().__init__(name='http-stand-in', daemon=True)
+        self.pushes = []
+        self.uploads = []
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if latency:
+                    time.sleep(latency)
+                if self.path.endswith('/push/send'):
+                    messages = json.loads(body)
+                    messages = messages if isinstance(messages, list) else [messages]
+                    with stand_in._lock:
+                        stand_in.pushes.extend(messages)
+                    response = {'data': [{'status': 'ok', 'id': str(i)} for i in range(len(messages))]}
+                    self._reply(json.dumps(response).encode(), 'application/json')
+                elif self.path == '/memories':
+                    with stand_in._lock:
+                        stand_in.uploads.append(len(body))
+                    self._reply(b'OK', 'text/plain')
+                else:
+                    self.send_error(404)
+
+            def _reply(self, body, content_type):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadedHTTPServer((host, port), Handler)
+        self.url = 'http://{:s}:{:d}'.format(host, self.server.server_address[1])
+
+    def run(self):
+        self.server.serve_forever(poll_interval=0.1)
+
+    def stop(self, timeout=None):
+        self.server.shutdown()
+        self.server.server_close()
+        self.join(timeout)
+
+
+# Function that creates a feeder talking to a SimulatedMcu over a pseudo-terminal, returns (feeder, mcu)
+def create_replay_feeder(name, net, source, opt, wake=None):
+    master, slave = pty.openpty()
+    serial_port = serial.Serial(os.ttyname(slave), baudrate=9600, timeout=0.5)
+    mcu = SimulatedMcu(master, CODECS[opt.uart_protocol](), feed_is_low=opt.feed_is_low)
+    mcu.start()
+    class_table = ClassTable.from_net(net)
+    # replayed cycles last exactly as long as the recording and every frame is due at once
+    scheduler = ActivityScheduler(active_fps=0, idle_fps=0, quiet_timeout=float('inf'),
+                                  trigger_hold=float('inf'), max_cycle=0)
+    feeder = Feeder(name, SourceInput(source, opt.height, opt.width), NullOutput(), serial_port,
+                    CommandLink(serial_port, CODECS[opt.uart_protocol]()), class_table, scheduler,
+                    BestShotSelector(), CooldownMap(cooldown=opt.species_cooldown, max_keys=len(class_table)),
+                    tracker=IouTracker(min_hits=opt.track_min_hits) if opt.track_min_hits > 0 else None,
+                    motion_gate=MotionGate() if opt.motion_gate else None, network='replay', wake=wake,
+                    hatch_reopen_delay=opt.hatch_reopen_delay)
+    return feeder, mcu
+
+
+# Function that replays frames through the feeder's decision code with fake I/O and returns a report.
+# sources - one frame source per feeder; with several feeders they share the network through a
+#           FeederSupervisor (batched inference), a single one runs the sequential detection loop
+# script - serial conversation, list of {'frame': index, 'mcu': message} sent by every simulated
+#          MSP430 before that frame ('r' start detection, 'l'/'h' feed level)
+def run_replay(net, sources, num_frames, opt, script=DEFAULT_SCRIPT, work_dir=None):
+    METRICS.reset()
+    work_dir = work_dir or tempfile.mkdtemp(prefix='feeder-replay-')
+
+    stand_in = StandInServer(latency=opt.http_latency)
+    stand_in.start()
+
+    # the services shared by all feeders live in module globals, set up the same way main does
+    smart_feeder_run.notifier = Notifier(smart_feeder_run.tokens, push_host=stand_in.url,
+                                         memory_url=stand_in.url + '/memories')
+    smart_feeder_run.outbox = Outbox(os.path.join(work_dir, 'outbox.sqlite3'))
+    smart_feeder_run.outbox_worker = OutboxWorker(smart_feeder_run.outbox, smart_feeder_run.delivery_handlers)
+    smart_feeder_run.outbox_worker.start()
+    smart_feeder_run.dispatcher = DispatchQueue(max_size=16, num_workers=2)
+    smart_feeder_run.memory_encoder = MemoryEncoder(max_size=opt.memory_max_size)
+    smart_feeder_run.memory_archive = None
+
+    wake = threading.Event()
+    pairs = [create_replay_feeder('feeder{:d}'.format(i) if len(sources) > 1 else '', net, source, opt, wake)
+             for i, source in enumerate(sources)]
+    feeders = [feeder for feeder, mcu in pairs]
+    supervisor = FeederSupervisor(feeders, net, wake=wake) if len(feeders) > 1 else None
+    events = sorted(script, key=lambda event: event['frame'])
+    for feeder in feeders:
+        feeder.start()
+
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    rounds = 0
+    for feeder in feeders:
+        feeder.start_cycle()
+    while rounds < num_frames:
+        while events and events[0]['frame'] <= rounds:
+            message = events.pop(0)['mcu'].encode()
+            for feeder, mcu in pairs:
+                mcu.emit(message)
+        if supervisor is not None:
+            supervisor.step()
+        else:
+            feeders[0].scheduler.begin_frame()
+            feeders[0].run_obj_detection(net)
+        rounds += 1
+        if not all(feeder.input.IsStreaming() for feeder in feeders):
+            break
+    # the end of the replay ends the detection cycles
+    for feeder in feeders:
+        feeder.end_cycle()
+    loop_wall, loop_cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    frames = rounds * len(feeders)
+
+    # let the side effects land before taking stock
+    smart_feeder_run.dispatcher.shutdown(drain=True, timeout=30)
+    for feeder in feeders:
+        feeder.uart_link.flush(timeout=5)
+    time.sleep(0.2)
+    total_wall, total_cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+    metrics = METRICS.as_dict()
+    report = {
+        'feeders': len(feeders),
+        'frames': frames,
+        'seconds': loop_wall,
+        'fps': frames / loop_wall if loop_wall > 0 else 0.0,
+        # CPU seconds of every thread of the process per wall second (1.0 = one core busy)
+        'cpu_load': total_cpu / total_wall if total_wall > 0 else 0.0,
+        'cpu_ms_per_frame': loop_cpu * 1000 / frames if frames else 0.0,
+        'stages_ms': {name: {key: value * 1000 for key, value in stats.items()
+                             if key in ('mean', 'p50', 'p95', 'p99', 'max')}
+                      for name, stats in metrics['stages'].items()},
+        'counters': metrics['counters'],
+        'mcu_commands': [''.join(command.decode() for command in mcu.received) for feeder, mcu in pairs],
+        'hatch_open': [mcu.hatch_is_open for feeder, mcu in pairs],
+        'pushes': [message.get('title') for message in stand_in.pushes],
+        'uploads': len(stand_in.uploads),
+        'upload_kb': sum(stand_in.uploads) / 1024.0,
+        'outbox': len(smart_feeder_run.outbox),
+        'dispatch': smart_feeder_run.dispatcher.stats.as_dict(),
+        'uart': [feeder.uart_link.stats.as_dict() for feeder in feeders],
+    }
+    if supervisor is not None:
+        report['supervisor'] = supervisor.stats()
+
+    smart_feeder_run.outbox_worker.stop(timeout=5)
+    smart_feeder_run.outbox.close()
+    smart_feeder_run.notifier.close()
+    for feeder, mcu in pairs:
+        feeder.stop()
+        mcu.stop(timeout=1)
+        os.close(mcu.fd)
+    stand_in.stop(timeout=1)
+    return report
+
+
+# Function that prints the report of one run in a readable form
+def print_report(report):
+    print('{:d} feeder(s), {:d} frames in {:.2f}s: {:.1f} FPS, {:.2f} ms CPU/frame, CPU load {:.2f}'.format(
+        report['feeders'], report['frames'], report['seconds'], report['fps'], report['cpu_ms_per_frame'], report['cpu_load']))
+    for name, stats in sorted(report['stages_ms'].items()):
+        print('  {:<13s} mean {:7.3f}  p50 {:7.3f}  p95 {:7.3f}  p99 {:7.3f}  max {:7.3f} ms'.format(
+            name, stats['mean'], stats['p50'], stats['p95'], stats['p99'], stats['max']))
+    print('  counters: {}'.format(report['counters']))
+    print('  MCU commands: {}, hatch open: {}'.format(report['mcu_commands'], report['hatch_open']))
+    if 'supervisor' in report:
+        print('  supervisor: {}'.format(report['supervisor']))
+    print('  pushes: {}'.format(report['pushes']))
+    print('  uploads: {:d} ({:.0f} KB), outbox: {:d}'.format(report['uploads'], report['upload_kb'], report['outbox']))
+
+
+# Main function: replay a recording (or a synthetic scenario) and benchmark the feeder loop
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded frames/detections through the feeder loop and benchmark it.")
+    parser.add_argument("--frames", type=str, default="synthetic",
+                        help="frames to replay: a directory of images, a video file or 'synthetic'")
+    parser.add_argument("--detections", type=str, default="",
+                        help="recorded detection stream (.jsonl or .npz); without it --model is run on the frames, "
+                             "without either a synthetic scenario is replayed")
+    parser.add_argument("--save-detections", type=str, default="",
+                        help="save the detections of the first run as a stream (.jsonl or .npz)")
+    parser.add_argument("--model", type=str, default="", help="ONNX model to run on the frames")
+    parser.add_argument("--labels", type=str, default=DEFAULT_LABELS, help="labels.txt of the model/recording")
+    parser.add_argument("--raw-outputs", action='store_true',
+                        help="the model was exported with onnx_export.py --raw-outputs")
+    parser.add_argument("--script", type=str, default="",
+                        help="JSON file with the serial conversation, e.g. [{\"frame\": 0, \"mcu\": \"r\"}]")
+    parser.add_argument("--num-frames", type=int, default=300, help="frames per run (per feeder)")
+    parser.add_argument("--feeders", type=int, default=1,
+                        help="number of simulated feeders sharing the network (more than one uses batched inference)")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--detector-latency", type=float, default=0.0,
+                        help="seconds each replayed detection takes (e.g. 0.03 to mimic the Jetson)")
+    parser.add_argument("--http-latency", type=float, default=0.0, help="seconds each request to the HTTP stand-in takes")
+    parser.add_argument("--uart-protocol", type=str, default="legacy", choices=list(CODECS))
+    parser.add_argument("--feed-is-low", action="store_true", help="the simulated MSP430 reports low feed")
+    parser.add_argument("--motion-gate", action="store_true",
+                        help="skip the detector on unchanged frames (only meaningful when a model runs on real frames)")
+    parser.add_argument("--track-min-hits", type=int, default=3)
+    parser.add_argument("--species-cooldown", type=float, default=120.0)
+    parser.add_argument("--hatch-reopen-delay", type=float, default=0.05,
+                        help="seconds without a squirrel before the hatch reopens (replays run faster than real time)")
+    parser.add_argument("--memory-max-size", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=3, help="number of benchmark runs (the median FPS run is reported)")
+    parser.add_argument("--json", type=str, default="", help="write the report to this file")
+    parser.add_argument("--baseline", type=str, default="", help="report of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.10,
+                        help="fail if FPS dropped by more than this fraction of the baseline")
+    opt = parser.parse_args()
+    opt.overlay = 'none'
+    opt.network = 'replay'
+
+    labels = load_labels(opt.labels)
+    script = DEFAULT_SCRIPT
+    if opt.script:
+        with open(opt.script) as script_file:
+            script = json.load(script_file)
+
+    if opt.detections:
+        stream = load_detection_stream(opt.detections)
+    elif not opt.model:
+        stream = synthetic_stream(labels, opt.num_frames, opt.width, opt.height)
+
+    reports = []
+    for run in range(opt.runs):
+        if opt.model and not opt.detections:
+            net = RecordingDetector(OnnxDetector(opt.model, opt.labels, raw_outputs=opt.raw_outputs))
+        else:
+            net = ReplayDetector(stream, labels, latency=opt.detector_latency)
+        sources = [create_source(opt.frames, loop=True, max_frames=opt.num_frames) for _ in range(opt.feeders)]
+        reports.append(run_replay(net, sources, opt.num_frames, opt, script))
+        if run == 0 and opt.save_detections and isinstance(net, RecordingDetector):
+            save_detection_stream(opt.save_detections, net.frames)
+
+    report = sorted(reports, key=lambda run_report: run_report['fps'])[len(reports) // 2]
+    report['fps_runs'] = [run_report['fps'] for run_report in reports]
+    print_report(report)
+
+    if opt.json:
+        with open(opt.json, 'w') as report_file:
+            json.dump(report, report_file, indent=1)
+
+    if opt.baseline:
+        with open(opt.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        change = report['fps'] / baseline['fps'] - 1.0
+        print('FPS {:.1f} vs baseline {:.1f} ({:+.1%})'.format(report['fps'], baseline['fps'], change))
+        if change < -opt.max_regression:
+            print('Performance regression beyond {:.0%}'.format(opt.max_regression))
+            sys.exit(1)
@@ -0,0 +1,135 @@
+#
+# adaptive frame-rate scheduler for detection cycles. Inference runs at the full rate while
+# something is in front of the camera (or a squirrel was just seen), drops to a low duty cycle
+# when the scene is quiet, and the cycle ends once the scene has been quiet for long enough
+# (sooner when the MSP430's trigger has cleared, i.e. no 'r' arrived for a while).
+#
+import threading
+import time
+
+
+class ActivityScheduler:
+    # active_fps - inference rate while there is activity (0 = as fast as possible)
+    # idle_fps - inference rate once the scene has been quiet for idle_after seconds
+    # quiet_timeout - end the cycle after this many seconds without activity
+    # trigger_hold - the MSP430 trigger counts as held for this long after the last 'r'; once it
+    #                has cleared the cycle ends as soon as the scene is idle
+    # squirrel_hold - keep the full rate for this long after a squirrel was seen
+    # max_cycle - hard limit on the length of a cycle in seconds (0 = no limit)
+    def __init__(self, active_fps=0, idle_fps=5, idle_after=1.0, quiet_timeout=8.0, trigger_hold=4.0,
+                 squirrel_hold=5.0, max_cycle=120.0, clock=time.monotonic):
+        self.active_fps = active_fps
+        self.idle_fps = idle_fps
+        self.idle_after = idle_after
+        self.quiet_timeout = quiet_timeout
+        self.trigger_hold = trigger_hold
+        self.squirrel_hold = squirrel_hold
+        self.max_cycle = max_cycle
+        self.clock = clock
+
+        self.frames = 0
+        self.idle_frames = 0
+        self.cycles = 0
+
+        self._cycle_start = None
+        self._last_activity = None
+        self._last_trigger = None
+        self._squirrel_until = None
+        self._last_frame = None
+        self._wake = threading.Event()
+
+    def start_cycle(self):
+        now = self.clock()
+        self.cycles += 1
+        self._cycle_start = now
+        # the trigger itself counts as activity, the cycle starts at the full rate
+        self._last_activity = now
+        self._last_trigger = now if self._last_trigger is None else max(self._last_trigger, now)
+        self._squirrel_until = None
+        self._last_frame = None
+
+    # Called for every 'r' from the MSP430 (also from the serial reader thread)
+    def trigger(self):
+        self._last_trigger = self.clock()
+        self._wake.set()
+
+    # Called after every decided frame: activity - something was detected, squirrel - a squirrel was
+    def record(self, activity, squirrel=False):
+        now = self.clock()
+        if activity or squirrel:
+            self._last_activity = now
+        if squirrel:
+            self._squirrel_until = now + self.squirrel_hold
+
+    def is_active(self):
+        now = self.clock()
+        if self._squirrel_until is not None and now < self._squirrel_until:
+            return True
+        return now - self._last_activity < self.idle_after
+
+    def trigger_held(self):
+        return self._last_trigger is not None and self.clock() - self._last_trigger < self.trigger_hold
+
+    def cycle_done(self):
+        now = self.clock()
+        if self.max_cycle and now - self._cycle_start >= self.max_cycle:
+            return True
+        if self.is_active():
+            return False
+        if not self.trigger_held():
+            return True
+        return now - self._last_activity >= self.quiet_timeout
+
+    # Seconds to wait before the next frame, given the current activity
+    def next_frame_delay(self):
+        fps = self.active_fps if self.is_active() else self.idle_fps
+        if not fps or self._last_frame is None:
+            return 0.0
+        return max(0.0, self._last_frame + 1.0 / fps - self.clock())
+
+    # Blocks until the next frame is due (a new trigger cuts the wait short), returns False once
+    # the cycle is over
+    def wait_for_next_frame(self):
+        delay = self.next_frame_delay()
+        if delay > 0:
+            self._wake.wait(delay)
+        self._wake.clear()
+        if self.cycle_done():
+            return False
+        self.begin_frame()
+        return True
+
+    # Counts a frame that is processed now (for callers that do their own waiting, like the
+    # multi-feeder supervisor polling next_frame_delay() of several schedulers)
+    def begin_frame(self):
+        self.frames += 1
+        if not self.is_active():
+            self.idle_frames += 1
+        self._last_frame = self.clock()
+
+    def stats(self):
+        return {'cycles': self.cycles, 'frames': self.frames, 'idle_frames': self.idle_frames}
+
+
+# Main function for testing during development (simulated clock, 30 FPS camera)
+if __name__ == '__main__':
+    class FakeClock:
+        def __init__(self):
+            self.now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    clock = FakeClock()
+    scheduler = ActivityScheduler(clock=clock)
+    scheduler._wake.wait = lambda delay: setattr(clock, 'now', clock.now + delay)
+
+    # a bird is present from 2s to 5s after the trigger, the trigger is repeated at 3s
+    scheduler.start_cycle()
+    while scheduler.wait_for_next_frame():
+        clock.now += 1 / 30
+        t = clock.now
+        if 3.0 <= t < 3.0 + 1 / 30:
+            scheduler.trigger()
+        scheduler.record(2.0 <= t < 5.0)
+    print('cycle of {:.1f}s, {}'.format(clock.now, scheduler.stats()))
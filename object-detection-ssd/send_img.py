@@ -1,17 +1,25 @@
 from os import name
 import requests as req
 
+BIRD_MEMORY_URL = 'https://smart-bird-feeder-api.herokuapp.com/user/post-bird-memory'
+# BIRD_MEMORY_URL = 'http://192.168.0.17:3000/user/post-bird-memory'
 
-def post_bird_memory(species_name):
-    # path is constant (img overwritten)
-    img_path = './captured-bird-images/bird_memory.jpeg'
-    url = 'https://smart-bird-feeder-api.herokuapp.com/user/post-bird-memory'
-    # url = 'http://192.168.0.17:3000/user/post-bird-memory'
 
-    files = {'file': (species_name, open(
-        img_path, 'rb'), 'image/jpeg')}
-    r = req.post(url, files=files)
+# path is constant (img overwritten)
+BIRD_MEMORY_PATH = './captured-bird-images/bird_memory.jpeg'
+
+
+# session can be a shared (keep-alive) requests.Session, otherwise a one-off request is made.
+# img_data can hold the jpeg bytes directly (e.g. when re-sending from the outbox).
+def post_bird_memory(species_name, session=None, url=BIRD_MEMORY_URL, timeout=None, img_data=None):
+    if img_data is None:
+        with open(BIRD_MEMORY_PATH, 'rb') as img_file:
+            img_data = img_file.read()
+
+    files = {'file': (species_name, img_data, 'image/jpeg')}
+    r = (session or req).post(url, files=files, timeout=timeout)
     print(r.text)
+    return r
 
 
 if __name__ == '__main__':
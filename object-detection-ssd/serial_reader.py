@@ -0,0 +1,92 @@
+#
+# event-driven reader for the MSP430 UART link. A dedicated thread blocks on the serial
+# port (read with timeout) and dispatches each received message to its handler, so the
+# main loop can sleep instead of spinning on serial_port.in_waiting.
+#
+import threading
+
+
+# Default decoder: the MSP430 sends one ASCII byte per message
+def split_bytes(data):
+    return [data[i:i + 1] for i in range(len(data))]
+
+
+class SerialReader(threading.Thread):
+    # handlers maps a message (e.g. b'r') to fn(message); messages without a handler
+    # are passed to default_handler (if given). decoder turns the raw bytes read into
+    # a list of messages (default: one message per byte, as sent by the MSP430).
+    # The serial port must have been opened with a read timeout so stop() is noticed
+    # within that time.
+    def __init__(self, serial_port, handlers=None, default_handler=None, decoder=None, name='serial-reader'):
+        super().__init__(name=name, daemon=True)
+        self.serial_port = serial_port
+        self.handlers = dict(handlers or {})
+        self.default_handler = default_handler
+        self.decoder = decoder or split_bytes
+        self.bytes_read = 0
+        self._stop_event = threading.Event()
+
+    # Register the handler for a message, replacing any previous one
+    def on(self, message, handler):
+        self.handlers[message] = handler
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                # blocks until at least one byte arrives or the port timeout expires,
+                # then picks up anything else that is already buffered
+                data = self.serial_port.read(1)
+                if data and self.serial_port.in_waiting > 0:
+                    data += self.serial_port.read(self.serial_port.in_waiting)
+            except Exception as exception_error:
+                if self._stop_event.is_set():
+                    return
+                print("Serial read failed: " + str(exception_error))
+                self._stop_event.wait(1)
+                continue
+
+            if not data:
+                continue
+            self.bytes_read += len(data)
+            for message in self.decoder(data):
+                self.dispatch(message)
+
+    def dispatch(self, message):
+        handler = self.handlers.get(message, self.default_handler)
+        if handler is None:
+            return
+        try:
+            handler(message)
+        except Exception as exception_error:
+            print("Serial handler for {} failed: {}".format(message, exception_error))
+
+
+# Main function for testing during development (uses a pseudo-terminal in place of /dev/ttyTHS1)
+if __name__ == '__main__':
+    import os
+    import pty
+    import time
+    import serial
+
+    master, slave = pty.openpty()
+    serial_port = serial.Serial(os.ttyname(slave), baudrate=9600, timeout=0.5)
+
+    reader = SerialReader(serial_port, default_handler=lambda message: print('received', message))
+    reader.start()
+
+    start_cpu = time.process_time()
+    os.write(master, b'r')
+    time.sleep(1)
+    os.write(master, b'lh')
+    time.sleep(1)
+    reader.stop()
+    print('bytes read: {:d}, cpu time while idle: {:.3f}s'.format(
+        reader.bytes_read, time.process_time() - start_cpu))
+
+    serial_port.close()
+    os.close(master)
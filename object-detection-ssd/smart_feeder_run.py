@@ -23,215 +23,598 @@
 
 import time
 import serial
-import cv2
 import numpy as np
 
-import jetson.inference
-import jetson.utils
+try:
+    import jetson.inference
+    import jetson.utils
+except ImportError:
+    # not on a Jetson: run on the CPU with the ONNX Runtime detector and numpy video sources
+    jetson = None
 
 import argparse
+import json
 import sys
-
-# http post request img file in req body
-from send_img import post_bird_memory
-# push notifications
-from push_notification import send_push_message
+import threading
+
+from requests.exceptions import RequestException
+
+# pooled http session for bird memory uploads and batched push notifications
+from notifier import Notifier
+# bird memories are JPEG-encoded in memory (optionally archived to disk)
+from memory_image import MemoryEncoder
+# local content-addressed archive of bird memories with a SQLite index (opt-in)
+from memory_archive import MemoryArchive
+# on-disk store for uploads/notifications that failed, retried in the background
+from outbox import Outbox, OutboxWorker
+# thread that blocks on the UART and dispatches MSP430 messages
+from serial_reader import SerialReader
+# send queue that coalesces redundant MSP430 commands (optionally framed + acknowledged)
+from uart_protocol import CommandLink, CODECS
+# frame differencing pre-filter that skips the detector on unchanged frames
+from motion_gate import MotionGate
+# staged capture -> inference -> decision pipeline over a ring of preallocated frames
+from frame_pipeline import FramePipeline, SourceInput, NullOutput, alloc_numpy_slots, create_source
+# detectNet-compatible detectors (TensorRT on the Jetson, ONNX Runtime on the CPU)
+from detector import create_detector, BACKENDS
+# class-id table (label, display name, squirrel?, threshold) and the per-frame squirrel/bird decision
+from decision import ClassTable, any_squirrel, decide, detections_to_array, parse_label_values
+# IoU tracker that only passes on detections confirmed over several frames
+from tracker import IouTracker
+# paces detection cycles by scene activity and ends them once the scene is quiet
+from scheduler import ActivityScheduler
+# keeps the best few crops of each bird visit and picks one memory when the visit ends
+from best_shot import BestShotSelector
+# per-species cooldowns for bird memories and per-token rate limits for push notifications
+from rate_limit import CooldownMap, KeyedRateLimiter
+# per-stage timing histograms and counters, exported over HTTP (Prometheus) or as JSON lines
+from metrics import METRICS, MetricsServer, JsonLineLogger
+# background queue for uploads/notifications so detection never blocks on HTTP
+from dispatch_queue import DispatchQueue, DROP_POLICIES, DROP_OLDEST
 
 # tokens for Expo push notifications
 tokens = ['ExponentPushToken[QdzwK-NUMCWMaVSyKnb8BC]', 'ExponentPushToken[dWndBpE2r1VD2cmkuzzdvV]']
-# counter1 for counting interval to ignore a species for
-counter1 = 0
-# counter2 for waiting some frames after a squirrel is gone before opening hatch again
-counter2 = 0
-# detection_cycle_counter for running detection while below a certain value
-# whenever new detection is made, detection_cycle_counter resets so detection can continue regardless
-# of command given by MSP430 laser sensor
-detection_cycle_counter = 0
-hatch_is_open = True
-# Have a flag to tell if a new species has been detected, this way we can ignore it the first time it's seen
-species_is_novel = True
-
-def run_obj_detection(input, output, net, opt, serial_port, species_names, species_to_ignore):
-    global hatch_is_open, counter2
-
-    ################################# object detection code #################################
-    # capture the next image
-    img = input.Capture()
-
-    # copy img to preserve no overlay in img but still have an overlayed img to render to ouput window
-    # this prevents detection overlay from showing up in bird memories
-    overlayed_img = img
-
-    # detect objects in the image (with overlay chosen in parser arguments)
-    detections = net.Detect(overlayed_img, overlay=opt.overlay)
-
-    # print the detections
-#    print("detected {:d} object(s) in image".format(len(detections)))
-
-    # render the image with detections overlay
-    output.Render(overlayed_img)
-
-    # update the title bar
-    update_title_bar(output, "{:s} | Network {:.0f} FPS".format(
-        opt.network, net.GetNetworkFPS()))
-
-    squirrel_detected = False
-
-    # check if a squirrel was detected in the frame
-    squirrel_detected = is_squirrel_detected(net, detections)
-
-    if squirrel_detected:
-        counter2 = 0
-        ## handle squirrel prescence ##
-        handle_squirrel(serial_port)
-        return  # stop processing current frame
-    else:
-        counter2 += 1
-
-        # if hatch closed and squirrel was not detected for a while -> open hatch and handle bird detection
-        if not hatch_is_open and counter2 >= (30 * 5):
-            counter2 = 0
-            # opening hatch also causes the alarm to stop sounding
-            open_hatch(serial_port)
-            hatch_is_open = True
-        species_to_ignore = handle_bird(
-            net, detections, species_names, img, species_to_ignore)
+# background job queue for bird memory uploads and push notifications (created in main, shared by all feeders)
+dispatcher = None
+# shared notifier holding the keep-alive HTTP sessions (created in main)
+notifier = None
+# persistent outbox for failed deliveries and the thread that flushes it (created in main)
+outbox = None
+outbox_worker = None
+# encodes bird memories for upload (created in main)
+memory_encoder = None
+# local archive of every bird memory and its upload status (created in main, None = not archived)
+memory_archive = None
+
+# TODO: adjust wait time for low feed check
+FEED_CHECK_INTERVAL = 30  # waiting interval in seconds
+
+
+# One feeder: its camera, its MSP430 link and the decision state of its detection cycles.
+# Feeders share the detection network and the upload/notification services above, so one
+# process (and one loaded network) can serve several feeders.
+class Feeder:
+    # name - used in log lines and metric names ('' for a single feeder)
+    # input/output - jetson.utils videoSource/videoOutput (or SourceInput/NullOutput)
+    # uart_link - CommandLink to this feeder's MSP430, serial_port the port it writes to
+    # motion_gate - skips the detector on frames without pixel change (None = detect every frame)
+    # scheduler - decides the frame rate and length of detection cycles: whenever something is
+    #             detected the cycle continues at the full rate regardless of command given by
+    #             MSP430 laser sensor
+    # tracker - confirms detections across frames before they are acted on (None = act on single frames)
+    # best_shots - best-shot buffers of the bird visits being recorded
+    # species_cooldowns - per-species cooldowns between bird memories
+    # hatch_reopen_delay - seconds without a squirrel before a closed hatch opens again
+    # wake - optional event set whenever the MSP430 asks for detection (shared by the supervisor)
+    def __init__(self, name, input, output, serial_port, uart_link, class_table, scheduler, best_shots,
+                 species_cooldowns, tracker=None, motion_gate=None, overlay='none', network='', wake=None,
+                 hatch_reopen_delay=5.0, clock=time.monotonic):
+        self.name = name
+        self.input = input
+        self.output = output
+        self.serial_port = serial_port
+        self.uart_link = uart_link
+        self.class_table = class_table
+        self.scheduler = scheduler
+        self.best_shots = best_shots
+        self.species_cooldowns = species_cooldowns
+        self.tracker = tracker
+        self.motion_gate = motion_gate
+        self.overlay = overlay
+        self.network = network
+        self.wake = wake
+        self.hatch_reopen_delay = hatch_reopen_delay
+        self.clock = clock
+
+        # a closed hatch stays closed until this time (monotonic clock), pushed back by every squirrel
+        self.hatch_reopen_at = 0.0
+        self.hatch_is_open = True
+        # detections of the last frame the detector ran on, reused for frames the motion gate skips
+        self.last_detections = []
+        self.in_cycle = False
+        # time the ultrasonic sensor was last pulsed
+        self.last_feed_check = time.time()
+
+        # set by the serial reader thread whenever the MSP430 sends 'r' (start detection)
+        self.detection_requested = threading.Event()
+        # the reader thread owns all UART input and dispatches each message as it arrives
+        self.serial_reader = SerialReader(serial_port, {
+            'r'.encode(): self.handle_detection_request,
+            'l'.encode(): self.handle_serial_data,
+            'h'.encode(): self.handle_serial_data,
+        }, decoder=uart_link.receive)
+
+    # Function that names a metric of this feeder (feeders of one process export side by side)
+    def metric_name(self, metric):
+        return metric + '_' + self.name if self.name else metric
+
+    def start(self):
+        self.uart_link.start()
+#        print('Performing initial hatch open process')
+        # initially, open the feed door, set hatch opened flag
+        # all commands to the MSP430 go through the link's send queue
+        self.open_hatch()
+        self.hatch_is_open = True
+        self.serial_reader.start()
+
+        # queue depths and link counters are read from their owners whenever metrics are exported
+        METRICS.register(self.metric_name('uart_bytes_written'), lambda: self.uart_link.stats.bytes_written,
+                         kind='counter', help='Bytes written to the MSP430.')
+        METRICS.register(self.metric_name('uart_bytes_read'), lambda: self.uart_link.stats.bytes_read,
+                         kind='counter', help='Bytes read from the MSP430.')
+        METRICS.register(self.metric_name('hatch_open'), lambda: self.hatch_is_open,
+                         help='1 while the feed hatch is open.')
+
+    def stop(self):
+        self.serial_reader.stop(timeout=1)
+        self.uart_link.flush(timeout=2)
+        self.uart_link.stop(timeout=1)
+        print('{:s}UART link stats: {}'.format(self._prefix(), self.uart_link.stats.as_dict()))
+        print('{:s}Scheduler stats: {}'.format(self._prefix(), self.scheduler.stats()))
+        self.serial_port.close()
+
+    def start_cycle(self):
+#        print("'r' received! Starting detection cycle...")
+        # detect until the scene has been quiet for a while, then stop the cycle to save resources
+        self.in_cycle = True
+        self.scheduler.start_cycle()
+
+    def end_cycle(self):
+#        print('detection loop has ended')
+        self.in_cycle = False
+        # 'r' messages received during the cycle were already served by it
+        self.detection_requested.clear()
+        # the scene may look completely different by the next cycle
+        if self.motion_gate is not None:
+            self.motion_gate.reset()
+            self.last_detections = []
+        if self.tracker is not None:
+            self.tracker.reset()
+        # visits still open when the cycle ends get their memory now
+        self.emit_bird_memories(self.best_shots.flush())
+
+        # tell the MSP430 that detection is not running
+        self.report_detection_stopped()
+
+    # Function that runs one detection cycle frame by frame (capture, inference and decision in turn)
+    def run_cycle(self, net):
+        self.start_cycle()
+        # waits between frames while the scene is quiet
+        while self.scheduler.wait_for_next_frame():
+            # check if it is time to check feed levels
+            self.check_feed_lvl()
+
+            self.run_obj_detection(net)
+        self.end_cycle()
+
+    # Function that runs one detection cycle with capture, inference and decisions on separate threads.
+    # Inference is paced by the scheduler, the cycle ends when the scheduler says so (or the input ends).
+    def run_pipelined_cycle(self, net, pipeline_source, slots):
+        self.start_cycle()
+        pipeline = FramePipeline(pipeline_source, lambda img: self.detect_objects(net, img),
+                                 lambda img, result: self.handle_detections(net, img, *result),
+                                 slots, pace=self.scheduler.wait_for_next_frame)
+        pipeline.start()
+        # the decision stage finishes once the scheduler ends the cycle or the input stream ends
+        while not pipeline.wait(1.0):
+            # check if it is time to check feed levels
+            self.check_feed_lvl()
+        pipeline.stop()
+#        print('pipeline stats: {}'.format(pipeline.stats()))
+        self.end_cycle()
 
-    # print out performance info
-#    net.PrintProfilerTimes()
+    def run_obj_detection(self, net):
+        ################################# object detection code #################################
+        # capture the next image
+        img = self.capture()
 
-    # exit on input/output EOS
-    if not input.IsStreaming() or not output.IsStreaming():
-        return species_to_ignore
+        detections, inferred = self.detect_objects(net, img)
 
-    return species_to_ignore
+        self.handle_detections(net, img, detections, inferred)
 
+    def capture(self):
+        with METRICS.stage('capture'):
+            return self.input.Capture()
 
-def is_squirrel_detected(net, detections):
-    global detection_cycle_counter
-    # check if a squirrel was detected in the frame
-    for detection in detections:
-        detection_cycle_counter = 0
-        if str(net.GetClassDesc(detection.ClassID)) == 'squirrel' and detection.Confidence >= .90:
+    # Function that tells whether the detector has to run on a captured image: nothing in the scene
+    # has changed, the detections of the last inferred frame still hold
+    def should_detect(self, img):
+        if self.motion_gate is None or self.motion_gate.should_detect(to_numpy(img)):
             return True
+        METRICS.inc('frames_skipped')
+        return False
+
+    # Function that runs the detector on a captured image (inference stage of the pipeline).
+    # Returns the detections and whether the detector actually ran on this image.
+    def detect_objects(self, net, img):
+        # detect objects in the image (with overlay chosen in parser arguments), unless nothing in the
+        # scene has changed, in which case the detections of the last inferred frame still hold
+        inferred = self.should_detect(img)
+        if inferred:
+            self.last_detections = net.Detect(img, overlay=self.overlay)
+
+        # print the detections
+#        print("detected {:d} object(s) in image".format(len(self.last_detections)))
+
+        return self.last_detections, inferred
+
+    # Function that renders a processed frame and acts on its detections (decision stage of the pipeline)
+    # inferred - False if the detections were reused from the last inferred frame
+    def handle_detections(self, net, img, detections, inferred=True):
+        # copy img to preserve no overlay in img but still have an overlayed img to render to ouput window
+        # this prevents detection overlay from showing up in bird memories
+        overlayed_img = img
+
+        # render the image with detections overlay
+        self.output.Render(overlayed_img)
+
+        # update the title bar
+        update_title_bar(self.output, "{:s} | Network {:.0f} FPS".format(
+            self.network, net.GetNetworkFPS()))
+
+        with METRICS.stage('decision'):
+            self.act_on_detections(img, detections, inferred)
+        METRICS.inc('frames_processed')
+
+        # print out performance info
+#        net.PrintProfilerTimes()
+
+    # Function that decides a frame and acts on it: hatch/alarm for squirrels, memories for birds
+    def act_on_detections(self, img, detections, inferred=True):
+        # decide the whole frame at once: squirrel present? which birds?
+        decision, rows, visit_keys, ended_keys = self.decide_frame(detections, inferred)
+
+        # birds that left the scene get their one memory (the best shot of the visit)
+        if ended_keys:
+            self.emit_bird_memories(self.best_shots.end_visits(ended_keys))
+
+        if decision.squirrel:
+            self.hatch_reopen_at = self.clock() + self.hatch_reopen_delay
+            ## handle squirrel prescence ##
+            self.handle_squirrel()
+            return  # stop processing current frame
+        else:
+            # if hatch closed and squirrel was not detected for a while -> open hatch and handle bird detection
+            if not self.hatch_is_open and self.clock() >= self.hatch_reopen_at:
+                # opening hatch also causes the alarm to stop sounding
+                self.open_hatch()
+                self.hatch_is_open = True
+                METRICS.inc('hatch_toggles')
+            self.handle_bird(decision, rows, visit_keys, img)
+
+    # Function that decides a frame from its detections (see decision.decide), only counting
+    # detections that belong to confirmed tracks when tracking is enabled.
+    # Returns the decision, the decided rows, the visit key of each row (track id, or class id
+    # without tracking) and the keys of the visits that ended on this frame.
+    # Reused detections (inferred=False) don't count as new sightings for the tracker, or a
+    # single false positive on a still scene would confirm itself.
+    def decide_frame(self, detections, inferred=True):
+        rows = detections_to_array(detections)
+        # any detection (or a closed hatch waiting to reopen) keeps the detection cycle going at the
+        # full rate, a squirrel - however unsure - keeps it there a while longer
+        self.scheduler.record(len(rows) > 0 or not self.hatch_is_open,
+                              squirrel=any_squirrel(self.class_table, rows))
+        if self.tracker is None:
+            return decide(self.class_table, rows), rows, rows[:, 0].astype(int).tolist(), []
+        rows = self.tracker.update(rows) if inferred else self.tracker.hold()
+        return decide(self.class_table, rows), rows, self.tracker.confirmed_ids, self.tracker.ended_ids
+
+    def handle_squirrel(self):
+        if self.hatch_is_open:
+            # closing hatch also causes the alarm to start sounding until hatch is opened again
+            self.close_hatch()
+            self.hatch_is_open = False
+            METRICS.inc('hatch_toggles')
+
+    # decision, rows, visit_keys - the frame's decision, decided rows and their visit keys (from decide_frame)
+    def handle_bird(self, decision, rows, visit_keys, img):
+        frame = None
+        for class_id, row_index in zip(decision.birds, decision.bird_rows):
+            visit_key = visit_keys[row_index]
+
+            # a new visit is only recorded if its species is not cooling down from its last memory,
+            # so a species that keeps coming back (or two alternating ones) can't flood uploads
+            if (not self.best_shots.has_visit(visit_key)
+                    and self.species_cooldowns.try_acquire(self.class_table.slug(class_id))):
+#                print('Processing species:', self.class_table.slug(class_id))  # debug
+
+                ## handle confidently detected bird: record its visit ##
+                self.best_shots.open_visit(visit_key, class_id)
+
+            # offer the frame to the visit, the crop is only copied if it is one of the best so far
+            if self.best_shots.has_visit(visit_key):
+                if frame is None:
+                    frame = to_numpy(img)
+                self.best_shots.offer(visit_key, frame, rows[row_index])
+
+    # Function that sends one bird memory + push notification per ended visit, with its best shot
+    def emit_bird_memories(self, shots):
+        for class_id, shot in shots:
+            # save + post the bird memory with formatted species name off the capture thread
+            display_name = self.class_table.display_name(class_id)
+            # the shot is already a private copy, encoding happens on the dispatch queue
+            dispatch('bird-memory', record_bird_memory, shot, display_name, self.class_table.slug(class_id))
+            # send push notification for newly added bird memory
+            title = 'A {:s} is at your feeder! 🐦'.format(display_name)
+            message = 'A new bird memory has been captured!\nView it in your bird memories gallery.'
+            dispatch('notification', send_notification, title, message)
+
+    # seconds until the next feed check is due
+    def feed_check_due_in(self):
+        return max(0.0, FEED_CHECK_INTERVAL - (time.time() - self.last_feed_check))
+
+    # Function that requests a feed check if it is due
+    def check_feed_lvl(self):
+        if self.feed_check_due_in() <= 0:
+            self.request_feed_check()
+            # reset waiting time for next pulse to ultrasonic
+            self.last_feed_check = time.time()
+
+    # Function that asks the MSP430 to read the ultrasonic sensor ('h'/'l' comes back on the reader thread)
+    # (a feed check still waiting to be sent is not queued twice)
+    def request_feed_check(self):
+        self.uart_link.send('u'.encode())
+
+    # hatch commands are state commands: the link only transmits them when the hatch state changes
+    def open_hatch(self):
+#        print('Start of open_hatch function')
+        open_hatch_cmd = 'o'
+        # queue msg for the UART link (responses are picked up by the serial reader thread)
+        self.uart_link.set_state('hatch', open_hatch_cmd.encode())
+#        print('Hatch open command sent to MSP430')
+
+    def close_hatch(self):
+#        print('Start of close_hatch function')
+        close_hatch_cmd = 'c'
+        # queue msg for the UART link (responses are picked up by the serial reader thread)
+        self.uart_link.set_state('hatch', close_hatch_cmd.encode())
+#        print('Hatch close command sent to MSP430')
+
+    # Function that tells the MSP430 that detection is not running (only sent when that changes)
+    def report_detection_stopped(self):
+        self.uart_link.set_state('detection', 's'.encode())
+
+    # Function for the 'r' message: the MSP430 started a detection cycle on its own
+    def handle_detection_request(self, data=None):
+        self.uart_link.assume_state('detection', 'r'.encode())
+        # a running cycle counts the trigger as still held
+        self.scheduler.trigger()
+        self.detection_requested.set()
+        if self.wake is not None:
+            self.wake.set()
+
+    # Function handles different data that is in the serial port buffer
+    # 1. Handle low feed levels msg -> push low feed notification -> send ack msg back
+    # 2. Handle non-low feed level msg -> send ack msg back (no further action required)
+    def handle_serial_data(self, data):
+        if data == 'l'.encode():
+#            print("Feed is low! Sending notification")
+            # send push notification for low bird feed warning
+            title = 'Your birds are running out of food! ⚠️'
+            message = "Your smart bird feeder is running low on bird feed.\nMake sure to refill it soon!"
+            dispatch('notification', send_notification, title, message)
+            return
+
+        if data == 'h'.encode():
+#            print("Feed is not low yet. No notification sent")
+            return
+        # TODO: Add all other serial port data checks below here (if any)
+
+    def _prefix(self):
+        return '[{:s}] '.format(self.name) if self.name else ''
+
+
+# Drives several feeders from one thread with one loaded network. Every feeder runs its own
+# detection cycles (started by its MSP430, paced by its scheduler); the frames of all feeders
+# that are due are captured together and go through the network as one batch (DetectBatch),
+# so the network's memory is paid once and the batch amortizes each inference call.
+class FeederSupervisor:
+    # max_wait - longest sleep between checks while no feeder is in a detection cycle
+    def __init__(self, feeders, net, wake=None, max_wait=1.0):
+        self.feeders = list(feeders)
+        self.net = net
+        self.wake = wake or threading.Event()
+        self.max_wait = max_wait
+        self.batches = 0
+        self.batched_frames = 0
+
+    # Function that runs one round: starts/ends cycles, then detects on the frames that are due.
+    # Returns the number of frames processed.
+    def step(self):
+        due = []
+        for feeder in self.feeders:
+            # check if it is time to check feed levels
+            feeder.check_feed_lvl()
+            # start detection cycle if 'r' start msg is received
+            if not feeder.in_cycle and feeder.detection_requested.is_set():
+                feeder.start_cycle()
+            if not feeder.in_cycle:
+                continue
+            if feeder.scheduler.cycle_done():
+                feeder.end_cycle()
+            elif feeder.scheduler.next_frame_delay() <= 0:
+                feeder.scheduler.begin_frame()
+                due.append(feeder)
+
+        if not due:
+            self.wake.wait(self._next_wait())
+            self.wake.clear()
+            return 0
+
+        imgs = [feeder.capture() for feeder in due]
+        # feeders whose scene did not change reuse their last detections
+        to_detect = [i for i, (feeder, img) in enumerate(zip(due, imgs)) if feeder.should_detect(img)]
+        inferred = [False] * len(due)
+        if to_detect:
+            results = self.net.DetectBatch([imgs[i] for i in to_detect], overlay=due[0].overlay)
+            for i, detections in zip(to_detect, results):
+                due[i].last_detections = detections
+                inferred[i] = True
+            self.batches += 1
+            self.batched_frames += len(to_detect)
+
+        for feeder, img, frame_inferred in zip(due, imgs, inferred):
+            feeder.handle_detections(self.net, img, feeder.last_detections, frame_inferred)
+        return len(due)
+
+    def run(self):
+        while True:
+            self.step()
+
+    def stats(self):
+        return {'batches': self.batches, 'batched_frames': self.batched_frames,
+                'frames_per_batch': self.batched_frames / self.batches if self.batches else 0.0}
+
+    # Function that returns how long to sleep until some feeder needs attention
+    def _next_wait(self):
+        wait = self.max_wait
+        for feeder in self.feeders:
+            wait = min(wait, feeder.feed_check_due_in())
+            if feeder.in_cycle:
+                wait = min(wait, feeder.scheduler.next_frame_delay())
+        return max(0.0, wait)
+
+
+# Job run on the dispatch queue: encode the shot's (RGB) image to JPEG in memory, archive it
+# (if enabled) and upload it as a bird memory
+def record_bird_memory(shot, species_name, species_slug):
+    img_data = memory_encoder.encode(shot.image)
+    payload = {'species_name': species_name, 'timestamp': str(shot.timestamp)}
+    if memory_archive is not None:
+        payload['archive_id'] = memory_archive.add(img_data, species_slug, shot.confidence, shot.box, shot.timestamp)
+    deliver('bird-memory', payload, img_data)
+
+
+# Job run on the dispatch queue: push a notification to every token. The rate limiter is charged
+# here, once; the admitted tokens travel with the job, so outbox retries don't use up more of it.
+def send_notification(title, message):
+    tokens = notifier.admit(title)
+    if tokens:
+        deliver('notification', {'title': title, 'message': message, 'tokens': tokens})
+
+
+def deliver_bird_memory(payload, img_data):
+    notifier.post_bird_memory(payload['species_name'], img_data=img_data)
+    # also reached from outbox retries, so the archive learns about late uploads too
+    if memory_archive is not None and 'archive_id' in payload:
+        memory_archive.mark_uploaded(payload['archive_id'])
+
+
+# Function called by the outbox for every job it gives up on (rejected, out of attempts or evicted),
+# so the archive knows which memories never made it
+def outbox_dropped(kind, payload):
+    if kind == 'bird-memory' and memory_archive is not None and 'archive_id' in payload:
+        memory_archive.mark_failed(payload['archive_id'])
+
+
+# Function that hands the archived memories still waiting for upload (e.g. from before a restart,
+# or given up on earlier) to the outbox. Jobs the outbox still holds are not stored twice.
+# display_names - species slug -> name shown in the app
+def resync_bird_memories(display_names):
+    queued = 0
+    for memory in memory_archive.pending():
+        try:
+            img_data = memory_archive.read(memory.id)
+        except (KeyError, OSError) as exception_error:
+            print('Archived memory {:d} is unreadable ({}), skipping it'.format(memory.id, exception_error))
+            memory_archive.mark_failed(memory.id)
+            continue
+        payload = {'species_name': display_names.get(memory.species, memory.species),
+                   'timestamp': str(memory.timestamp), 'archive_id': memory.id}
+        queued += outbox.put('bird-memory', payload, img_data)
+    if queued:
+        print('Queued {:d} archived bird memories for upload'.format(queued))
+        outbox_worker.wake()
+
+
+def deliver_notification(payload, data):
+    notifier.notify(payload['title'], payload['message'], tokens=payload.get('tokens'))
+
+
+# delivery function for each kind of job, shared by the first attempt and outbox retries
+delivery_handlers = {
+    'bird-memory': deliver_bird_memory,
+    'notification': deliver_notification,
+}
+
+
+# Function that makes one delivery attempt and keeps the job in the outbox if the network fails
+def deliver(kind, payload, data=None):
+    try:
+        delivery_handlers[kind](payload, data)
+    except RequestException as exception_error:
+        if outbox is None:
+            raise
+        print('Could not deliver {:s} ({}), saving it to the outbox'.format(kind, exception_error))
+        outbox.put(kind, payload, data)
+        outbox_worker.wake()
+
+
+# Function that hands a slow side effect to the background dispatch queue
+# (falls back to running it inline if the queue has not been created)
+def dispatch(kind, fn, *args):
+    if dispatcher is None:
+        fn(*args)
+        return
+    if not dispatcher.submit(kind, fn, *args):
+        print('Dispatch queue full, dropped {:s} job'.format(kind))
 
 
-def handle_squirrel(serial_port):
-    global hatch_is_open
-
-    if hatch_is_open:
-        # closing hatch also causes the alarm to start sounding until hatch is opened again
-        close_hatch(serial_port)
-        hatch_is_open = False
+# Function that gives a host-side numpy view of a captured image (zero-copy for mapped CUDA images)
+def to_numpy(img):
+    if isinstance(img, np.ndarray):
+        return img
+    return jetson.utils.cudaToNumpy(img)
 
 
-def handle_bird(net, detections, species_names, img, species_to_ignore):
-    global counter1, species_is_novel
+# Adapter that lets the frame pipeline capture from a jetson.utils.videoSource into its ring slots
+class JetsonCaptureSource:
+    def __init__(self, input):
+        self.input = input
 
-    # this loop works only when an object (or objects) is detected
-    for detection in detections:
-        species_label = str(net.GetClassDesc(detection.ClassID))
+    def capture_into(self, slot):
+        img = self.input.Capture()
+        # GPU-side copy into the preallocated ring slot, the videoSource reuses its own buffers
+        jetson.utils.cudaMemcpy(slot, img)
+        return self.input.IsStreaming()
 
-        if detection.Confidence >= 0.90 and species_to_ignore != species_label and not species_is_novel:
-            #            print(detection)
-#            print('Processing species:', species_label)  # debug
 
-            # reassign species to ignore with the current detected species
-            species_to_ignore = species_label
-            
-            # reset counter1 so full time is waited before repeating capture of ignored species
-            counter1 = 0
-            
-            # this is a new species, so acknowledge this so it can be ingored for a while
-            species_is_novel = True
-            
-            ## handle confidently detected bird ##
-            timestamp = str(time.time())
-            save_img(img, timestamp)
-            # post saved bird memory with formatted species name
-            post_bird_memory(species_names[species_label])
-            # send push notification for newly added bird memory
-            title = 'A {:s} is at your feeder! 🐦'.format(species_names[species_label])
-            message = 'A new bird memory has been captured!\nView it in your bird memories gallery.'
-            for token in tokens:
-                send_push_message(token, title, message)
-            
-        
-        if counter1 >= (30 * 2.5):
-#            print('counter1 has reached {:d}. Now resetting counter1 and species_to_ignore'.format(
-#                counter1))
-            counter1 = 0
-            # reset species to ignore to None with the current detected species
-            species_to_ignore = None
-            species_is_novel = False
-        else:
-            counter1 += 1
-            
-    return species_to_ignore
-
-
-def should_check_feed_lvl(time1, time2):
-    # TODO: adjust wait time for low feed check
-    wait_time = 30  # waiting interval in seconds
-    return (time2 - time1) >= wait_time
-
-
-def open_hatch(serial_port):
-#    print('Start of open_hatch function')
-    open_hatch_cmd = 'o'
-    # write msg to UART serial port
-    if serial_port.in_waiting > 0:
-#        print('Data found in serial port in check #1')  # debug
-        data = serial_port.read()
-        handle_serial_data(data)
-    serial_port.write(open_hatch_cmd.encode())
-#    print('Hatch open command sent to MSP430')
-
-
-def close_hatch(serial_port):
-#    print('Start of close_hatch function')
-    close_hatch_cmd = 'c'
-    if serial_port.in_waiting > 0:
-#        print('Data found in serial port in check #2')  # debug
-        data = serial_port.read()
-        handle_serial_data(data)
-    # write msg to UART serial port
-    serial_port.write(close_hatch_cmd.encode())
-#    print('Hatch close command sent to MSP430')
-
-
-# Function handles different data that is in the serial port buffer
-# 1. Handle low feed levels msg -> push low feed notification -> send ack msg back
-# 2. Handle non-low feed level msg -> send ack msg back (no further action required)
-def handle_serial_data(data):
-    if data == 'l'.encode():
-#        print("Feed is low! Sending notification")
-        # send push notification for low bird feed warning
-        title = 'Your birds are running out of food! ⚠️'
-        message = "Your smart bird feeder is running low on bird feed.\nMake sure to refill it soon!"
-        for token in tokens:
-            send_push_message(token, title, message)
-        return
-
-    if data == 'h'.encode():
-#        print("Feed is not low yet. No notification sent")
-        return
-    # TODO: Add all other serial port data checks below here (if any)
-
-
-# Function that will write the current frame as a .jpg to local storage
-def save_img(img, timestamp):
-    cv2.imwrite("captured-bird-images/" + str('bird_memory' + ".jpeg"),
-                cv2.cvtColor(np.array(img), cv2.COLOR_BGR2RGB))
+# Function that allocates the pipeline's ring of mapped CUDA images, sized like the camera frames
+def alloc_cuda_slots(num_slots, input):
+    img = input.Capture()
+    return [jetson.utils.cudaAllocMapped(width=img.width, height=img.height, format=img.format)
+            for _ in range(num_slots)]
 
 
-def serial_config():
+def serial_config(port="/dev/ttyTHS1"):
     serial_port = serial.Serial(
-        port="/dev/ttyTHS1",
+        port=port,
         baudrate=9600,
         bytesize=serial.EIGHTBITS,
         parity=serial.PARITY_NONE,
         stopbits=serial.STOPBITS_ONE,
+        # reads block for at most this long so the reader thread can be stopped
+        timeout=0.5,
     )
     # Wait a second to let the port initialize
     time.sleep(1)
@@ -246,11 +629,93 @@ def update_title_bar(output, title):
     output.SetStatus(title)
 
 
+# Function that runs a single feeder: it sleeps until its MSP430 asks for object detection (or it is
+# time to check feed levels) and then runs a detection cycle
+# pipeline - (pipeline_source, slots) to run the cycles pipelined, False to run them frame by frame
+def run_feeder(feeder, net, pipeline=False):
+    while True:
+        # sleep until the MSP430 asks for object detection or it is time to check feed levels
+        start_detection = feeder.detection_requested.wait(feeder.feed_check_due_in())
+
+        # check if it is time to check feed levels
+        feeder.check_feed_lvl()
+
+        # check if MSP430 wants model to perform object detection
+        # start detection cycle if 'r' start msg is received
+        if start_detection:
+            if pipeline:
+                feeder.run_pipelined_cycle(net, *pipeline)
+            else:
+                feeder.run_cycle(net)
+
+
+# Function that creates the video source & output of a feeder
+def create_video(opt, input_URI, output_URI, is_headless):
+    if jetson is not None:
+        input = jetson.utils.videoSource(input_URI, argv=sys.argv)
+        output = jetson.utils.videoOutput(output_URI, argv=sys.argv + is_headless)
+    else:
+        # a directory of images, a video file or 'synthetic', played back as the camera
+        input = SourceInput(create_source(input_URI, loop=True), opt.input_height, opt.input_width)
+        output = NullOutput()
+    return input, output
+
+
+# Function that creates a feeder with its own link, scheduler, tracker etc. configured from the command line
+def create_feeder(opt, name, input, output, serial_port, class_table, species_cooldown_overrides, wake=None):
+    # skip inference on frames where nothing moved
+    motion_gate = None
+    if opt.motion_min_area > 0:
+        motion_gate = MotionGate(scale=opt.motion_scale, pixel_threshold=opt.motion_threshold,
+                                 min_changed_fraction=opt.motion_min_area,
+                                 keyframe_interval=opt.keyframe_interval)
+
+    # frame rate and length of detection cycles follow the activity in the scene
+    scheduler = ActivityScheduler(active_fps=opt.active_fps, idle_fps=opt.idle_fps, idle_after=opt.idle_after,
+                                  quiet_timeout=opt.quiet_timeout, trigger_hold=opt.trigger_hold,
+                                  squirrel_hold=opt.squirrel_hold, max_cycle=opt.max_cycle)
+
+    # act on objects confirmed over several frames instead of single-frame hits
+    tracker = None
+    if opt.track_min_hits > 0:
+        tracker = IouTracker(iou_threshold=opt.track_iou, smoothing=opt.track_smoothing,
+                             min_hits=opt.track_min_hits, max_misses=opt.track_max_misses)
+
+    # one bird memory per visit, picked from the best few frames of that visit
+    best_shots = BestShotSelector(max_candidates=opt.best_shot_candidates,
+                                  crop_margin=opt.best_shot_margin if opt.best_shot_margin >= 0 else None)
+
+    # every species gets at most one bird memory per cooldown, wherever its visits are interleaved
+    species_cooldowns = CooldownMap(cooldown=opt.species_cooldown, cooldowns=species_cooldown_overrides,
+                                    max_keys=len(class_table.classes))
+
+    # all commands to the MSP430 go through the link's send queue
+    uart_link = CommandLink(serial_port, CODECS[opt.uart_protocol]())
+
+    return Feeder(name, input, output, serial_port, uart_link, class_table, scheduler, best_shots,
+                  species_cooldowns, tracker=tracker, motion_gate=motion_gate, overlay=opt.overlay,
+                  network=opt.network, wake=wake, hatch_reopen_delay=opt.hatch_reopen_delay)
+
+
+# Function that reads the feeders of a multi-feeder site: a JSON list of
+# {"name": ..., "input": ..., "output": ..., "serial_port": ...}
+def load_feeder_configs(path):
+    with open(path) as config_file:
+        configs = json.load(config_file)
+    names = [config['name'] for config in configs]
+    if len(set(names)) != len(names):
+        raise ValueError("Feeder names must be unique")
+    return configs
+
+
 if __name__ == '__main__':
     # parse the command line
+    epilog = ""
+    if jetson is not None:
+        epilog = jetson.inference.detectNet.Usage() + jetson.utils.videoSource.Usage() + \
+            jetson.utils.videoOutput.Usage() + jetson.utils.logUsage()
     parser = argparse.ArgumentParser(description="Locate objects in a live camera stream using an object detection DNN.",
-                                     formatter_class=argparse.RawTextHelpFormatter, epilog=jetson.inference.detectNet.Usage() +
-                                     jetson.utils.videoSource.Usage() + jetson.utils.videoOutput.Usage() + jetson.utils.logUsage())
+                                     formatter_class=argparse.RawTextHelpFormatter, epilog=epilog)
 
     parser.add_argument("input_URI", type=str, default="",
                         nargs='?', help="URI of the input stream")
@@ -262,6 +727,112 @@ if __name__ == '__main__':
                         help="detection overlay flags (e.g. --overlay=labels,conf)\nvalid combinations are:  'box', 'labels', 'conf', 'none'")
     parser.add_argument("--threshold", type=float, default=0.75,
                         help="minimum detection threshold to use")
+    parser.add_argument("--backend", type=str, default="jetson" if jetson is not None else "onnx", choices=BACKENDS,
+                        help="detector backend: 'jetson' (TensorRT detectNet) or 'onnx' (ONNX Runtime on the CPU)")
+    parser.add_argument("--model", type=str, default="",
+                        help="path to the ONNX model (also read by detectNet for custom models)")
+    parser.add_argument("--labels", type=str, default="",
+                        help="path to the model's labels.txt (also read by detectNet for custom models)")
+    parser.add_argument("--raw-outputs", action='store_true',
+                        help="the ONNX model was exported with onnx_export.py --raw-outputs (onnx backend only)")
+    parser.add_argument("--decision-threshold", type=float, default=0.90,
+                        help="minimum confidence for a squirrel/bird detection to be acted on")
+    parser.add_argument("--class-thresholds", type=str, default="",
+                        help="per-class overrides of --decision-threshold (e.g. --class-thresholds=squirrel=0.8,blue-jay=0.85)")
+    parser.add_argument("--active-fps", type=float, default=0,
+                        help="detection rate while something is in front of the camera (0 = as fast as possible)")
+    parser.add_argument("--idle-fps", type=float, default=5,
+                        help="detection rate once the scene has been quiet for --idle-after seconds")
+    parser.add_argument("--idle-after", type=float, default=1.0,
+                        help="seconds without detections before dropping to --idle-fps")
+    parser.add_argument("--quiet-timeout", type=float, default=8.0,
+                        help="seconds without detections after which a detection cycle ends")
+    parser.add_argument("--trigger-hold", type=float, default=4.0,
+                        help="seconds the MSP430 trigger counts as held after its last 'r' (the cycle ends early once it clears)")
+    parser.add_argument("--squirrel-hold", type=float, default=5.0,
+                        help="seconds to stay at the full rate after a squirrel was seen")
+    parser.add_argument("--max-cycle", type=float, default=120.0,
+                        help="maximum length of a detection cycle in seconds (0 = no limit)")
+    parser.add_argument("--hatch-reopen-delay", type=float, default=5.0,
+                        help="seconds without a squirrel before the closed hatch opens again")
+    parser.add_argument("--species-cooldown", type=float, default=120.0,
+                        help="seconds after a bird memory before the same species is recorded again")
+    parser.add_argument("--species-cooldowns", type=str, default="",
+                        help="per-species overrides of --species-cooldown (e.g. --species-cooldowns=blue-jay=300,cardinal=60)")
+    parser.add_argument("--notify-per-hour", type=float, default=20,
+                        help="push notifications per hour each token may receive once its burst is used up (0 = no limit)")
+    parser.add_argument("--notify-burst", type=int, default=5,
+                        help="push notifications a token may receive at once")
+    parser.add_argument("--best-shot-candidates", type=int, default=4,
+                        help="number of candidate crops kept per bird visit for picking its memory")
+    parser.add_argument("--best-shot-margin", type=float, default=0.5,
+                        help="margin around the bird kept in its memory, relative to the box size (negative = whole frame)")
+    parser.add_argument("--memory-quality", type=int, default=90,
+                        help="JPEG quality (0-100) of uploaded bird memories")
+    parser.add_argument("--memory-max-size", type=int, default=0,
+                        help="longer side of uploaded bird memories in pixels (0 = keep the size of the shot)")
+    parser.add_argument("--memory-archive-dir", type=str, default="",
+                        help="keep every bird memory in a local archive in this directory, e.g. ./captured-bird-images (default: off)")
+    parser.add_argument("--archive-max-mb", type=float, default=512,
+                        help="max disk space used by the archive, least recently used images are evicted past this")
+    parser.add_argument("--archive-max-days", type=float, default=30,
+                        help="days a memory is kept in the archive (0 = forever)")
+    parser.add_argument("--track-min-hits", type=int, default=3,
+                        help="frames an object has to be tracked on before it is acted on (0 = act on single frames)")
+    parser.add_argument("--track-max-misses", type=int, default=5,
+                        help="frames a track survives without a matching detection")
+    parser.add_argument("--track-iou", type=float, default=0.3,
+                        help="minimum box overlap for a detection to continue a track")
+    parser.add_argument("--track-smoothing", type=float, default=0.5,
+                        help="weight of the newest confidence in a track's moving average (1 = no smoothing)")
+    parser.add_argument("--num-threads", type=int, default=0,
+                        help="CPU threads used by the onnx backend (0 = ONNX Runtime default)")
+    parser.add_argument("--input-width", type=int, default=1280,
+                        help="frame width when reading images/video without jetson.utils")
+    parser.add_argument("--input-height", type=int, default=720,
+                        help="frame height when reading images/video without jetson.utils")
+    parser.add_argument("--serial-port", type=str, default="/dev/ttyTHS1",
+                        help="UART device connected to the MSP430")
+    parser.add_argument("--feeders", type=str, default="",
+                        help="JSON file listing several feeders to run with one shared network, e.g.\n"
+                             "[{\"name\": \"front\", \"input\": \"csi://0\", \"serial_port\": \"/dev/ttyTHS1\"}, ...]\n"
+                             "(replaces input_URI, output_URI and --serial-port)")
+    parser.add_argument("--dispatch-queue-size", type=int, default=16,
+                        help="max number of upload/notification jobs waiting in the background queue")
+    parser.add_argument("--dispatch-workers", type=int, default=2,
+                        help="number of background threads running upload/notification jobs")
+    parser.add_argument("--dispatch-drop-policy", type=str, default=DROP_OLDEST, choices=DROP_POLICIES,
+                        help="what to do with a new job when the background queue is full")
+    parser.add_argument("--dispatch-drain-timeout", type=float, default=10.0,
+                        help="seconds to wait for queued jobs to finish on shutdown")
+    parser.add_argument("--motion-min-area", type=float, default=0.005,
+                        help="fraction of changed pixels needed to run the detector on a frame (0 = run on every frame)")
+    parser.add_argument("--motion-threshold", type=int, default=15,
+                        help="brightness change (0-255) for a pixel to count as changed")
+    parser.add_argument("--motion-scale", type=int, default=8,
+                        help="downscale factor applied to frames before comparing them")
+    parser.add_argument("--keyframe-interval", type=int, default=15,
+                        help="run the detector at least every N frames even without motion")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="run capture, inference and decisions concurrently (latest frame wins)")
+    parser.add_argument("--pipeline-slots", type=int, default=4,
+                        help="number of preallocated frames in the pipeline's ring buffer")
+    parser.add_argument("--uart-protocol", type=str, default="legacy", choices=list(CODECS),
+                        help="MSP430 wire format: 'legacy' single bytes (current firmware) or 'framed' acknowledged frames")
+    parser.add_argument("--outbox-path", type=str, default="outbox.sqlite3",
+                        help="SQLite file holding uploads/notifications waiting to be retried")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics on this port at /metrics (0 = off)")
+    parser.add_argument("--metrics-log", type=str, default="",
+                        help="append a JSON line with all metrics to this file every --metrics-interval seconds ('-' = stdout)")
+    parser.add_argument("--metrics-interval", type=float, default=60.0,
+                        help="seconds between JSON metrics lines")
+    parser.add_argument("--outbox-max-mb", type=float, default=64,
+                        help="max disk space used by the outbox, oldest jobs are evicted past this")
+    parser.add_argument("--outbox-max-attempts", type=int, default=20,
+                        help="delivery attempts before an outbox job is dropped (0 = retry forever)")
+    parser.add_argument("--outbox-max-age", type=float, default=168,
+                        help="hours after which an outbox job that still fails is dropped (0 = no limit)")
 
     is_headless = [
         "--headless"] if sys.argv[0].find('console.py') != -1 else [""]
@@ -273,46 +844,93 @@ if __name__ == '__main__':
         parser.print_help()
         sys.exit(0)
 
-    # load the object detection network
-    net = jetson.inference.detectNet(opt.network, sys.argv, opt.threshold)
-
-    # create video sources & outputs
-    input = jetson.utils.videoSource(opt.input_URI, argv=sys.argv)
-    output = jetson.utils.videoOutput(
-        opt.output_URI, argv=sys.argv+is_headless)
-
-    # setup serial communication
-    serial_port = serial_config()
-
-    # dict for bird species labels to formatted names
-    species_names = {
-        'american-crow': 'american crow',
-        'blue-jay': 'blue jay',
-        'blue-gray-gnatcatcher': 'blue gray gnatcatcher',
-        'carolina-wren': 'carolina wren',
-        'common-grackle': 'common grackle',
-        'downy-woodpecker': 'downy woodpecker',
-        'gray-catbird': 'gray catbird',
-        'green-cheeked-parakeet': 'green-cheeked parakeet',
-        'mourning-dove': 'mourning dove',
-        'cardinal': 'northern cardinal',
-        'northern-mockingbird': 'northern mockingbird',
-        'palm-warbler': 'palm warbler',
-        'pileated-woodpecker': 'pileated woodpecker',
-        'red-bellied-woodpecker': 'red-bellied woodpecker',
-        'tufted-titmouse': 'tufted titmouse',
-        'yellow-rumped-warbler': 'yellow-rumped warbler',
-        'squirrel': 'squirrel'
-    }
-
-    # Set species to ignore to None to start off with so that no species is initially ignored.
-    # This keeps track of what the last bird detected was.
-    species_to_ignore = None
-
-#    print('Performing initial hatch open process')
-    # initially, open the feed door, set hatch opened flag
-    open_hatch(serial_port)
-    hatch_is_open = True
+    # load the object detection network (once, shared by every feeder of this process)
+    net = create_detector(opt.backend, opt.network, sys.argv, opt.threshold,
+                          model=opt.model, labels=opt.labels, num_threads=opt.num_threads,
+                          raw_outputs=opt.raw_outputs)
+
+    # labels of the loaded model resolved once to display names, squirrel flags and thresholds
+    class_table = ClassTable.from_net(net, threshold=opt.decision_threshold,
+                                      class_thresholds=parse_label_values(opt.class_thresholds))
+    species_cooldown_overrides = parse_label_values(opt.species_cooldowns)
+    unknown = set(species_cooldown_overrides) - set(info.slug for info in class_table.classes)
+    if unknown:
+        raise ValueError("Cooldowns given for unknown labels: " + ', '.join(sorted(unknown)))
+
+    # one camera + MSP430 from the command line, or every feeder of the site from --feeders
+    if opt.feeders:
+        feeder_configs = load_feeder_configs(opt.feeders)
+        if opt.pipeline:
+            print('--pipeline is ignored with --feeders, the feeders share batched inference instead')
+    else:
+        feeder_configs = [{'name': '', 'input': opt.input_URI, 'output': opt.output_URI,
+                           'serial_port': opt.serial_port}]
+
+    # set by any feeder's serial reader whenever its MSP430 asks for detection
+    wake = threading.Event()
+    feeders = []
+    for config in feeder_configs:
+        # create video sources & outputs, setup serial communication
+        input, output = create_video(opt, config.get('input', ''), config.get('output', ''), is_headless)
+        serial_port = serial_config(config['serial_port'])
+        feeders.append(create_feeder(opt, config['name'], input, output, serial_port, class_table,
+                                     species_cooldown_overrides, wake=wake))
+
+    # ring of preallocated frames for pipelined detection cycles
+    if opt.pipeline and not opt.feeders and jetson is not None:
+        pipeline_source = JetsonCaptureSource(feeders[0].input)
+        pipeline_slots = alloc_cuda_slots(opt.pipeline_slots, feeders[0].input)
+    elif opt.pipeline and not opt.feeders:
+        pipeline_source = feeders[0].input.source
+        pipeline_slots = alloc_numpy_slots(opt.pipeline_slots, opt.input_height, opt.input_width)
+
+    # bird memories are encoded in memory, the disk archive is opt-in
+    memory_encoder = MemoryEncoder(quality=opt.memory_quality, max_size=opt.memory_max_size)
+    if opt.memory_archive_dir:
+        memory_archive = MemoryArchive(opt.memory_archive_dir, max_bytes=int(opt.archive_max_mb * 1024 * 1024),
+                                       max_age=opt.archive_max_days * 24 * 3600)
+        print('{:d} bird memories in the archive, {:d} waiting for upload'.format(
+            len(memory_archive), len(memory_archive.pending())))
+
+    # one notifier (and its pooled sessions) shared by every upload/notification job,
+    # each token gets at most --notify-burst pushes at once and --notify-per-hour after that
+    notify_limiter = None
+    if opt.notify_per_hour > 0:
+        notify_limiter = KeyedRateLimiter(rate=opt.notify_per_hour / 3600.0, burst=opt.notify_burst)
+    notifier = Notifier(tokens, rate_limiter=notify_limiter)
+
+    # failed deliveries are kept on disk and retried with backoff until the network is back
+    outbox = Outbox(opt.outbox_path, max_bytes=int(opt.outbox_max_mb * 1024 * 1024),
+                    max_attempts=opt.outbox_max_attempts, max_age=opt.outbox_max_age * 3600,
+                    on_drop=outbox_dropped)
+    outbox_worker = OutboxWorker(outbox, delivery_handlers)
+    outbox_worker.start()
+    if memory_archive is not None:
+        resync_bird_memories({info.slug: info.display_name for info in class_table.classes})
+
+    # start the background upload/notification workers
+    dispatcher = DispatchQueue(max_size=opt.dispatch_queue_size, num_workers=opt.dispatch_workers,
+                               drop_policy=opt.dispatch_drop_policy)
+
+    # open the hatches and start listening to the MSP430s
+    for feeder in feeders:
+        feeder.start()
+
+    # queue depths are read from their owners whenever metrics are exported
+    METRICS.register('dispatch_queue_depth', dispatcher.depth, help='Upload/notification jobs waiting to run.')
+    METRICS.register('dispatch_dropped', lambda: dispatcher.stats.dropped, kind='counter',
+                     help='Upload/notification jobs dropped because the queue was full.')
+    METRICS.register('outbox_depth', lambda: len(outbox), help='Deliveries waiting to be retried.')
+    metrics_server = None
+    if opt.metrics_port:
+        metrics_server = MetricsServer(port=opt.metrics_port)
+        metrics_server.start()
+    metrics_logger = None
+    if opt.metrics_log:
+        metrics_logger = JsonLineLogger(opt.metrics_log, interval=opt.metrics_interval)
+        metrics_logger.start()
+
+    supervisor = FeederSupervisor(feeders, net, wake=wake) if opt.feeders else None
 
     try:
         # wait for WIFI connection to establish
@@ -320,96 +938,19 @@ if __name__ == '__main__':
         # send push notification to tell user that the feeder has powered on
         title = 'The Smart Bird Feeder is now online! 🔋'
         message = "Your smart bird feeder is now powered on and ready for use!"
-        for token in tokens:
-            send_push_message(token, title, message)
-        
-        if serial_port.in_waiting > 0:
-#            print('Data found in serial port in check #7')  # debug
-            data = serial_port.read()
-            handle_serial_data(data)
-        # ask msp430 to read ultrasonic data and tell us if feed is low
-        serial_port.write('u'.encode())
-#        print("'u' is sent #1")
-
-        # capture initial time to track when the ultrasonic sensor should next be pulsed
-        time1 = time.time()
-
-        while True:
-            time2 = time.time()
+        dispatch('notification', send_notification, title, message)
 
-            data = ""
-
-            # check if it is time to check feed levels
-            if should_check_feed_lvl(time1, time2):
-                if serial_port.in_waiting > 0:
-#                    print('Data found in serial port in check #3')  # debug
-                    data = serial_port.read()
-                    handle_serial_data(data)
-                # ask msp430 to read ultrasonic data and tell us if feed is low
-                serial_port.write('u'.encode())
-#                print("'u' is sent #2")
-                # reset waiting time for next pulse to ultrasonic
-                time1 = time.time()
-
-            # check if UART response indicates low feed
-            # handle_serial_data(data)
-
-            # TODO: ensure that this block executes
-            if serial_port.in_waiting > 0:
-#                print('Data found in serial port in check #4')  # debug
-                data = serial_port.read()
-                handle_serial_data(data)
-
-            # check if MSP430 wants model to perform object detection
-            # start detection cycle if 'r' start msg is received
-            if data == 'r'.encode():
-#            if True:
-#                print("'r' received! Starting detection cycle...")
-                # loop for a number of cycles/frames, then stop detection cyce to save resources
-                while detection_cycle_counter < (30 * 8):
-#                while True:
-#                    print('detection_cycles_cntr is {:d}'.format(detection_cycle_counter))
-                    # read serial port for stop message (received when MCU's sensor stops detecting objects)
-                    if serial_port.in_waiting > 0:
-#                        print('Data found in serial port in check #5')  # debug
-                        data = serial_port.read()
-                        handle_serial_data(data)
-                    else:
-                        time2 = time.time()
-
-                        # TODO: this is duplicate code. Figure out a way to refactor this.
-                        # check if it is time to check feed levels
-                        if should_check_feed_lvl(time1, time2):
-                            if serial_port.in_waiting > 0:
-                                # debug
-#                                print('Data found in serial port in check #6')
-                                data = serial_port.read()
-                                handle_serial_data(data)
-                            # ask msp430 to read ultrasonic data and tell us if feed is low
-                            serial_port.write('u'.encode())
-#                            print("'u' is sent")
-                            # reset waiting time for next pulse to ultrasonic
-                            time1 = time.time()
-
-                        species_to_ignore = run_obj_detection(
-                            input, output, net, opt, serial_port, species_names, species_to_ignore)
-                            
-                    detection_cycle_counter += 1
-#                print('detection loop has ended')
-                detection_cycle_counter = 0
-                time.sleep(1)
-            elif serial_port.in_waiting > 0:
-##                print('Data found in serial port check #9!')
-                data = serial_port.read()
-                handle_serial_data(data)
-            
-            # tell the MSP430 that detection is not running
-            # make sure to check for data in serial port before writing to it
-            if serial_port.in_waiting > 0:
-#                print('Data found in serial port in check #8')  # debug
-                data = serial_port.read()
-                handle_serial_data(data)
-            serial_port.write('s'.encode())
+        # ask msp430 to read ultrasonic data and tell us if feed is low
+        for feeder in feeders:
+            feeder.request_feed_check()
+            # capture initial time to track when the ultrasonic sensor should next be pulsed
+            feeder.last_feed_check = time.time()
+
+        if supervisor is not None:
+            # every feeder's detection cycles are driven from here, with batched inference
+            supervisor.run()
+        else:
+            run_feeder(feeders[0], net, opt.pipeline and (pipeline_source, pipeline_slots))
             
     except KeyboardInterrupt:
         print("Exiting Program")
@@ -419,5 +960,21 @@ if __name__ == '__main__':
         print("Error: " + str(exception_error))
 
     finally:
-        serial_port.close()
-        pass
+        for feeder in feeders:
+            feeder.stop()
+        if supervisor is not None:
+            print('Supervisor stats: {}'.format(supervisor.stats()))
+        if metrics_logger is not None:
+            metrics_logger.stop(timeout=1)
+        if metrics_server is not None:
+            metrics_server.stop(timeout=1)
+        # let queued uploads/notifications finish before exiting
+        dispatcher.shutdown(drain=True, timeout=opt.dispatch_drain_timeout)
+        print('Dispatch queue stats: {}'.format(dispatcher.stats.as_dict()))
+        # anything still in the outbox is retried on the next start
+        outbox_worker.stop(timeout=opt.dispatch_drain_timeout)
+        print('{:d} job(s) left in the outbox'.format(len(outbox)))
+        outbox.close()
+        if memory_archive is not None:
+            memory_archive.close()
+        notifier.close()
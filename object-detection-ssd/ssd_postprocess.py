@@ -0,0 +1,329 @@
+#
+# NumPy SSD pre/post-processing for models exported by onnx_export.py: input normalization,
+# prior generation, location decoding and class-wise non-maximum suppression.
+# (mirrors vision/utils/box_utils.py from the training code, without torch)
+#
+import collections
+import itertools
+import math
+
+import cv2
+import numpy as np
+
+SSDBoxSizes = collections.namedtuple('SSDBoxSizes', ['min', 'max'])
+SSDSpec = collections.namedtuple('SSDSpec', ['feature_map_size', 'shrinkage', 'box_sizes', 'aspect_ratios'])
+
+# same values as vision/ssd/config/mobilenetv1_ssd_config.py (also used by mb2-ssd-lite)
+IMAGE_SIZE = 300
+IMAGE_MEAN = 127.0
+IMAGE_STD = 128.0
+CENTER_VARIANCE = 0.1
+SIZE_VARIANCE = 0.2
+
+MOBILENET_SSD_SPECS = [
+    SSDSpec(19, 16, SSDBoxSizes(60, 105), [2, 3]),
+    SSDSpec(10, 32, SSDBoxSizes(105, 150), [2, 3]),
+    SSDSpec(5, 64, SSDBoxSizes(150, 195), [2, 3]),
+    SSDSpec(3, 100, SSDBoxSizes(195, 240), [2, 3]),
+    SSDSpec(2, 150, SSDBoxSizes(240, 285), [2, 3]),
+    SSDSpec(1, 300, SSDBoxSizes(285, 330), [2, 3]),
+]
+
+
+# Function that turns an RGB HxWxC image into the normalized 1x3xHxW float tensor the SSD expects
+def preprocess_image(img, width=IMAGE_SIZE, height=IMAGE_SIZE, mean=IMAGE_MEAN, std=IMAGE_STD):
+    resized = cv2.resize(np.asarray(img)[..., :3], (width, height))
+    tensor = (resized.astype(np.float32) - mean) / std
+    return tensor.transpose(2, 0, 1)[np.newaxis]
+
+
+# Function that generates the SSD prior boxes in center form (cx, cy, w, h), normalized to 0-1
+def generate_priors(specs=MOBILENET_SSD_SPECS, image_size=IMAGE_SIZE, clamp=True):
+    priors = []
+    for spec in specs:
+        scale = image_size / spec.shrinkage
+        for j, i in itertools.product(range(spec.feature_map_size), repeat=2):
+            x_center = (i + 0.5) / scale
+            y_center = (j + 0.5) / scale
+
+            # small sized square box
+            size = spec.box_sizes.min
+            h = w = size / image_size
+            priors.append([x_center, y_center, w, h])
+
+            # big sized square box
+            size = math.sqrt(spec.box_sizes.max * spec.box_sizes.min)
+            h = w = size / image_size
+            priors.append([x_center, y_center, w, h])
+
+            # change h/w ratio of the small sized box
+            size = spec.box_sizes.min
+            h = w = size / image_size
+            for ratio in spec.aspect_ratios:
+                ratio = math.sqrt(ratio)
+                priors.append([x_center, y_center, w * ratio, h / ratio])
+                priors.append([x_center, y_center, w / ratio, h * ratio])
+
+    priors = np.array(priors, dtype=np.float32)
+    if clamp:
+        np.clip(priors, 0.0, 1.0, out=priors)
+    return priors
+
+
+# Function that decodes regression outputs (..., N, 4) against center form priors (N, 4)
+def convert_locations_to_boxes(locations, priors, center_variance=CENTER_VARIANCE, size_variance=SIZE_VARIANCE):
+    return np.concatenate([
+        locations[..., :2] * center_variance * priors[..., 2:] + priors[..., :2],
+        np.exp(locations[..., 2:] * size_variance) * priors[..., 2:]
+    ], axis=-1)
+
+
+def center_form_to_corner_form(boxes):
+    return np.concatenate([boxes[..., :2] - boxes[..., 2:] / 2,
+                           boxes[..., :2] + boxes[..., 2:] / 2], axis=-1)
+
+
+def softmax(x, axis=-1):
+    exp = np.exp(x - x.max(axis=axis, keepdims=True))
+    return exp / exp.sum(axis=axis, keepdims=True)
+
+
+def area_of(left_top, right_bottom):
+    hw = np.clip(right_bottom - left_top, 0.0, None)
+    return hw[..., 0] * hw[..., 1]
+
+
+# Function that returns the intersection over union of corner form boxes (broadcasting)
+def iou_of(boxes0, boxes1, eps=1e-5):
+    overlap_left_top = np.maximum(boxes0[..., :2], boxes1[..., :2])
+    overlap_right_bottom = np.minimum(boxes0[..., 2:], boxes1[..., 2:])
+
+    overlap_area = area_of(overlap_left_top, overlap_right_bottom)
+    area0 = area_of(boxes0[..., :2], boxes0[..., 2:])
+    area1 = area_of(boxes1[..., :2], boxes1[..., 2:])
+    return overlap_area / (area0 + area1 - overlap_area + eps)
+
+
+# Greedy NMS on (K, 5) rows of corner form box + score, returns the kept rows
+def hard_nms(box_scores, iou_threshold, top_k=-1, candidate_size=200):
+    scores = box_scores[:, -1]
+    boxes = box_scores[:, :-1]
+    picked = []
+    indexes = np.argsort(scores)[::-1][:candidate_size]
+    while len(indexes) > 0:
+        current = indexes[0]
+        picked.append(current)
+        if 0 < top_k == len(picked) or len(indexes) == 1:
+            break
+        current_box = boxes[current]
+        indexes = indexes[1:]
+        iou = iou_of(boxes[indexes], current_box[np.newaxis])
+        indexes = indexes[iou <= iou_threshold]
+    return box_scores[picked]
+
+
+# Function that filters one image's scores (N, C) and corner form boxes (N, 4) into final
+# detections. Class 0 is the background. Returns (boxes (K, 4), labels (K,), probs (K,)).
+def postprocess(scores, boxes, prob_threshold=0.5, iou_threshold=0.45, top_k=-1, candidate_size=200):
+    picked_box_scores = []
+    picked_labels = []
+    for class_index in range(1, scores.shape[1]):
+        probs = scores[:, class_index]
+        mask = probs > prob_threshold
+        if not mask.any():
+            continue
+        box_scores = np.concatenate([boxes[mask], probs[mask, np.newaxis]], axis=1)
+        box_scores = hard_nms(box_scores, iou_threshold, top_k, candidate_size)
+        picked_box_scores.append(box_scores)
+        picked_labels.extend([class_index] * box_scores.shape[0])
+
+    if not picked_box_scores:
+        return np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    picked_box_scores = np.concatenate(picked_box_scores)
+    return picked_box_scores[:, :4], np.array(picked_labels, dtype=np.int64), picked_box_scores[:, 4]
+
+
+# Function that turns raw network outputs (exported without is_test) into probabilities and
+# corner form boxes, for any number of leading batch dimensions
+def decode(raw_scores, raw_locations, priors, center_variance=CENTER_VARIANCE, size_variance=SIZE_VARIANCE):
+    boxes = convert_locations_to_boxes(raw_locations, priors, center_variance, size_variance)
+    return softmax(raw_scores), center_form_to_corner_form(boxes)
+
+
+# Function that returns each element's rank inside its group, for an array already sorted by group
+def rank_within_groups(sorted_groups):
+    if len(sorted_groups) == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    counts = np.diff(np.r_[starts, len(sorted_groups)])
+    return np.arange(len(sorted_groups)) - np.repeat(starts, counts)
+
+
+# Greedy NMS for many groups at once. boxes (G, S, 4) holds each group's boxes sorted by
+# descending score, padded to S; valid (G, S) marks the real ones. Returns a (G, S) keep mask.
+# The IoU matrices of all groups are computed in one shot and the greedy pass walks the S
+# positions once, handling every group in parallel.
+def batched_greedy_nms(boxes, valid, iou_threshold):
+    keep = np.zeros_like(valid)
+    if boxes.size == 0:
+        return keep
+
+    iou = iou_of(boxes[:, :, np.newaxis], boxes[:, np.newaxis])
+    # only a higher scoring box (earlier position) can suppress a lower one
+    suppress = np.triu(iou > iou_threshold, k=1)
+
+    suppressed = ~valid
+    for i in range(boxes.shape[1]):
+        keep[:, i] = ~suppressed[:, i]
+        suppressed |= suppress[:, i] & keep[:, i, np.newaxis]
+    return keep
+
+
+# Vectorized version of postprocess() for a whole batch: scores (B, N, C), corner form boxes (B, N, 4).
+# Thresholding, candidate selection, NMS and top-k are done for every (image, class) group at once
+# by laying the candidates out as a padded (groups, candidate_size) array.
+# Returns a list with (boxes, labels, probs) per image, in the same order as postprocess().
+def batched_postprocess(scores, boxes, prob_threshold=0.5, iou_threshold=0.45, top_k=-1, candidate_size=200):
+    batch_size, num_priors, num_classes = scores.shape
+
+    # per class score thresholding (class 0 is the background)
+    image_index, prior_index, class_index = np.nonzero(scores[:, :, 1:] > prob_threshold)
+    class_index += 1
+    probs = scores[image_index, prior_index, class_index]
+    candidate_boxes = boxes[image_index, prior_index]
+    groups = image_index * num_classes + class_index
+
+    # sort by (image, class, descending score) and keep the candidate_size best of every group
+    order = np.lexsort((-probs, groups))
+    ranks = rank_within_groups(groups[order])
+    order, ranks = order[ranks < candidate_size], ranks[ranks < candidate_size]
+
+    # scatter the candidates into a padded (group, rank) layout and run NMS on all groups at once
+    _, group_slots = np.unique(groups[order], return_inverse=True)
+    num_groups = group_slots.max() + 1 if len(order) else 0
+    padded_size = ranks.max() + 1 if len(order) else 0
+    padded_boxes = np.zeros((num_groups, padded_size, 4), dtype=boxes.dtype)
+    valid = np.zeros((num_groups, padded_size), dtype=bool)
+    padded_boxes[group_slots, ranks] = candidate_boxes[order]
+    valid[group_slots, ranks] = True
+
+    keep = batched_greedy_nms(padded_boxes, valid, iou_threshold)
+    if top_k > 0:
+        keep &= np.cumsum(keep, axis=1) <= top_k
+    kept = order[keep[group_slots, ranks]]
+
+    # split the flat result (still sorted by image) back into one entry per image
+    splits = np.searchsorted(image_index[kept], np.arange(1, batch_size))
+    return [(candidate_boxes[indexes], class_index[indexes].astype(np.int64), probs[indexes])
+            for indexes in np.split(kept, splits)]
+
+
+# Function that post-processes the output of a model exported with the NMS fused into the graph
+# (onnx_tools.fuse_nms). selected_indices holds (image, label, prior) rows of the kept boxes,
+# the result has the same layout as batched_postprocess (sorted by label, then score).
+def select_postprocess(scores, boxes, selected_indices, prob_threshold=0.5, top_k=-1):
+    image_index, class_index, prior_index = np.asarray(selected_indices, dtype=np.int64).T
+    probs = scores[image_index, prior_index, class_index]
+
+    order = np.lexsort((-probs, class_index, image_index))
+    order = order[probs[order] > prob_threshold]
+    if top_k > 0:
+        groups = image_index[order] * scores.shape[2] + class_index[order]
+        order = order[rank_within_groups(groups) < top_k]
+
+    splits = np.searchsorted(image_index[order], np.arange(1, scores.shape[0]))
+    return [(boxes[image_index[indexes], prior_index[indexes]], class_index[indexes], probs[indexes])
+            for indexes in np.split(order, splits)]
+
+
+# Reference implementation: per-box, per-class Python loops (what a straightforward port would do)
+def naive_postprocess(scores, boxes, prob_threshold=0.5, iou_threshold=0.45, top_k=-1, candidate_size=200):
+    def iou(a, b):
+        width = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+        height = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+        overlap = width * height
+        area_a = max(0.0, a[2] - a[0]) * max(0.0, a[3] - a[1])
+        area_b = max(0.0, b[2] - b[0]) * max(0.0, b[3] - b[1])
+        return overlap / (area_a + area_b - overlap + 1e-5)
+
+    results = []
+    for image_scores, image_boxes in zip(scores.tolist(), boxes.tolist()):
+        candidates = {}
+        for box, box_scores in zip(image_boxes, image_scores):
+            for class_index in range(1, len(box_scores)):
+                if box_scores[class_index] > prob_threshold:
+                    candidates.setdefault(class_index, []).append((box_scores[class_index], box))
+
+        picked_boxes, picked_labels, picked_probs = [], [], []
+        for class_index in sorted(candidates):
+            remaining = sorted(candidates[class_index], key=lambda item: -item[0])[:candidate_size]
+            picked = []
+            while remaining:
+                best = remaining.pop(0)
+                picked.append(best)
+                if 0 < top_k == len(picked):
+                    break
+                remaining = [item for item in remaining if iou(item[1], best[1]) <= iou_threshold]
+            for prob, box in picked:
+                picked_boxes.append(box)
+                picked_labels.append(class_index)
+                picked_probs.append(prob)
+
+        results.append((np.array(picked_boxes, dtype=np.float32).reshape(-1, 4),
+                        np.array(picked_labels, dtype=np.int64),
+                        np.array(picked_probs, dtype=np.float32)))
+    return results
+
+
+# Main function: micro-benchmark of the vectorized post-processing against the loop versions
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Benchmark SSD post-processing implementations.")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--num-classes", type=int, default=18, help="including BACKGROUND")
+    parser.add_argument("--threshold", type=float, default=0.3)
+    parser.add_argument("--runs", type=int, default=10)
+    opt = parser.parse_args()
+
+    priors = generate_priors()
+    rng = np.random.default_rng(0)
+    # mostly background, like a real frame, with a tail of confident foreground boxes
+    raw_scores = rng.normal(size=(opt.batch_size, len(priors), opt.num_classes)).astype(np.float32) * 2.0
+    raw_scores[:, :, 0] += 3.0
+    raw_locations = rng.normal(size=(opt.batch_size, len(priors), 4)).astype(np.float32) * 0.5
+
+    start = time.perf_counter()
+    for _ in range(opt.runs):
+        scores, boxes = decode(raw_scores, raw_locations, priors)
+    decode_time = (time.perf_counter() - start) / opt.runs
+
+    def benchmark(fn):
+        start = time.perf_counter()
+        for _ in range(opt.runs):
+            result = fn()
+        return result, (time.perf_counter() - start) / opt.runs
+
+    vectorized, vectorized_time = benchmark(
+        lambda: batched_postprocess(scores, boxes, opt.threshold))
+    per_class, per_class_time = benchmark(
+        lambda: [postprocess(s, b, opt.threshold) for s, b in zip(scores, boxes)])
+    naive, naive_time = benchmark(
+        lambda: naive_postprocess(scores, boxes, opt.threshold))
+
+    # parity: the same detections (up to order within a class) for every image
+    def as_set(result):
+        return {(int(label), round(float(prob), 5)) for _, label, prob in zip(*result)}
+    for image in range(opt.batch_size):
+        assert as_set(vectorized[image]) == as_set(naive[image]) == as_set(per_class[image]), \
+            'post-processing mismatch on image {:d}'.format(image)
+
+    detections = sum(len(result[1]) for result in vectorized)
+    print('{:d} priors x {:d} classes x {:d} images, {:d} detections'.format(
+        len(priors), opt.num_classes, opt.batch_size, detections))
+    print('decode (batched):           {:8.2f} ms'.format(decode_time * 1000))
+    print('vectorized batched NMS:     {:8.2f} ms'.format(vectorized_time * 1000))
+    print('per-class NumPy NMS loop:   {:8.2f} ms'.format(per_class_time * 1000))
+    print('naive per-box Python loop:  {:8.2f} ms'.format(naive_time * 1000))
@@ -0,0 +1,142 @@
+#
+# lightweight IoU tracker that confirms detections across frames before the feeder acts on them.
+# Detections are associated greedily with the existing tracks of the same class by box overlap,
+# every track keeps an exponentially smoothed confidence and hit/miss counters, and only
+# confirmed tracks (seen on several frames) are passed on to the decision logic.
+#
+import numpy as np
+
+from ssd_postprocess import iou_of
+
+
+class Track:
+    def __init__(self, track_id, class_id, confidence, box):
+        self.track_id = track_id
+        self.class_id = class_id
+        self.confidence = confidence
+        self.box = box
+        self.hits = 1
+        self.misses = 0
+        self.age = 1
+
+    def __repr__(self):
+        return '<Track {:d} ClassID={:d} Confidence={:.3f} hits={:d} misses={:d}>'.format(
+            self.track_id, self.class_id, self.confidence, self.hits, self.misses)
+
+
+class IouTracker:
+    # iou_threshold - minimum overlap for a detection to continue a track
+    # smoothing - weight of the newest confidence in the track's moving average (1 = no smoothing)
+    # min_hits - frames a track has to be seen on before it is confirmed
+    # max_misses - frames a track survives without a matching detection
+    def __init__(self, iou_threshold=0.3, smoothing=0.5, min_hits=3, max_misses=5):
+        self.iou_threshold = iou_threshold
+        self.smoothing = smoothing
+        self.min_hits = min_hits
+        self.max_misses = max_misses
+        self.tracks = []
+        # ids of the tracks returned by the last update (same order as its rows)
+        self.confirmed_ids = []
+        # ids of the tracks dropped by the last update
+        self.ended_ids = []
+        self._next_id = 0
+
+    # Updates the tracks with a frame's (K, 6) rows of (class_id, confidence, left, top, right, bottom)
+    # and returns the confirmed tracks seen on this frame, as rows of the same layout
+    # (carrying the smoothed confidence and the latest box)
+    def update(self, detections):
+        for track in self.tracks:
+            track.age += 1
+
+        matched_tracks, matched_detections = self._associate(detections)
+
+        for track_index, detection_index in zip(matched_tracks, matched_detections):
+            track = self.tracks[track_index]
+            row = detections[detection_index]
+            track.confidence += self.smoothing * (float(row[1]) - track.confidence)
+            track.box = row[2:6].copy()
+            track.hits += 1
+            track.misses = 0
+
+        # unmatched tracks keep their confidence but are dropped after max_misses frames in a row
+        matched = set(matched_tracks)
+        for track_index, track in enumerate(self.tracks):
+            if track_index not in matched:
+                track.misses += 1
+        self.ended_ids = [track.track_id for track in self.tracks if track.misses > self.max_misses]
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+        # unmatched detections start new tracks
+        unmatched = np.ones(len(detections), dtype=bool)
+        unmatched[matched_detections] = False
+        for row in detections[unmatched]:
+            self.tracks.append(Track(self._next_id, int(row[0]), float(row[1]), row[2:6].copy()))
+            self._next_id += 1
+
+        return self._confirmed_rows()
+
+    # Carries the tracks over a frame the detector did not run on (nothing in the scene changed):
+    # the tracks age, but gain no hits and no misses. Returns the confirmed tracks like update().
+    def hold(self):
+        for track in self.tracks:
+            track.age += 1
+        self.ended_ids = []
+        return self._confirmed_rows()
+
+    # Drops all tracks, returns the ids of the ones that were still alive
+    def reset(self):
+        ended_ids = [track.track_id for track in self.tracks]
+        self.tracks = []
+        self.confirmed_ids = []
+        self.ended_ids = []
+        return ended_ids
+
+    # Function that greedily pairs tracks and detections of the same class, highest IoU first
+    def _associate(self, detections):
+        if not self.tracks or not len(detections):
+            return [], []
+
+        track_classes = np.array([track.class_id for track in self.tracks])
+        track_boxes = np.array([track.box for track in self.tracks], dtype=np.float32)
+        ious = iou_of(track_boxes[:, np.newaxis, :], detections[np.newaxis, :, 2:6])
+        ious[track_classes[:, np.newaxis] != detections[np.newaxis, :, 0].astype(int)] = 0.0
+
+        track_indexes, detection_indexes = np.nonzero(ious >= self.iou_threshold)
+        order = np.argsort(-ious[track_indexes, detection_indexes], kind='stable')
+
+        matched_tracks, matched_detections = [], []
+        used_tracks, used_detections = set(), set()
+        for track_index, detection_index in zip(track_indexes[order], detection_indexes[order]):
+            if track_index in used_tracks or detection_index in used_detections:
+                continue
+            used_tracks.add(track_index)
+            used_detections.add(detection_index)
+            matched_tracks.append(int(track_index))
+            matched_detections.append(int(detection_index))
+        return matched_tracks, matched_detections
+
+    def _confirmed_rows(self):
+        confirmed = [track for track in self.tracks if track.misses == 0 and track.hits >= self.min_hits]
+        self.confirmed_ids = [track.track_id for track in confirmed]
+        if not confirmed:
+            return np.zeros((0, 6), dtype=np.float32)
+        return np.array([(track.class_id, track.confidence, *track.box) for track in confirmed], dtype=np.float32)
+
+
+# Main function for testing during development
+if __name__ == '__main__':
+    tracker = IouTracker(min_hits=3, max_misses=2)
+    bird = [3, 0.95, 100, 100, 200, 200]
+    squirrel_flicker = [17, 0.92, 400, 300, 500, 400]
+
+    frames = [
+        [bird, squirrel_flicker],
+        [[3, 0.93, 104, 102, 204, 203]],
+        [[3, 0.96, 108, 104, 208, 206]],
+        [[3, 0.94, 110, 106, 210, 208], [3, 0.91, 600, 50, 650, 90]],
+        [],
+        [[3, 0.95, 112, 108, 212, 210]],
+    ]
+    for index, frame in enumerate(frames):
+        confirmed = tracker.update(np.array(frame, dtype=np.float32).reshape(-1, 6))
+        print(index, confirmed[:, :2].round(3).tolist(), tracker.tracks)
@@ -3,12 +3,19 @@
 #
 import os
 import sys
+import socket
 import logging
 import argparse
 import itertools
+import contextlib
+import subprocess
+import time
 import torch
+import torch.distributed as dist
 
 from torch.utils.data import DataLoader, ConcatDataset
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import CosineAnnealingLR, MultiStepLR
 
 from vision.utils.misc import str2bool, Timer, freeze_net_layers, store_labels
@@ -26,6 +33,10 @@ from vision.ssd.config import mobilenetv1_ssd_config
 from vision.ssd.config import squeezenet_ssd_config
 from vision.ssd.data_preprocessing import TrainAugmentation, TestTransform
 
+from dataset_cache import open_cached_dataset, cache_path
+from batch_matching import BatchMatchPrior, MatchPriorCollate
+from checkpoints import CheckpointSaver, latest_checkpoint, load_training_state
+
 parser = argparse.ArgumentParser(
     description='Single Shot MultiBox Detector Training With PyTorch')
 
@@ -36,6 +47,14 @@ parser.add_argument('--datasets', '--data', nargs='+',
                     default=["data"], help='Dataset directory path')
 parser.add_argument('--balance-data', action='store_true',
                     help="Balance training data by down-sampling more frequent labels.")
+parser.add_argument('--dataset-cache', default=None, type=str,
+                    help="Directory for memory-mapped caches of the decoded datasets (compiled on first use, "
+                         "recompiled when the dataset files change)")
+parser.add_argument('--cache-image-size', default=512, type=int,
+                    help="Longer side of the cached images in pixels (0 = keep the original size)")
+parser.add_argument('--target-encoding', default="sample", type=str, choices=['sample', 'batch', 'device'],
+                    help="Where ground truth boxes are matched to the priors: per sample in the dataloader "
+                         "workers (sample), per batch at collate time (batch) or per batch on the training device (device)")
 
 # Params for network
 parser.add_argument('--net', default="mb1-ssd",
@@ -52,7 +71,9 @@ parser.add_argument('--base-net', help='Pretrained base model')
 parser.add_argument('--pretrained-ssd', default='models/mobilenet-v1-ssd-mp-0_675.pth',
                     type=str, help='Pre-trained base model')
 parser.add_argument('--resume', default=None, type=str,
-                    help='Checkpoint state_dict file to resume training from')
+                    help='Checkpoint (.pth) to resume training from, or a checkpoint folder to resume from '
+                         'its latest checkpoint. The optimizer, scheduler, epoch and RNG state saved with '
+                         'it are restored as well')
 
 # Params for SGD
 parser.add_argument('--lr', '--learning-rate', default=0.01, type=float,
@@ -95,37 +116,174 @@ parser.add_argument('--use-cuda', default=True, type=str2bool,
                     help='Use CUDA to train model')
 parser.add_argument('--checkpoint-folder', '--model-dir', default='models/',
                     help='Directory for saving checkpoint models')
+parser.add_argument('--keep-checkpoints', default=5, type=int,
+                    help='Number of checkpoints with the lowest validation loss to keep, besides the latest '
+                         'one (0 = keep all of them). Only checkpoints saved by this run are deleted, those of '
+                         'earlier runs in --checkpoint-folder are left alone')
+
+# Params for CPU training
+parser.add_argument('--cpu-profile', action='store_true',
+                    help='Tune the defaults below for CPU-only servers: no CUDA, one intra-op thread per core '
+                         'not used by a dataloader worker, persistent workers with prefetch, channels-last '
+                         'and bfloat16 autocast if the CPU supports it')
+parser.add_argument('--threads', default=None, type=int,
+                    help='Number of intra-op threads (default: PyTorch default)')
+parser.add_argument('--interop-threads', default=None, type=int,
+                    help='Number of inter-op threads (default: PyTorch default)')
+parser.add_argument('--persistent-workers', default=None, type=str2bool,
+                    help='Keep the dataloader workers alive between epochs')
+parser.add_argument('--prefetch-factor', default=None, type=int,
+                    help='Batches loaded in advance by each dataloader worker')
+parser.add_argument('--pin-memory', default=None, type=str2bool,
+                    help='Load batches into pinned memory (default: only when training on CUDA)')
+parser.add_argument('--channels-last', default=None, type=str2bool,
+                    help='Use the channels-last memory format for the model and images')
+parser.add_argument('--autocast', default=None, type=str, choices=['none', 'bf16'],
+                    help='Run the forward pass under bfloat16 autocast')
+parser.add_argument('--accumulation-steps', default=1, type=int,
+                    help='Batches whose gradients are accumulated per optimizer step '
+                         '(effective batch size = batch-size x accumulation-steps)')
+
+# Params for distributed training
+parser.add_argument('--distributed', default=0, type=int,
+                    help='Train data-parallel in this many processes (gloo backend), each one loading '
+                         'batch-size images per step from its own shard of the datasets')
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO,
                     format='%(asctime)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
 
 args = parser.parse_args()
-DEVICE = torch.device("cuda:0" if torch.cuda.is_available()
+
+# rank of this process and number of processes when training distributed
+# (set by --distributed, or by a launcher like torchrun)
+RANK = int(os.environ.get('RANK', 0))
+LOCAL_RANK = int(os.environ.get('LOCAL_RANK', 0))
+WORLD_SIZE = int(os.environ.get('WORLD_SIZE', 1))
+
+
+# Function that tells whether the CPU runs bfloat16 natively (AVX512-BF16 / AMX)
+def bf16_supported():
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+# Function that fills in the CPU training options left unset on the command line
+def apply_cpu_profile(args):
+    if args.cpu_profile:
+        args.use_cuda = False
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        if args.threads is None:
+            args.threads = max(1, cores // WORLD_SIZE - args.num_workers)
+        if args.interop_threads is None:
+            args.interop_threads = 1
+        if args.persistent_workers is None:
+            args.persistent_workers = True
+        if args.prefetch_factor is None:
+            args.prefetch_factor = 4
+        if args.channels_last is None:
+            args.channels_last = True
+        if args.autocast is None:
+            args.autocast = 'bf16' if bf16_supported() else 'none'
+    if args.autocast == 'bf16' and not (args.use_cuda and torch.cuda.is_available()) and not bf16_supported():
+        logging.warning("This CPU has no native bfloat16 support, training without autocast.")
+        args.autocast = 'none'
+
+
+apply_cpu_profile(args)
+if args.threads:
+    torch.set_num_threads(args.threads)
+if args.interop_threads:
+    torch.set_num_interop_threads(args.interop_threads)
+
+DEVICE = torch.device(f"cuda:{LOCAL_RANK}" if torch.cuda.is_available()
                       and args.use_cuda else "cpu")
 
 if args.use_cuda and torch.cuda.is_available():
     torch.backends.cudnn.benchmark = True
     logging.info("Using CUDA...")
+elif args.cpu_profile:
+    logging.info(f"Using the CPU profile: {torch.get_num_threads()} intra-op threads, "
+                 f"{torch.get_num_interop_threads()} inter-op threads, {args.num_workers} workers, "
+                 f"channels-last {args.channels_last}, autocast {args.autocast}.")
+
+
+# Function that starts --distributed training processes on this machine and waits for them.
+# If one of them fails the others are stopped, as they would block in the next gradient exchange.
+def launch_distributed(world_size):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    processes = []
+    for rank in range(world_size):
+        env = dict(os.environ, RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(world_size),
+                   MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+        processes.append(subprocess.Popen([sys.executable] + sys.argv, env=env))
+
+    try:
+        while any(process.poll() is None for process in processes):
+            if any(process.poll() for process in processes):
+                break
+            time.sleep(1.0)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        codes = [process.wait() for process in processes]
+    sys.exit(max(abs(code) for code in codes))
+
+
+# Function that averages values over all ranks
+def all_reduce_mean(*values):
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return (tensor / WORLD_SIZE).tolist()
+
+
+# Function that moves a batch to the device. With a matcher (--target-encoding device) the batch
+# holds padded ground truth boxes, which are encoded on the device.
+def batch_to_device(data, device, matcher=None, memory_format=torch.preserve_format):
+    if matcher is None:
+        images, boxes, labels = data
+        return images.to(device, memory_format=memory_format), boxes.to(device), labels.to(device)
+    images, gt_boxes, gt_labels, valid = data
+    boxes, labels = matcher(gt_boxes.to(device), gt_labels.to(device), valid.to(device))
+    return images.to(device, memory_format=memory_format), boxes, labels
 
 
-def train(loader, net, criterion, optimizer, device, debug_steps=100, epoch=-1):
+# autocast_dtype - run the forward pass under autocast with this dtype (the loss is computed in float32)
+# accumulation_steps - batches whose gradients are summed before every optimizer step
+def train(loader, net, criterion, optimizer, device, debug_steps=100, epoch=-1, matcher=None,
+          accumulation_steps=1, autocast_dtype=None, memory_format=torch.preserve_format):
     net.train(True)
     running_loss = 0.0
     running_regression_loss = 0.0
     running_classification_loss = 0.0
+    num_images = 0
+    data_time = 0.0
+    start = time.perf_counter()
+    optimizer.zero_grad()
+    step_end = time.perf_counter()
     for i, data in enumerate(loader):
-        images, boxes, labels = data
-        images = images.to(device)
-        boxes = boxes.to(device)
-        labels = labels.to(device)
-
-        optimizer.zero_grad()
-        confidence, locations = net(images)
-        regression_loss, classification_loss = criterion(
-            confidence, locations, labels, boxes)  # TODO CHANGE BOXES
-        loss = regression_loss + classification_loss
-        loss.backward()
-        optimizer.step()
+        images, boxes, labels = batch_to_device(data, device, matcher, memory_format)
+        data_time += time.perf_counter() - step_end
+        num_images += images.size(0)
+
+        # distributed, gradients are only exchanged on the batches that end in an optimizer step
+        step = (i + 1) % accumulation_steps == 0 or i + 1 == len(loader)
+        with net.no_sync() if not step and hasattr(net, 'no_sync') else contextlib.nullcontext():
+            with torch.autocast(device_type=device.type, dtype=autocast_dtype or torch.bfloat16,
+                                enabled=autocast_dtype is not None):
+                confidence, locations = net(images)
+            regression_loss, classification_loss = criterion(
+                confidence.float(), locations.float(), labels, boxes)  # TODO CHANGE BOXES
+            loss = regression_loss + classification_loss
+            (loss / accumulation_steps).backward()
+        if step:
+            optimizer.step()
+            optimizer.zero_grad()
+        step_end = time.perf_counter()
 
         running_loss += loss.item()
         running_regression_loss += regression_loss.item()
@@ -144,24 +302,30 @@ def train(loader, net, criterion, optimizer, device, debug_steps=100, epoch=-1):
             running_regression_loss = 0.0
             running_classification_loss = 0.0
 
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"Epoch: {epoch}, Throughput: {num_images / elapsed:.1f} images/sec, " +
+        f"{num_images} images in {elapsed:.1f} sec, " +
+        f"waiting for data {100.0 * data_time / elapsed:.0f}% of the time"
+    )
+
 
-def test(loader, net, criterion, device):
+def test(loader, net, criterion, device, matcher=None, autocast_dtype=None, memory_format=torch.preserve_format):
     net.eval()
     running_loss = 0.0
     running_regression_loss = 0.0
     running_classification_loss = 0.0
     num = 0
     for _, data in enumerate(loader):
-        images, boxes, labels = data
-        images = images.to(device)
-        boxes = boxes.to(device)
-        labels = labels.to(device)
+        images, boxes, labels = batch_to_device(data, device, matcher, memory_format)
         num += 1
 
         with torch.no_grad():
-            confidence, locations = net(images)
+            with torch.autocast(device_type=device.type, dtype=autocast_dtype or torch.bfloat16,
+                                enabled=autocast_dtype is not None):
+                confidence, locations = net(images)
             regression_loss, classification_loss = criterion(
-                confidence, locations, labels, boxes)
+                confidence.float(), locations.float(), labels, boxes)
             loss = regression_loss + classification_loss
 
         running_loss += loss.item()
@@ -170,9 +334,42 @@ def test(loader, net, criterion, device):
     return running_loss / num, running_regression_loss / num, running_classification_loss / num
 
 
+# Function that creates the train or test split of a dataset, read through the memory-mapped
+# dataset cache if --dataset-cache is set
+def create_dataset(dataset_path, split, transform, target_transform):
+    balance_data = args.balance_data and split == "train"
+    if args.dataset_type == 'voc':
+        def create(**kwargs):
+            return VOCDataset(dataset_path, is_test=split == "test", **kwargs)
+    elif args.dataset_type == 'open_images':
+        def create(**kwargs):
+            return OpenImagesDataset(dataset_path, dataset_type=split, balance_data=balance_data, **kwargs)
+    else:
+        raise ValueError(
+            f"Dataset type {args.dataset_type} is not supported.")
+
+    if not args.dataset_cache:
+        return create(transform=transform, target_transform=target_transform)
+    return open_cached_dataset(create, dataset_path,
+                               cache_path(args.dataset_cache, dataset_path, args.dataset_type, split),
+                               transform=transform, target_transform=target_transform,
+                               image_size=args.cache_image_size, num_workers=max(1, args.num_workers),
+                               cache_root=args.dataset_cache,
+                               dataset_type=args.dataset_type, split=split, balance_data=balance_data)
+
+
 if __name__ == '__main__':
     timer = Timer()
 
+    if args.distributed > 1 and 'RANK' not in os.environ:
+        launch_distributed(args.distributed)
+    if WORLD_SIZE > 1:
+        dist.init_process_group("gloo", rank=RANK, world_size=WORLD_SIZE)
+        logging.info(f"Process {RANK} of {WORLD_SIZE} joined the distributed training.")
+        # only rank 0 logs, writes labels and saves checkpoints
+        if RANK != 0:
+            logging.getLogger().setLevel(logging.WARNING)
+
     logging.info(args)
 
     # make sure that the checkpoint output dir exists
@@ -210,56 +407,63 @@ if __name__ == '__main__':
     target_transform = MatchPrior(config.priors, config.center_variance,
                                   config.size_variance, 0.5)
 
+    # with batched target encoding the datasets return raw targets, which the collate_fn
+    # (or the training loop, on the device) matches to the priors a batch at a time
+    collate_fn = None
+    device_matcher = None
+    if args.target_encoding != "sample":
+        matcher = BatchMatchPrior(config.priors, config.center_variance,
+                                  config.size_variance, 0.5)
+        collate_fn = MatchPriorCollate(matcher, encode_on_device=args.target_encoding == "device")
+        device_matcher = matcher if args.target_encoding == "device" else None
+        target_transform = None
+
     test_transform = TestTransform(
         config.image_size, config.image_mean, config.image_std)
 
-    # load datasets (could be multiple)
+    # dataloader options (pinned memory only pays off for host to GPU copies)
+    loader_options = {'pin_memory': args.pin_memory if args.pin_memory is not None else DEVICE.type == 'cuda'}
+    if args.num_workers > 0:
+        loader_options['persistent_workers'] = bool(args.persistent_workers)
+        if args.prefetch_factor:
+            loader_options['prefetch_factor'] = args.prefetch_factor
+
+    # load datasets (could be multiple), the other ranks wait for rank 0 to compile the dataset caches
     logging.info("Prepare training datasets.")
+    if WORLD_SIZE > 1 and RANK != 0:
+        dist.barrier()
     datasets = []
     for dataset_path in args.datasets:
-        if args.dataset_type == 'voc':
-            dataset = VOCDataset(dataset_path, transform=train_transform,
-                                 target_transform=target_transform)
-            label_file = os.path.join(args.checkpoint_folder, "labels.txt")
+        dataset = create_dataset(dataset_path, "train", train_transform, target_transform)
+        label_file = os.path.join(args.checkpoint_folder, "labels.txt")
+        if RANK == 0:
             store_labels(label_file, dataset.class_names)
-            num_classes = len(dataset.class_names)
-        elif args.dataset_type == 'open_images':
-            dataset = OpenImagesDataset(dataset_path,
-                                        transform=train_transform, target_transform=target_transform,
-                                        dataset_type="train", balance_data=args.balance_data)
-            label_file = os.path.join(args.checkpoint_folder, "labels.txt")
-            store_labels(label_file, dataset.class_names)
-            logging.info(dataset)
-            num_classes = len(dataset.class_names)
-
-        else:
-            raise ValueError(
-                f"Dataset type {args.dataset_type} is not supported.")
+        logging.info(dataset)
+        num_classes = len(dataset.class_names)
         datasets.append(dataset)
 
     # create training dataset
     logging.info(f"Stored labels into file {label_file}.")
     train_dataset = ConcatDataset(datasets)
     logging.info("Train dataset size: {}".format(len(train_dataset)))
+    train_sampler = DistributedSampler(train_dataset, shuffle=True) if WORLD_SIZE > 1 else None
     train_loader = DataLoader(train_dataset, args.batch_size,
-                              num_workers=args.num_workers,
-                              shuffle=True)
+                              num_workers=args.num_workers, sampler=train_sampler,
+                              shuffle=train_sampler is None, collate_fn=collate_fn, **loader_options)
 
     # create validation dataset
     logging.info("Prepare Validation datasets.")
-    if args.dataset_type == "voc":
-        val_dataset = VOCDataset(dataset_path, transform=test_transform,
-                                 target_transform=target_transform, is_test=True)
-    elif args.dataset_type == 'open_images':
-        val_dataset = OpenImagesDataset(dataset_path,
-                                        transform=test_transform, target_transform=target_transform,
-                                        dataset_type="test")
-        logging.info(val_dataset)
+    val_dataset = create_dataset(dataset_path, "test", test_transform, target_transform)
+    logging.info(val_dataset)
     logging.info("Validation dataset size: {}".format(len(val_dataset)))
 
+    if WORLD_SIZE > 1 and RANK == 0:
+        dist.barrier()
+
+    val_sampler = DistributedSampler(val_dataset, shuffle=False) if WORLD_SIZE > 1 else None
     val_loader = DataLoader(val_dataset, args.batch_size,
-                            num_workers=args.num_workers,
-                            shuffle=False)
+                            num_workers=args.num_workers, sampler=val_sampler,
+                            shuffle=False, collate_fn=collate_fn, **loader_options)
 
     # create the network
     logging.info("Build network.")
@@ -308,9 +512,15 @@ if __name__ == '__main__':
 
     # load a previous model checkpoint (if requested)
     timer.start("Load Model")
-    if args.resume:
-        logging.info(f"Resume from the model {args.resume}")
-        net.load(args.resume)
+    resume_path = args.resume
+    if resume_path and os.path.isdir(resume_path):
+        resume_path = latest_checkpoint(resume_path, args.net)
+        if resume_path is None:
+            logging.fatal(f"No {args.net} checkpoint to resume from in {args.resume}.")
+            sys.exit(1)
+    if resume_path:
+        logging.info(f"Resume from the model {resume_path}")
+        net.load(resume_path)
     elif args.base_net:
         logging.info(f"Init from base net {args.base_net}")
         net.init_from_base_net(args.base_net)
@@ -322,6 +532,16 @@ if __name__ == '__main__':
 
     # move the model to GPU
     net.to(DEVICE)
+    memory_format = torch.channels_last if args.channels_last else torch.preserve_format
+    if args.channels_last:
+        net.to(memory_format=torch.channels_last)
+    autocast_dtype = torch.bfloat16 if args.autocast == 'bf16' else None
+
+    # distributed, the model averages the gradients of all ranks in backward()
+    # (and starts from rank 0's weights); net stays the plain module for saving
+    model = net
+    if WORLD_SIZE > 1:
+        model = DistributedDataParallel(net, device_ids=[DEVICE.index] if DEVICE.type == 'cuda' else None)
 
     # define loss function and optimizer
     criterion = MultiboxLoss(config.priors, iou_threshold=0.5, neg_pos_ratio=3,
@@ -346,26 +566,50 @@ if __name__ == '__main__':
         parser.print_help(sys.stderr)
         sys.exit(1)
 
+    # restore the training state saved with the checkpoint (each rank draws its own random numbers)
+    if resume_path:
+        epoch = load_training_state(resume_path, optimizer, scheduler, restore_rng=RANK == 0)
+        if epoch is None:
+            logging.warning(f"{resume_path} has no training state, resuming with a fresh optimizer and scheduler.")
+        else:
+            last_epoch = epoch
+
+    # checkpoints are written in the background, only by rank 0
+    saver = None
+    if RANK == 0:
+        saver = CheckpointSaver(args.checkpoint_folder, args.net, keep_best=args.keep_checkpoints)
+        saver.start()
+
     # train for the desired number of epochs
     logging.info(f"Start training from epoch {last_epoch + 1}.")
 
     for epoch in range(last_epoch + 1, args.num_epochs):
         scheduler.step()
-        train(train_loader, net, criterion, optimizer,
-              device=DEVICE, debug_steps=args.debug_steps, epoch=epoch)
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        train(train_loader, model, criterion, optimizer,
+              device=DEVICE, debug_steps=args.debug_steps, epoch=epoch, matcher=device_matcher,
+              accumulation_steps=args.accumulation_steps, autocast_dtype=autocast_dtype,
+              memory_format=memory_format)
 
         if epoch % args.validation_epochs == 0 or epoch == args.num_epochs - 1:
             val_loss, val_regression_loss, val_classification_loss = test(
-                val_loader, net, criterion, DEVICE)
+                val_loader, net, criterion, DEVICE, matcher=device_matcher,
+                autocast_dtype=autocast_dtype, memory_format=memory_format)
+            if WORLD_SIZE > 1:
+                val_loss, val_regression_loss, val_classification_loss = all_reduce_mean(
+                    val_loss, val_regression_loss, val_classification_loss)
             logging.info(
                 f"Epoch: {epoch}, " +
                 f"Validation Loss: {val_loss:.4f}, " +
                 f"Validation Regression Loss {val_regression_loss:.4f}, " +
                 f"Validation Classification Loss: {val_classification_loss:.4f}"
             )
-            model_path = os.path.join(
-                args.checkpoint_folder, f"{args.net}-Epoch-{epoch}-Loss-{val_loss}.pth")
-            net.save(model_path)
-            logging.info(f"Saved model {model_path}")
+            if saver:
+                saver.save(epoch, val_loss, net, optimizer, scheduler)
 
+    if saver:
+        saver.close()
+    if WORLD_SIZE > 1:
+        dist.destroy_process_group()
     logging.info("Task done, exiting program.")
@@ -0,0 +1,377 @@
+#
+# command link between the Jetson and the MSP430.
+#
+# Outgoing commands go through a send queue that coalesces redundant state commands
+# (e.g. repeated hatch opens) and only transmits when the state actually changes.
+# Two wire formats are supported:
+#   legacy - one ASCII byte per message, no acknowledgement (current MSP430 firmware)
+#   framed - START | SEQ | TYPE | LEN | PAYLOAD | CHECKSUM frames, every command and
+#            event is acknowledged and retransmitted until it is
+#
+import collections
+import os
+import select
+import threading
+import time
+
+from metrics import METRICS
+
+START_BYTE = 0x7E
+
+# frame types
+TYPE_COMMAND = 0x01  # Jetson -> MSP430 ('o', 'c', 'u', 's')
+TYPE_EVENT = 0x02    # MSP430 -> Jetson ('r', 'l', 'h')
+TYPE_ACK = 0x03      # either direction, payload is empty and seq is the acknowledged frame
+
+MAX_PAYLOAD = 32
+HEADER_SIZE = 4      # start, seq, type, len
+
+Frame = collections.namedtuple('Frame', ['seq', 'type', 'payload'])
+
+
+# Function that computes the 8-bit checksum over seq, type, len and payload
+def checksum(data):
+    return (-sum(data)) & 0xFF
+
+
+def encode_frame(seq, frame_type, payload=b''):
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"Frame payload is {len(payload)} bytes, max is {MAX_PAYLOAD}")
+    body = bytes([seq & 0xFF, frame_type, len(payload)]) + payload
+    return bytes([START_BYTE]) + body + bytes([checksum(body)])
+
+
+# Incremental frame decoder. Bytes can arrive split across reads; corrupted frames
+# are skipped by resynchronising on the next start byte.
+class FrameParser:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.bad_frames = 0
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+
+        while True:
+            start = self.buffer.find(START_BYTE)
+            if start < 0:
+                self.buffer.clear()
+                break
+            del self.buffer[:start]
+
+            if len(self.buffer) < HEADER_SIZE:
+                break
+            length = self.buffer[3]
+            if length > MAX_PAYLOAD:
+                self.bad_frames += 1
+                del self.buffer[0]
+                continue
+
+            frame_size = HEADER_SIZE + length + 1
+            if len(self.buffer) < frame_size:
+                break
+
+            body = bytes(self.buffer[1:frame_size - 1])
+            if checksum(body) != self.buffer[frame_size - 1]:
+                self.bad_frames += 1
+                del self.buffer[0]
+                continue
+
+            frames.append(Frame(body[0], body[1], body[3:]))
+            del self.buffer[:frame_size]
+
+        return frames
+
+
+# One ASCII byte per message, as spoken by the current MSP430 firmware
+class LegacyCodec:
+    framed = False
+
+    def encode(self, seq, frame_type, payload):
+        return payload
+
+    def decode(self, data):
+        return [Frame(None, TYPE_EVENT, data[i:i + 1]) for i in range(len(data))]
+
+
+class FramedCodec:
+    framed = True
+
+    def __init__(self):
+        self.parser = FrameParser()
+
+    def encode(self, seq, frame_type, payload):
+        return encode_frame(seq, frame_type, payload)
+
+    def decode(self, data):
+        return self.parser.feed(data)
+
+
+CODECS = {
+    'legacy': LegacyCodec,
+    'framed': FramedCodec,
+}
+
+
+# Counters describing the traffic on the link
+class LinkStats:
+    def __init__(self):
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.commands_sent = 0
+        self.commands_coalesced = 0
+        self.retransmits = 0
+        self.commands_lost = 0
+        self.events_received = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class CommandLink(threading.Thread):
+    def __init__(self, serial_port, codec=None, ack_timeout=0.5, max_retries=3, name='uart-link'):
+        super().__init__(name=name, daemon=True)
+        self.serial_port = serial_port
+        self.codec = codec or LegacyCodec()
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        self.stats = LinkStats()
+
+        # pending commands in send order, keyed by state key (or the command itself for actions)
+        self._pending = collections.OrderedDict()
+        # last state the MSP430 is known to be in, per state key
+        self._remote_state = {}
+        self._condition = threading.Condition()
+        self._acked = threading.Event()
+        self._waiting_seq = None
+        # (key, command) currently being transmitted
+        self._in_flight = None
+        self._seq = 0
+        self._last_event_seq = None
+        self._write_lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    # Queue a state command (e.g. key='hatch', command=b'o'). Nothing is sent if the
+    # MSP430 is already in that state; a pending command for the same key is replaced.
+    def set_state(self, key, command):
+        with self._condition:
+            expected_state = self._expected_state(key)
+            if key in self._pending:
+                if expected_state == command:
+                    # the pending command would undo itself, just drop it
+                    del self._pending[key]
+                else:
+                    self._pending[key] = (key, command)
+                self.stats.commands_coalesced += 1
+                return
+            if expected_state == command:
+                self.stats.commands_coalesced += 1
+                return
+            self._pending[key] = (key, command)
+            self._condition.notify()
+
+    # caller must hold self._condition; state the MSP430 will be in once in-flight commands land
+    def _expected_state(self, key):
+        if self._in_flight is not None and self._in_flight[0] == key:
+            return self._in_flight[1]
+        return self._remote_state.get(key)
+
+    # Record a state the MSP430 reached on its own (e.g. it started detection by sending 'r')
+    def assume_state(self, key, command):
+        with self._condition:
+            self._remote_state[key] = command
+
+    # Queue a one-off action (e.g. b'u' feed check); a duplicate still waiting to be sent is dropped
+    def send(self, command):
+        with self._condition:
+            if command in self._pending:
+                self.stats.commands_coalesced += 1
+                return
+            self._pending[command] = (None, command)
+            self._condition.notify()
+
+    # Decode received bytes, handle acks and return the event payloads (e.g. [b'r'])
+    def receive(self, data):
+        self.stats.bytes_read += len(data)
+        events = []
+        for frame in self.codec.decode(data):
+            if frame.type == TYPE_ACK:
+                if frame.seq == self._waiting_seq:
+                    self._acked.set()
+                continue
+            if frame.type != TYPE_EVENT:
+                continue
+
+            if self.codec.framed:
+                self._write(self.codec.encode(frame.seq, TYPE_ACK, b''))
+                # a retransmitted event whose ack got lost
+                if frame.seq == self._last_event_seq:
+                    continue
+                self._last_event_seq = frame.seq
+
+            self.stats.events_received += 1
+            events.append(frame.payload)
+        return events
+
+    # Block until every queued command has been sent (or timeout expires)
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._pending or self._in_flight is not None:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stop_event.is_set():
+                    self._condition.wait()
+                if self._stop_event.is_set():
+                    return
+                _, (key, command) = self._pending.popitem(last=False)
+                self._seq = (self._seq + 1) & 0xFF
+                seq = self._seq
+                self._waiting_seq = seq if self.codec.framed else None
+                self._in_flight = (key, command)
+
+            delivered = self._transmit(seq, command)
+
+            with self._condition:
+                self._waiting_seq = None
+                self._in_flight = None
+                if key is not None and delivered:
+                    self._remote_state[key] = command
+                self._condition.notify_all()
+
+    def _transmit(self, seq, command):
+        frame = self.codec.encode(seq, TYPE_COMMAND, command)
+        if not self.codec.framed:
+            self._write(frame)
+            self.stats.commands_sent += 1
+            return True
+
+        for attempt in range(self.max_retries + 1):
+            self._acked.clear()
+            if attempt:
+                self.stats.retransmits += 1
+            self._write(frame)
+            if self._acked.wait(self.ack_timeout):
+                self.stats.commands_sent += 1
+                return True
+            if self._stop_event.is_set():
+                break
+
+        self.stats.commands_lost += 1
+        print('UART command {} was not acknowledged'.format(command))
+        return False
+
+    def _write(self, data):
+        with self._write_lock, METRICS.stage('serial_write'):
+            self.serial_port.write(data)
+        self.stats.bytes_written += len(data)
+
+
+# Stand-in for the MSP430 firmware used during testing. It talks to the other end of a
+# pseudo-terminal (or any file descriptor pair), acknowledges commands, tracks the hatch
+# and answers feed checks.
+class SimulatedMcu(threading.Thread):
+    def __init__(self, fd, codec=None, feed_is_low=False, drop_every=0):
+        super().__init__(name='simulated-mcu', daemon=True)
+        self.fd = fd
+        self.codec = codec or LegacyCodec()
+        self.feed_is_low = feed_is_low
+        # drop every Nth received frame to exercise retransmission (0 = never)
+        self.drop_every = drop_every
+        self.hatch_is_open = None
+        self.received = []
+        self._count = 0
+        self._seq = 0
+        self._stop_event = threading.Event()
+
+    # Send an event to the Jetson (e.g. b'r' when the trip-wire is broken)
+    def emit(self, payload):
+        self._seq = (self._seq + 1) & 0xFF
+        os.write(self.fd, self.codec.encode(self._seq, TYPE_EVENT, payload))
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            if not select.select([self.fd], [], [], 0.1)[0]:
+                continue
+            try:
+                data = os.read(self.fd, 64)
+            except OSError:
+                return
+            # frames sent by the Jetson have the same layout as events, so the same codec decodes them
+            for frame in self.codec.decode(data):
+                self._count += 1
+                if self.drop_every and self._count % self.drop_every == 0:
+                    continue
+                if frame.type == TYPE_ACK:
+                    continue
+                if self.codec.framed:
+                    os.write(self.fd, self.codec.encode(frame.seq, TYPE_ACK, b''))
+                self._handle(frame.payload)
+
+    def _handle(self, command):
+        self.received.append(command)
+        if command == b'o':
+            self.hatch_is_open = True
+        elif command == b'c':
+            self.hatch_is_open = False
+        elif command == b'u':
+            self.emit(b'l' if self.feed_is_low else b'h')
+
+
+# Main function for testing during development (simulated MSP430 on a pseudo-terminal)
+if __name__ == '__main__':
+    import pty
+    import sys
+    import serial
+
+    from serial_reader import SerialReader
+
+    protocol = sys.argv[1] if len(sys.argv) > 1 else 'framed'
+
+    master, slave = pty.openpty()
+    serial_port = serial.Serial(os.ttyname(slave), baudrate=9600, timeout=0.5)
+
+    mcu = SimulatedMcu(master, CODECS[protocol](), feed_is_low=True, drop_every=5)
+    link = CommandLink(serial_port, CODECS[protocol]())
+    reader = SerialReader(serial_port, default_handler=lambda message: print('event', message),
+                          decoder=link.receive)
+    mcu.start()
+    link.start()
+    reader.start()
+
+    for i in range(10):
+        link.set_state('hatch', b'o')
+    link.send(b'u')
+    link.set_state('hatch', b'c')
+    link.set_state('hatch', b'o')
+    mcu.emit(b'r')
+    link.flush(timeout=5)
+    time.sleep(0.5)
+
+    print('commands seen by MCU: {}'.format(mcu.received))
+    print('link stats: {}'.format(link.stats.as_dict()))
+
+    reader.stop()
+    link.stop()
+    mcu.stop()
+    serial_port.close()
+    os.close(master)